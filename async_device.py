@@ -0,0 +1,160 @@
+import asyncio
+import os
+import time
+
+import recorder
+from health import health
+from metrics import metrics
+from ot_serial import EventLog, ResponseFrame, command_timeout, response_lines
+
+NRF_PLATFORM = "Zephyr"
+
+
+# asyncio counterpart of ot_device. The port is read without blocking from
+# the event loop, so one thread can drive hundreds of devices.
+class async_ot_device:
+    def __init__(self, port, platform="", ser=None, events=None, baudrate=115200, echo=True,
+                 **settings):
+        self.port = port
+        self.platform = platform
+        self.echo = echo  # the device echoes commands, see ResponseFrame
+        # an already open port can be shared with the blocking device classes
+        self.serial = ser or recorder.RecordingSerial(port, baudrate, timeout=0, **settings)
+        # output that doesn't belong to a command
+        self.events = events if events is not None else EventLog()
+        self.frame = None  # response currently being read
+        self.data_ready = None
+        self.lock = None
+        self.loop = None
+
+    # Start reading the port from the running event loop
+    def attach(self):
+        loop = asyncio.get_running_loop()
+        if self.loop is loop:
+            return
+        self.loop = loop
+        self.data_ready = asyncio.Event()
+        self.lock = asyncio.Lock()
+        loop.add_reader(self.serial.fileno(), self.on_readable)
+
+    # Stop reading the port
+    def detach(self):
+        if self.loop is not None:
+            self.loop.remove_reader(self.serial.fileno())
+            self.loop = None
+
+    def on_readable(self):
+        try:
+            data = os.read(self.serial.fileno(), 4096)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError:
+            data = b""
+        recorder.record(self.port, "r", data)
+        if not data:
+            self.detach()  # port went away, stop polling it
+            self.data_ready.set()
+            return
+        frame = self.frame
+        unsolicited = b""
+        if frame is not None and not frame.complete:
+            complete = frame.feed(data)
+            unsolicited = frame.take_unsolicited()
+            data = b""
+            if complete:
+                data = frame.remainder
+                self.data_ready.set()
+        data = unsolicited + data
+        if data:
+            metrics.received(self.port, len(data))
+            self.events.feed(data)
+
+    def write(self, data):
+        recorder.record(self.port, "w", data)
+        fd = self.serial.fileno()
+        while data:
+            data = data[os.write(fd, data):]
+
+    # Run command and return output once the device has answered, or the
+    # partial output if the timeout passes. Cancelling the coroutine leaves
+    # the device ready for the next command. The outcome counts towards the
+    # device's health, and a quarantined device returns "" at once.
+    async def run_command(self, command, timeout=None):
+        if not health.available(self.port):
+            return ""
+        self.attach()
+        if self.platform == NRF_PLATFORM:
+            command = "ot " + command
+        if timeout is None:
+            timeout = command_timeout(command)
+        async with self.lock:
+            frame = ResponseFrame(command, self.echo)
+            self.frame = frame
+            self.data_ready.clear()
+            start = time.monotonic()
+            try:
+                self.write(bytes(command + "\r\n", "utf-8"))
+                async with asyncio.timeout(timeout):
+                    while not frame.complete and self.loop is not None:
+                        await self.data_ready.wait()
+                        self.data_ready.clear()
+            except TimeoutError:
+                pass
+            finally:
+                self.frame = None  # late output is logged as an event
+                frame.record(self.port, command, time.monotonic() - start)
+        if frame.complete:
+            health.success(self.port, time.monotonic() - start, timeout)
+        else:
+            health.failure(self.port, "no answer to '%s'" % command)
+        return "\n".join(response_lines(frame.text, command))
+
+    def close(self):
+        self.detach()
+        self.serial.close()
+
+
+# Run a command on every device at once, results in device order
+async def broadcast(devices, command, timeout=None):
+    return await asyncio.gather(*(device.run_command(command, timeout) for device in devices))
+
+
+# Run a command on every device at once and group ports by response
+async def grouped_broadcast(devices, command, timeout=None):
+    response_dict = {}
+    for device, response in zip(devices, await broadcast(devices, command, timeout)):
+        response_dict.setdefault(response, []).append(device.port)
+    return response_dict
+
+
+# Run a command on one device, returns (port, response, seconds taken)
+async def timed_command(device, command, timeout=None):
+    start = time.monotonic()
+    response = await device.run_command(command, timeout)
+    return device.port, response, time.monotonic() - start
+
+
+# Run a command on every device at once and yield (port, response, latency)
+# as each device answers. With `quorum` set, stop as soon as that many
+# devices have answered and cancel the commands still outstanding. With
+# `limit` set, at most that many devices run the command at the same time.
+async def stream(devices, command, timeout=None, quorum=None, limit=None):
+    if limit:
+        semaphore = asyncio.Semaphore(limit)
+
+        async def limited(device):
+            async with semaphore:
+                return await timed_command(device, command, timeout)
+        tasks = [asyncio.ensure_future(limited(device)) for device in devices]
+    else:
+        tasks = [asyncio.ensure_future(timed_command(device, command, timeout))
+                 for device in devices]
+    try:
+        for count, next_done in enumerate(asyncio.as_completed(tasks), 1):
+            yield await next_done
+            if quorum and count >= quorum:
+                break
+    finally:
+        for task in tasks:
+            task.cancel()
+
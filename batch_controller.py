@@ -1,7 +1,27 @@
+import os
 import serial
 import time
 import serial.tools.list_ports as ports_list
 import re
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import queue
+from ot_serial import read_response, response_lines, response_ok, run_batch, SerialPool, EventLog, DeviceReader
+import discovery
+import hotplug
+from async_device import async_ot_device, broadcast, stream
+from watch import NetworkWatch
+import ping_matrix
+import topology
+import survey
+import traffic
+import bringup
+import dataset
+import reconcile
+from metrics import metrics, stats_command
+from recorder import record_command
+from health import health, health_command, RETRIES
 
 available_ports = []
 thread_devices = []
@@ -10,20 +30,52 @@ SLABS_PLATFORM = "EFR32"
 
 NETWORK_KEY = "00112233445566778899aabbccddeeff"
 PAN_ID = "0xabcd"
-CHANNEL = "15"
+# Radio settings, overridden by the environment or "survey apply"
+CHANNEL = os.environ.get("OT_CHANNEL", "15")
+FTD_TXPOWER = int(os.environ.get("OT_FTD_TXPOWER", 0))
+MTD_TXPOWER = int(os.environ.get("OT_MTD_TXPOWER", -20))
+# FTDs in the last config, kept when "survey apply" configures again
+config_routers = 1
 
-FTD_TXPOWER = 0
-MTD_TXPOWER = -20
+# Maximum number of devices worked on at the same time
+WORKERS = 64
+
+# Bounds of the adaptive poll interval of the watch mode, in seconds
+WATCH_MIN_INTERVAL = 0.5
+WATCH_MAX_INTERVAL = 30.0
+
+# Serial connections, opened once per port
+pool = SerialPool(baudrate=115200, timeout=0.1, write_timeout=1.0)
+# Configuration last applied to each device
+reconciler = reconcile.Reconciler()
+# Follows boards being plugged in and out, see start_hotplug
+monitor = None
+hotplug_changes = queue.Queue()
+# Event loop of the console and the asyncio devices it reads from
+console_loop = None
+attached_devices = []
 
 
 class ot_device:
     def __init__(self, port):
         self.port = port  # COM Port
-        self.serial = serial.Serial(self.port, 115200, timeout=0.1, write_timeout=1.0)
+        self.serial = pool.get(self.port)
         self.platform = ""  # zephyr or efr32
         self.rloc = ""
         self.ipaddr = ""
-        self.failed = False # TODO do something with this flag
+        self.failed = False  # quarantined by the health checks or config failed
+        self.lock = threading.RLock()  # one command at a time per device
+        # output the device prints on its own, shared by every reader
+        self.events = EventLog()
+        self.reader = DeviceReader(self.serial, self.events)
+
+    # Keep draining the port in the background, so output that arrives
+    # between commands is logged as events instead of being lost
+    def start_reader(self):
+        self.reader.start()
+
+    def stop_reader(self):
+        self.reader.stop()
 
     # Safely open port only if not open
     def open_port(self):
@@ -35,25 +87,80 @@ class ot_device:
         if self.serial.is_open:
             self.serial.close()
 
-    # Run command and wait 10ms and return formatted output
-    def run_command(self, command):
+    # Run command and return output once the device has answered. A command
+    # that gets no answer is retried; a quarantined device returns "" at once.
+    def run_command(self, command, timeout=None, retries=RETRIES):
         if self.platform == NRF_PLATFORM:
             command = "ot " + command
-        self.serial.write(bytes(command + "\r\n", "utf-8"))
-        time.sleep(0.1)
-        self.serial.flush()
-        return self.get_output()
-
-    # Get output and format lines
-    def get_output(self):
-        self.serial.readline()
-        res = self.serial.read(200)
-        res = res.decode()
-        return res
+
+        def send(timeout):
+            if self.reader.running:
+                return self.reader.request([command], timeout=timeout)[0]
+            with self.lock:
+                self.serial.reset_input_buffer()  # drop output left by an abandoned command
+                self.serial.write(bytes(command + "\r\n", "utf-8"))
+                self.serial.flush()
+                return read_response(self.serial, command, timeout)
+
+        res = health.run(self.port, command, send, timeout, retries)
+        self.failed = health.quarantined(self.port)
+        return "\n".join(response_lines(res, command))
+
+    # Get output without the echoed command and prompts
+    def get_output(self, command, timeout=None):
+        res = read_response(self.serial, command, timeout)
+        return "\n".join(response_lines(res, command))
     
-    def ping(self, address):
-        res = self.run_command("ping " + address)
+    # Send several commands back to back and match each response to its
+    # command. Returns a list of (command, output, ok) tuples.
+    def run_batch(self, commands, timeout=None):
+        if self.platform == NRF_PLATFORM:
+            commands = ["ot " + command for command in commands]
+        results = []
+        if not health.available(self.port):
+            self.failed = True
+            return [(command, "quarantined", False) for command in commands]
+        start = time.monotonic()
+        try:
+            if self.reader.running:
+                responses = self.reader.request(commands, timeout=timeout)
+                batch = [(c, res, response_ok(res) or not c.strip()) for c, res in zip(commands, responses)]
+            else:
+                with self.lock:
+                    batch = run_batch(self.serial, commands, timeout=timeout)
+        except (serial.SerialException, OSError) as e:
+            health.failure(self.port, "%s: %s" % (type(e).__name__, e))
+            batch = [(command, "", False) for command in commands]
+        else:
+            health.batch(self.port, batch, time.monotonic() - start)
+        self.failed = health.quarantined(self.port)
+        for command, res, ok in batch:
+            results.append((command, "\n".join(response_lines(res, command)), ok))
+        return results
+
+    # Ping an address and print the replies. With the reader running, replies
+    # that arrive after the command's "Done" are collected from the events.
+    def ping(self, address, timeout=5.0):
+        replies = queue.Queue()
+
+        def collect(timestamp, line):
+            if "bytes from" in line or "packets transmitted" in line:
+                replies.put(line)
+
+        self.events.subscribe(collect)
+        try:
+            lines = self.run_command("ping " + address, retries=0).split("\n")
+            deadline = time.monotonic() + timeout
+            while self.reader.running and not any("packets transmitted" in l for l in lines):
+                try:
+                    lines.append(replies.get(timeout=max(0, deadline - time.monotonic())))
+                except queue.Empty:
+                    break
+        finally:
+            self.events.unsubscribe(collect)
+        res = "\n".join(line for line in lines if line != "Done")
         print(res)
+        return res
 
 # Get available COM ports
 def get_ports():
@@ -63,95 +170,342 @@ def get_ports():
     return ports_l
 
 
-def link_devices():
+# Probe all ports at once, using cached identities where they still match
+def link_devices(refresh=False):
     print("Thread devices:")
-    for port in available_ports:
-        device = ot_device(port.name)
-        platform = device.run_command("\r\nplatform")
-        if "EFR32" in platform:
-            device.platform = SLABS_PLATFORM
-            thread_devices.append(device)
-            print(port.name + " | ERF32")
-        platform = device.run_command("\r\not platform")
-        if "Zephyr" in platform:
-            device.platform = NRF_PLATFORM
-            thread_devices.append(device)
-            print(port.name + " | Zephyr")
-
-
-def config_devices(routers=1):
-    router = False
-    router_count = 0
-    for device in thread_devices:
-        if not router:
-            device.run_command("txpower " + str(FTD_TXPOWER))
-            device.run_command("mode rdn")
-            if router_count == routers:
-                router = True
+    patterns = [port.device for port in available_ports]
+    for entry in discovery.discover(pool, patterns, refresh):
+        add_device(entry)
+
+
+def add_device(entry):
+    if not entry["platform"]:
+        return
+    device = ot_device(entry["port"])
+    device.platform = entry["platform"]
+    thread_devices.append(device)
+    print(entry["port"] + " | " + entry["platform"])
+
+
+def remove_device(entry):
+    for device in [d for d in thread_devices if d.port == entry["port"]]:
+        device.stop_reader()
+        thread_devices.remove(device)
+        reconciler.forget(device.port)
+        print(device.port + " | removed")
+
+
+# Probe the ports once, then follow boards being plugged in and out. The
+# monitor queues the changes and the console applies them between commands.
+def start_hotplug():
+    global monitor
+    print("Thread devices:")
+    monitor = hotplug.HotplugMonitor(
+        pool,
+        on_added=lambda entry: hotplug_changes.put((add_device, entry)),
+        on_removed=on_removed,
+    )
+    for entry in monitor.start():
+        add_device(entry)
+
+
+# Called from the monitor's thread before the pool closes the removed port
+def on_removed(entry):
+    detach_port(entry["port"])
+    hotplug_changes.put((remove_device, entry))
+
+
+# Stop the console's event loop reading a port, so it isn't left polling
+# the stale fd once the connection is closed
+def detach_port(port):
+    loop = console_loop
+    if loop is None or not loop.is_running():
+        return
+
+    async def detach():
+        for device in attached_devices:
+            if device.port == port:
+                device.detach()
+    asyncio.run_coroutine_threadsafe(detach(), loop).result()
+
+
+# Apply the boards plugged in or out since the last call, True if any were
+def apply_hotplug_changes():
+    changed = False
+    while True:
+        try:
+            function, entry = hotplug_changes.get_nowait()
+        except queue.Empty:
+            return changed
+        function(entry)
+        changed = True
+
+
+# Run a function on every thread device at the same time and return the
+# results in device order
+def for_all_devices(function, devices=None):
+    if devices is None:
+        devices = thread_devices
+    if not devices:
+        return []
+    with ThreadPoolExecutor(max_workers=min(WORKERS, len(devices))) as pool:
+        return list(pool.map(function, devices))
+
+
+# Configure the first `routers` devices as FTDs and the rest as MTDs. Each
+# device's settings are read back first and only those that differ are
+# sent, unless `force` is set.
+def config_devices(routers=1, force=False):
+    global config_routers
+    config_routers = routers
+    # the whole dataset goes in one command, checked before anything is sent
+    try:
+        tlvs = dataset.build_dataset(CHANNEL, PAN_ID, NETWORK_KEY)
+    except ValueError as e:
+        print("Invalid network settings: " + str(e))
+        return []
+    changed = []
+
+    def config_device(device, ftd):
+        if not health.available(device.port):
+            return []  # reported with the other quarantined devices
+        if ftd:
+            desired = reconcile.desired_state(tlvs, "rdn", FTD_TXPOWER)
         else:
-            device.run_command("txpower " + str(MTD_TXPOWER))
-            device.run_command("mode rn")
-        device.run_command("dataset channel" + CHANNEL)
-        device.run_command("dataset networkkey" + NETWORK_KEY)
-        device.run_command("dataset panid" + PAN_ID)
-        device.run_command("dataset commit active")
+            desired = reconcile.desired_state(tlvs, "rn", MTD_TXPOWER)
+        commands = reconcile.diff_commands(reconcile.UNKNOWN_STATE, desired)
+        if not force:
+            results = device.run_batch(reconcile.READ_COMMANDS + ["rloc16", "ipaddr"])
+            if not health.available(device.port):
+                return []  # stopped answering while being read
+            current = reconcile.current_state(
+                [res.split("\n") for command, res, ok in results[:len(reconcile.READ_COMMANDS)]])
+            commands, note = reconciler.plan(device.port, current, desired)
+            if note:
+                print(device.port + " | " + note)
+        if commands:
+            changed.append(device)
+            results = device.run_batch(commands + ["rloc16", "ipaddr"])
+        failures = [(command, res) for command, res, ok in results if not ok]
+        for command, res in failures:
+            print(device.port + " | " + command + " | " + (res or "no response"))
+        if not failures:
+            reconciler.applied(device.port, desired)
         try:
-            device.rloc = re.findall(r'\d+', device.run_command("rloc16"))[0]
-            device.ipaddr = device.run_command("ipaddr").split('\n')[0]
+            device.rloc = re.findall(r'\d+', results[-2][1])[0]
+            device.ipaddr = results[-1][1].split('\n')[0]
             device.failed = False
         except:
             device.failed = True
+        return failures
 
+    ftds = thread_devices[:routers]
+    start = time.monotonic()
+    failures = for_all_devices(lambda device: config_device(device, device in ftds))
+    metrics.operation("config", time.monotonic() - start)
+    print("%d of %d devices changed" % (len(changed), len(thread_devices)))
+    print_quarantined()
+    return failures
 
-def get_network_state():
+
+# Thread role reported in a state response
+def parse_state(device_state):
+    s = "unknown"
+    if "child" in device_state:
+        s = "child"
+    elif "disabled" in device_state:
+        s = "disabled"
+    elif "detached" in device_state:
+        s = "detached"
+    elif "router" in device_state:
+        s = "router"
+    elif "leader" in device_state:
+        s = "leader"
+    return s
+
+
+def format_network_state(devices, responses):
     network_state = ""
-    for device in thread_devices:
-        s = "unknown"
-        device_state = device.run_command("state")
-        if "child" in device_state:
-            s = "child"
-        elif "disabled" in device_state:
-            s = "disabled"
-        elif "detached" in device_state:
-            s = "detached"
-        elif "router" in device_state:
-            s = "router"
-        elif "leader" in device_state:
-            s = "leader"
-        network_state += device.port + " | " + device.rloc + " | " + s + "\n"
+    for device, device_state in zip(devices, responses):
+        state = "quarantined" if health.quarantined(device.port) else parse_state(device_state)
+        network_state += device.port + " | " + device.rloc + " | " + state + "\n"
     return network_state[:-1]  # remove trailing carriage return
 
 
+def get_network_state():
+    responses = for_all_devices(lambda device: device.run_command("state"))
+    return format_network_state(thread_devices, responses)
+
+
+# Bring the network up in stages, leader then routers then children, and
+# report how long each stage took and which devices held it up
 def start_network():
-    for device in thread_devices:
-        res = device.run_command("ifconfig up")
-        res = device.run_command("thread start")
-        # TODO error handling - set failed flag to True if error
+    devices = [device for device in thread_devices if health.available(device.port)]
+    modes = for_all_devices(lambda device: device.run_command("mode"), devices)
+    leader, routers, children = bringup.plan(devices, [bringup.is_ftd(mode) for mode in modes])
+    if leader is None:
+        print("No FTD to form the network, configure devices first")
+        return None
+
+    def start(device):
+        commands = ["ifconfig up", "thread start"]
+        if device in routers:
+            commands.insert(0, "routerselectionjitter %d" % bringup.ROUTER_SELECTION_JITTER)
+        # the jitter is only an optimisation, older firmware may not have it
+        return report_failures(device, device.run_batch(commands)[-2:])
+
+    def state(device):
+        return parse_state(device.run_command("state"))
+
+    report = bringup.BringUp(start, state).run(leader, routers, children)
+    print(bringup.format_report(report, lambda device: device.port))
+    print_quarantined()
+    return report
 
 def stop_network():
-    for device in thread_devices:
-        res = device.run_command("thread stop")
-        res = device.run_command("ifconfig down")
-        # TODO error handling - set failed flag to True if error
+    stopped = for_all_devices(
+        lambda device: report_failures(device, device.run_batch(["thread stop", "ifconfig down"])))
+    print("%d of %d devices stopped" % (stopped.count(True), len(stopped)))
+    print_quarantined()
+
+
+# Print the commands of a batch that failed, True if none did
+def report_failures(device, results):
+    failures = [(command, res) for command, res, ok in results if not ok]
+    for command, res in failures:
+        print(device.port + " | " + command + " | " + (res or "no response"))
+    if failures:
+        device.failed = True
+    return not failures
+
+
+def print_quarantined():
+    quarantined = health.report()
+    if quarantined:
+        print(health.format_report())
 
-# Get IP addresses of each device and state of each device
-def ping_demo():
+# Ping every pair of devices, a round of disjoint pings at a time, and
+# return the RTT/loss matrix as a table, "csv" or "json"
+async def ping_demo(aio_devices, output="table"):
+    addresses = None
+    if all(device.ipaddr for device in thread_devices):
+        addresses = [device.ipaddr for device in thread_devices]
+    matrix = await ping_matrix.ping_matrix(aio_devices, addresses)
+    if output == "csv":
+        return ping_matrix.to_csv(matrix)
+    if output == "json":
+        return ping_matrix.to_json(matrix)
+    return ping_matrix.format_matrix(matrix)
+
+# Console "traffic [pattern] [udp|ping] [count] [size] [json]": load the mesh
+# with a traffic pattern from every device at once and report per-flow
+# delivery, loss and latency and the goodput over time
+async def traffic_demo(aio_devices, cmd):
+    words = cmd.split()[1:]
+    pattern = next((word for word in words if word in traffic.PATTERNS), traffic.ALL_TO_LEADER)
+    kind = "ping" if "ping" in words else "udp"
+    numbers = [int(word) for word in words if word.isdigit()]
+    count = numbers[0] if numbers else traffic.COUNT
+    size = numbers[1] if len(numbers) > 1 else traffic.SIZE
+    results = await traffic.run_traffic(aio_devices, pattern, kind, count, size)
+    if results is not None and "json" in words:
+        return traffic.to_json(results)
+    return traffic.format_results(results)
+
+# asyncio counterparts of the thread devices, sharing their open ports. The
+# previous ones stop reading first so no port is read twice.
+def async_devices():
+    global attached_devices
+    for device in attached_devices:
+        device.detach()
+    attached_devices = [
+        async_ot_device(device.port, device.platform, ser=device.serial, events=device.events)
+        for device in thread_devices
+    ]
+    return attached_devices
+
+
+# Run a blocking operation while the event loop isn't reading the ports;
+# background readers keep draining them in the meantime
+async def blocking(aio_devices, function, *args):
+    for device in aio_devices:
+        device.detach()
     for device in thread_devices:
-        for receiver in thread_devices:
-            if device != receiver:
-                print(device.port)
-                device.ping(receiver.ipaddr)
-    return ""
+        device.start_reader()
+    try:
+        return await asyncio.to_thread(function, *args)
+    finally:
+        for device in thread_devices:
+            device.stop_reader()
+
 
-def console():
+async def async_network_state(aio_devices):
+    return format_network_state(thread_devices, await broadcast(aio_devices, "state"))
+
+
+# Print each device's state as soon as it answers, stopping after `quorum`
+async def print_network_state(aio_devices, quorum=None):
+    rlocs = {device.port: device.rloc for device in thread_devices}
+    async for port, device_state, latency in stream(aio_devices, "state", quorum=quorum):
+        print("%s | %s | %s | %.0f ms" % (port, rlocs[port], parse_state(device_state), latency * 1000))
+
+
+# Poll the network until `stop` is set and print only role, rloc16 and
+# address changes. Polls quickly after a change and backs off when stable.
+async def watch_network(aio_devices, stop, min_interval=None, max_interval=None):
+    watch = NetworkWatch(min_interval or WATCH_MIN_INTERVAL, max_interval or WATCH_MAX_INTERVAL)
+    while not stop.is_set():
+        roles = [parse_state(res) for res in await broadcast(aio_devices, "state")]
+        moved = [(device, role) for device, role in zip(aio_devices, roles)
+                 if watch.role_changed(device.port, role)]
+        # only devices whose role changed are asked for rloc16 and addresses
+        rlocs = await broadcast([device for device, _ in moved], "rloc16")
+        addrs = await broadcast([device for device, _ in moved], "ipaddr")
+        changes = []
+        for (device, role), rloc, addr in zip(moved, rlocs, addrs):
+            rloc = rloc.split("\n")[0]
+            addresses = [a for a in addr.split("\n") if ":" in a]
+            changes += watch.update(device.port, role, rloc, addresses)
+        for change in changes:
+            print(change)
+        try:
+            await asyncio.wait_for(stop.wait(), watch.next_interval(bool(changes)))
+        except asyncio.TimeoutError:
+            pass
+
+
+# Scan every device's channels at once and recommend the least congested
+# channel and a txpower per role, planned from the links of the last
+# topology snapshot. With `apply` the settings are changed and the devices
+# configured again.
+async def site_survey(aio_devices, snapshot=None, apply=False):
+    global CHANNEL, FTD_TXPOWER, MTD_TXPOWER
+    result = await survey.survey(aio_devices, snapshot, {"ftd": FTD_TXPOWER, "mtd": MTD_TXPOWER})
+    print(survey.format_survey(result))
+    if apply and result["channel"] is not None:
+        CHANNEL = str(result["channel"])
+        FTD_TXPOWER, MTD_TXPOWER = result["txpower"]["ftd"], result["txpower"]["mtd"]
+        await blocking(aio_devices, config_devices, config_routers)
+    return result
+
+
+async def console():
+    global console_loop
+    console_loop = asyncio.get_running_loop()
+    aio_devices = async_devices()
+    mesh = topology.Topology()
     while True:
-        cmd = input(">")
+        cmd = await asyncio.to_thread(input, ">")
+        if apply_hotplug_changes():
+            aio_devices = async_devices()
         if cmd == "quit":
             break
         
         elif "demo" in cmd.split()[0]:
             if "ping" in cmd:
-                print(ping_demo())        
+                # "demo ping csv" / "demo ping json" for machine readable output
+                output = cmd.split()[-1] if cmd.split()[-1] in ("csv", "json") else "table"
+                print(await ping_demo(aio_devices, output))        
         
         elif "config" in cmd:
             number = 1
@@ -159,20 +513,59 @@ def console():
                 number = int(re.findall(r"\d+", cmd)[0])
             except:
                 pass
-            config_devices(number)
+            # "config N force" sends every setting without reading them first
+            await blocking(aio_devices, config_devices, number, "force" in cmd)
             
+        elif cmd.split()[0] == "stats":
+            print(stats_command(cmd))
+
+        elif cmd.split()[0] == "record":
+            print(record_command(cmd))
+
+        elif cmd.split()[0] == "health":
+            print(health_command(cmd))
+
+        elif cmd.split()[0] == "topology":
+            # links that changed since the last call, the whole graph the first time;
+            # "topology json FILE" / "topology dot FILE" also export it
+            print(mesh.format_changes(await mesh.refresh(aio_devices)))
+            message = topology.export_command(mesh.snapshot, cmd)
+            if message:
+                print(message)
+
+        elif cmd.split()[0] == "traffic":
+            print(await traffic_demo(aio_devices, cmd))
+
+        elif cmd.split()[0] == "survey":
+            # "survey apply" also switches to the recommended settings
+            await site_survey(aio_devices, mesh.snapshot, cmd.split()[1:] == ["apply"])
+
+        elif "watch" in cmd:
+            print("Watching network state, press enter to stop")
+            stop = asyncio.Event()
+            watcher = asyncio.create_task(watch_network(aio_devices, stop))
+            await asyncio.to_thread(input)
+            stop.set()
+            await watcher
+
         elif "state" in cmd:
-            print(get_network_state())
+            # "state N" stops once N devices have answered
+            quorum = None
+            try:
+                quorum = int(re.findall(r"\d+", cmd)[0])
+            except:
+                pass
+            await print_network_state(aio_devices, quorum)
             
         elif "start" in cmd:
             print("Starting thread network")
-            start_network()
-            print(get_network_state())
+            await blocking(aio_devices, start_network)
+            print(await async_network_state(aio_devices))
         
         elif "stop" in cmd:
             print("Stopping thread network")
-            stop_network()
-            print(get_network_state())
+            await blocking(aio_devices, stop_network)
+            print(await async_network_state(aio_devices))
                 
         else:
             print("Unknown Command")
@@ -180,5 +573,5 @@ def console():
 
 if __name__ == "__main__":
     available_ports = get_ports()
-    link_devices()
-    console()
+    start_hotplug()
+    asyncio.run(console())
\ No newline at end of file
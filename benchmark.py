@@ -0,0 +1,208 @@
+import argparse
+import asyncio
+import contextlib
+import io
+import json
+import os
+import resource
+import tempfile
+import time
+from types import SimpleNamespace
+
+import batch_controller
+import controller
+import discovery
+import linkspeed
+import thread_console
+from async_device import async_ot_device, broadcast
+from simulator import DeviceFarm, ZEPHYR, EFR32
+
+COMMAND_SAMPLES = 50
+
+
+# Run a function and return how long it took in ms
+def timed(function, *args):
+    start = time.perf_counter()
+    function(*args)
+    return (time.perf_counter() - start) * 1000
+
+
+def percentile(samples, p):
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(round(p / 100.0 * (len(samples) - 1))))]
+
+
+def latency_summary(samples):
+    return {
+        "p50": round(percentile(samples, 50), 3),
+        "p95": round(percentile(samples, 95), 3),
+        "max": round(max(samples), 3),
+    }
+
+
+# Time the controller.py entry points against a farm. The virtual devices
+# aren't in the cache and don't run at the settings boards ship with, so
+# their links are searched at every rate as with OT_LINK_SWEEP=1.
+def bench_controller(farm):
+    controller.devices[:] = [controller.ot_device(port) for port in farm.ports]
+    sweep, linkspeed.SWEEP = linkspeed.SWEEP, True
+    try:
+        link = timed(controller.detect_links, controller.devices)
+    finally:
+        linkspeed.SWEEP = sweep
+    device = controller.devices[0]
+    command = b"ot state" if farm.devices[0].dialect == ZEPHYR else b"state"
+    latency = [timed(device.run_command, command) for _ in range(COMMAND_SAMPLES)]
+    fanout = timed(controller.handle_command, command)
+    return {"link_ms": round(link, 3), "command_ms": latency_summary(latency),
+            "fanout_ms": round(fanout, 3)}
+
+
+# Time the batch_controller.py entry points against a farm
+def bench_batch_controller(farm):
+    batch_controller.available_ports = [SimpleNamespace(device=p, name=p) for p in farm.ports]
+    batch_controller.thread_devices[:] = []
+    cold = timed(batch_controller.link_devices)
+    batch_controller.thread_devices[:] = []
+    warm = timed(batch_controller.link_devices)
+    device = batch_controller.thread_devices[0]
+    latency = [timed(device.run_command, "state") for _ in range(COMMAND_SAMPLES)]
+    config = timed(batch_controller.config_devices, 1)
+    fanout = timed(batch_controller.get_network_state)
+    return {
+        "devices_found": len(batch_controller.thread_devices),
+        "discovery_cold_ms": round(cold, 3),
+        "discovery_warm_ms": round(warm, 3),
+        "command_ms": latency_summary(latency),
+        "config_ms": round(config, 3),
+        "fanout_ms": round(fanout, 3),
+    }
+
+
+# Time the thread_console.py entry points against a farm
+def bench_thread_console(farm):
+    console = thread_console.ThreadConsole(
+        channel=thread_console.CHANNEL, panid=thread_console.PANID,
+        networkkey=thread_console.NETWORKKEY)
+    try:
+        cold = timed(console.findOtDevices, False, farm.ports)
+        warm = timed(console.findOtDevices, False, farm.ports)
+        with console.pool.connection(console.threadDevices[0]) as ser:
+            latency = [timed(console.writeReadSerial, ser, "ot state\r\n")
+                       for _ in range(COMMAND_SAMPLES)]
+        config = timed(console.configNetwork)
+        fanout = timed(console.showDeviceState)
+    finally:
+        console.pool.close_all()
+    return {
+        "devices_found": console.noOfFoundDevices,
+        "discovery_cold_ms": round(cold, 3),
+        "discovery_warm_ms": round(warm, 3),
+        "command_ms": latency_summary(latency),
+        "config_ms": round(config, 3),
+        "fanout_ms": round(fanout, 3),
+    }
+
+
+# Time the asyncio engine against a farm
+def bench_async(farm):
+    platform = "Zephyr" if farm.devices[0].dialect == ZEPHYR else ""
+    devices = [async_ot_device(port, platform) for port in farm.ports]
+
+    async def measure():
+        latency = []
+        for _ in range(COMMAND_SAMPLES):
+            start = time.perf_counter()
+            await devices[0].run_command("state")
+            latency.append((time.perf_counter() - start) * 1000)
+        start = time.perf_counter()
+        await broadcast(devices, "state")
+        return latency, (time.perf_counter() - start) * 1000
+
+    try:
+        latency, fanout = asyncio.run(measure())
+    finally:
+        for device in devices:
+            device.close()
+    return {"command_ms": latency_summary(latency), "fanout_ms": round(fanout, 3)}
+
+
+# Close any ports an entry point left open
+def cleanup():
+    for device in controller.devices:
+        device.close_port()
+    controller.devices[:] = []
+    batch_controller.thread_devices[:] = []
+    batch_controller.pool.close_all()
+
+
+ENTRY_POINTS = {
+    "controller": bench_controller,
+    "batch_controller": bench_batch_controller,
+    "thread_console": bench_thread_console,
+    "async": bench_async,
+}
+
+
+def run(sizes, entry_points, dialect, latency, jitter):
+    # every virtual device needs a few file descriptors
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    results = []
+    with tempfile.TemporaryDirectory() as cache_dir:
+        for size in sizes:
+            for name in entry_points:
+                discovery.CACHE_FILE = os.path.join(cache_dir, "%s-%d.json" % (name, size))
+                with DeviceFarm(size, dialect, latency=latency, jitter=jitter) as farm:
+                    try:
+                        with contextlib.redirect_stdout(io.StringIO()):
+                            result = ENTRY_POINTS[name](farm)
+                    except Exception as e:
+                        # pyserial's blocking calls use select(), which can't
+                        # handle descriptors above FD_SETSIZE (1024)
+                        result = {"error": "%s: %s" % (type(e).__name__, e)}
+                    finally:
+                        cleanup()
+                result.update(entry_point=name, devices=size)
+                results.append(result)
+                print(format_result(result))
+    return results
+
+
+def format_result(result):
+    fields = ["%s %d devices:" % (result["entry_point"], result["devices"])]
+    for key, value in result.items():
+        if key in ("entry_point", "devices"):
+            continue
+        if isinstance(value, str):
+            pass
+        elif isinstance(value, dict):
+            value = "/".join("%g" % v for v in value.values()) + " (p50/p95/max)"
+        else:
+            value = "%g" % value
+        fields.append("  %s = %s" % (key, value))
+    return "\n".join(fields)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the controllers on simulated devices")
+    parser.add_argument("--sizes", default="1,4,16,64,256",
+                        help="comma separated numbers of devices")
+    parser.add_argument("--entry-points", default=",".join(ENTRY_POINTS),
+                        help="comma separated subset of " + ", ".join(ENTRY_POINTS))
+    parser.add_argument("--dialect", choices=[ZEPHYR, EFR32], default=ZEPHYR)
+    parser.add_argument("--latency", type=float, default=0.002,
+                        help="device response latency in seconds")
+    parser.add_argument("--jitter", type=float, default=0.0,
+                        help="random extra latency in seconds")
+    parser.add_argument("--json", help="write results to this file")
+    args = parser.parse_args()
+    sizes = [int(size) for size in args.sizes.split(",")]
+    results = run(sizes, args.entry_points.split(","), args.dialect, args.latency, args.jitter)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,113 @@
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from metrics import metrics
+
+# Seconds each stage may take to reach its target state
+STAGE_TIMEOUT = 30.0
+# Seconds between state polls while a stage converges
+POLL_INTERVAL = 0.2
+# Router selection jitter set on routers before they start, in seconds. The
+# OpenThread default of 120 s leaves a REED attached as a child for up to two
+# minutes before it becomes a router.
+ROUTER_SELECTION_JITTER = 1
+WORKERS = 64
+# Reply of the "mode" command: any of r, d and n, or "-" for none of them
+MODE = re.compile(r"[rdn]+|-")
+
+
+# Staged network bring-up: the leader first, then all routers at once, then
+# all children at once. Each stage waits until its devices report the target
+# state, so nothing tries to attach before there is a network to attach to.
+#   start(device) starts Thread on a device and returns False if it failed
+#   state(device) returns the device's role, e.g. "router"
+class BringUp:
+    def __init__(self, start, state, stage_timeout=STAGE_TIMEOUT, poll_interval=POLL_INTERVAL):
+        self.start = start
+        self.state = state
+        self.stage_timeout = stage_timeout
+        self.poll_interval = poll_interval
+
+    def map(self, function, devices):
+        with ThreadPoolExecutor(max_workers=min(WORKERS, len(devices))) as pool:
+            return list(pool.map(function, devices))
+
+    # Start the devices and poll them until all are in `targets` or the
+    # timeout passes. Returns a report of the stage with the devices that
+    # didn't get there and the state they were left in.
+    def stage(self, name, devices, targets):
+        begin = time.monotonic()
+        failed = [device for device, ok in zip(devices, self.map(self.start, devices)) if not ok]
+        waiting = [device for device in devices if device not in failed]
+        states = {}
+        deadline = begin + self.stage_timeout
+        while waiting:
+            for device, role in zip(waiting, self.map(self.state, waiting)):
+                states[device] = role
+            waiting = [device for device in waiting if states[device] not in targets]
+            if not waiting or time.monotonic() >= deadline:
+                break
+            time.sleep(self.poll_interval)
+        seconds = time.monotonic() - begin
+        metrics.operation("bringup_" + name, seconds)
+        stragglers = {device: "start failed" for device in failed}
+        stragglers.update((device, states[device]) for device in waiting)
+        return {
+            "stage": name,
+            "devices": len(devices),
+            "seconds": round(seconds, 3),
+            "converged": not stragglers,
+            "stragglers": stragglers,
+        }
+
+    # Bring the network up and return a report of every stage, with the
+    # time to a fully attached network or None if a stage didn't converge
+    def run(self, leader, routers=(), children=()):
+        begin = time.monotonic()
+        stages = [self.stage("leader", [leader], ("leader",))]
+        if routers:
+            stages.append(self.stage("routers", list(routers), ("router",)))
+        if children:
+            stages.append(self.stage("children", list(children), ("child",)))
+        seconds = time.monotonic() - begin
+        converged = all(stage["converged"] for stage in stages)
+        if converged:
+            metrics.operation("bringup", seconds)
+        return {
+            "stages": stages,
+            "converged": converged,
+            "seconds": round(seconds, 3) if converged else None,
+        }
+
+
+# Whether a "mode" reply is that of an FTD. Anything that isn't a mode, such
+# as an error line or an empty reply from a quarantined device, is not.
+def is_ftd(reply):
+    mode = reply.strip().split("\n")[0].strip()
+    return MODE.fullmatch(mode) is not None and "d" in mode
+
+
+# Split devices into leader, routers and children given whether each one is
+# an FTD ("d" in its mode). The first FTD becomes the leader.
+def plan(devices, ftd):
+    ftds = [device for device, is_ftd in zip(devices, ftd) if is_ftd]
+    children = [device for device, is_ftd in zip(devices, ftd) if not is_ftd]
+    if not ftds:
+        return None, [], children
+    return ftds[0], ftds[1:], children
+
+
+def format_report(report, name=str):
+    lines = []
+    for stage in report["stages"]:
+        lines.append("%s: %d devices in %.2f s%s" % (
+            stage["stage"], stage["devices"], stage["seconds"],
+            "" if stage["converged"] else " (not converged)"))
+        for device, state in stage["stragglers"].items():
+            lines.append("  %s | %s" % (name(device), state))
+    if report["converged"]:
+        lines.append("network converged in %.2f s" % report["seconds"])
+    else:
+        lines.append("network did not converge")
+    return "\n".join(lines)
@@ -0,0 +1,117 @@
+import argparse
+import itertools
+import json
+import os
+import socket
+import sys
+
+# Unix socket the daemon listens on. The client only uses the standard
+# library so that it starts quickly.
+SOCKET_PATH = os.environ.get(
+    "OT_DAEMON_SOCKET",
+    os.path.join(os.environ.get("XDG_RUNTIME_DIR") or "/tmp", "ot_controller-%d.sock" % os.getuid()),
+)
+
+
+# Connection to the controller daemon. Requests can be sent back to back and
+# their messages read as they arrive.
+class Client:
+    def __init__(self, path=SOCKET_PATH):
+        self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.socket.connect(path)
+        self.file = self.socket.makefile("rwb")
+        self.ids = itertools.count(1)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    # Send a request without waiting for it, returns its id
+    def send(self, command=None, op="command", devices=None, timeout=None, quorum=None):
+        request = {"id": next(self.ids), "op": op}
+        if command is not None:
+            request["command"] = command
+        if devices:
+            request["devices"] = devices
+        if timeout is not None:
+            request["timeout"] = timeout
+        if quorum is not None:
+            request["quorum"] = quorum
+        self.file.write(json.dumps(request).encode() + b"\n")
+        self.file.flush()
+        return request["id"]
+
+    # Yield messages until `pending` requests are done
+    def messages(self, pending=1):
+        while pending:
+            line = self.file.readline()
+            if not line:
+                raise ConnectionError("daemon closed the connection")
+            message = json.loads(line)
+            yield message
+            if message.get("done"):
+                pending -= 1
+
+    # Run one command and yield (port, response, seconds) as devices answer
+    def command(self, command, devices=None, timeout=None, quorum=None):
+        self.send(command, devices=devices, timeout=timeout, quorum=quorum)
+        for message in self.messages():
+            if "error" in message:
+                raise RuntimeError(message["error"])
+            if "port" in message:
+                yield message["port"], message["response"], message["seconds"]
+
+    def close(self):
+        self.file.close()
+        self.socket.close()
+
+
+def print_message(message, raw):
+    if raw:
+        print(json.dumps(message))
+    elif "error" in message:
+        print("error: " + message["error"], file=sys.stderr)
+    elif "port" in message:
+        print("%s | %s" % (message["port"], message["response"].replace("\n", " ")))
+    elif "devices" in message:
+        for entry in message["devices"]:
+            print("%s | %s%s" % (entry["port"], entry["platform"], " | TTM" if entry["ttm"] else ""))
+    elif "stats" in message:
+        print(json.dumps(message["stats"], indent=1))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Send commands to the controller daemon. 'devices' lists the "
+                    "devices and 'stats' prints the metrics; with no command, "
+                    "commands are read from stdin, one per line, and sent at once.")
+    parser.add_argument("command", nargs="*")
+    parser.add_argument("--socket", default=SOCKET_PATH)
+    parser.add_argument("-d", "--devices", action="append", help="port or glob, repeatable")
+    parser.add_argument("--timeout", type=float)
+    parser.add_argument("--quorum", type=int)
+    parser.add_argument("--json", action="store_true", help="print the raw messages")
+    args = parser.parse_args()
+    commands = [" ".join(args.command)] if args.command else [line.strip() for line in sys.stdin]
+    commands = [command for command in commands if command]
+    try:
+        client = Client(args.socket)
+    except OSError as e:
+        sys.exit("can't reach the daemon on %s: %s" % (args.socket, e))
+    with client:
+        for command in commands:
+            if command in ("devices", "stats"):
+                client.send(op=command)
+            else:
+                client.send(command, devices=args.devices, timeout=args.timeout, quorum=args.quorum)
+        failed = False
+        for message in client.messages(len(commands)):
+            failed = failed or "error" in message
+            print_message(message, args.json)
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
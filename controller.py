@@ -1,19 +1,36 @@
 import serial
+import os
 import time
+import asyncio
+import threading
 import serial.tools.list_ports as ports_list
+import discovery
+import linkspeed
+from ot_serial import read_response
+from async_device import async_ot_device, grouped_broadcast
+from metrics import stats_command
+from recorder import RecordingSerial, record_command
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 # List of available ports
 available_ports = []
 # List of devices that the CLI is connected to
 devices = []
+# Maximum number of devices a command is sent to at the same time
+WORKERS = 64
+# Settings the ports are opened with; boards that don't answer are tried
+# at others
+BAUDRATE = 38400
+PARITY = serial.PARITY_EVEN
 
 
 class ot_device:
     def __init__(self, port):
         self.port = port  # COM Port
-        self.serial = serial.Serial(
-            self.port, 38400, timeout=0, parity=serial.PARITY_EVEN
+        self.serial = RecordingSerial(
+            self.port, BAUDRATE, timeout=0, parity=PARITY
         )
+        self.lock = threading.Lock()  # one command at a time per device
 
     # Safely open port only if not open
     def open_port(self):
@@ -25,16 +42,16 @@ class ot_device:
         if self.serial.is_open:
             self.serial.close()
 
-    # Run command and wait 10ms and return formatted output
+    # Run command and return formatted output once the device has answered
     def run_command(self, command):
-        self.serial.write(command + b"\r\n")
-        time.sleep(0.01)
-        return self.get_output(command)
+        with self.lock:
+            self.serial.reset_input_buffer()  # drop output left by an abandoned command
+            self.serial.write(command + b"\r\n")
+            return self.get_output(command)
 
     # Get output and format lines
     def get_output(self, command):
-        res = self.serial.read_all()
-        res = res.decode()
+        res = read_response(self.serial, command)
         return (
             res.replace(command.decode(), "")
             .replace(">", "")
@@ -42,13 +59,26 @@ class ot_device:
             .replace("\n", " ")
         )
 
+    # Find the baud rate and parity the board answers with, trying
+    # `settings` besides the current ones, and raise the link to the fastest
+    # rate the firmware supports. A board that doesn't answer at all, or
+    # whose port fails while this runs, is left at the default settings.
+    def detect_link(self, settings=linkspeed.BOARD_SETTINGS):
+        with self.lock:
+            try:
+                if linkspeed.detect(self.serial, settings=settings):
+                    linkspeed.negotiate(self.serial)
+            except Exception:
+                try:
+                    linkspeed.apply(self.serial, {"baudrate": BAUDRATE, "parity": PARITY})
+                except (serial.SerialException, OSError):
+                    pass
+            return linkspeed.current_settings(self.serial)
+
     def thread_test(self):
         try:
             self.serial.write("thread version \r\n".encode())
-            time.sleep(0.01)
-            self.serial.read_all()
-            res = res.decode()
-            return True
+            return "Done" in read_response(self.serial, "thread version")
         except:
             return False
 
@@ -66,21 +96,61 @@ def get_ports():
 # Create device object for each available port
 def link_devices():
     for port in available_ports:
-        if port.name[:3].lower() == "com":
-            device = ot_device(port.name)
+        if port.name[:3].lower() == "com" or port.name.startswith(("ttyACM", "ttyUSB")):
+            device = ot_device(port.device)
             # if device.thread_test():
             devices.append(device)
-
-
-# Execute command on each device
-def handle_command(command):
+    detect_links(devices)
+
+
+# Find every device's link settings at the same time, returns them in order.
+# Only ports that had a thread device before are searched at every rate.
+def detect_links(devices):
+    if not devices:
+        return []
+    cache = discovery.load_cache()
+
+    def detect(device):
+        return device.detect_link(discovery.link_settings(discovery.known_device(cache, device.port)))
+    with ThreadPoolExecutor(max_workers=min(WORKERS, len(devices))) as pool:
+        return list(pool.map(detect, devices))
+
+
+# Run command on a device, returns (port, response, seconds taken)
+def timed_command(device, command):
+    start = time.monotonic()
+    response = device.run_command(command)
+    return device.port, response, time.monotonic() - start
+
+
+# Execute command on every device at once and yield (port, response,
+# latency) as each device answers. With `quorum` set, stop as soon as that
+# many devices have answered; the others finish in the background.
+def iter_command(command, quorum=None, workers=None):
+    if not devices:
+        return
+    pool = ThreadPoolExecutor(max_workers=min(workers or WORKERS, len(devices)))
+    futures = [pool.submit(timed_command, device, command) for device in devices]
+    try:
+        for count, future in enumerate(as_completed(futures), 1):
+            yield future.result()
+            if quorum and count >= quorum:
+                break
+    finally:
+        pool.shutdown(wait=False, cancel_futures=True)
+
+
+# Execute command on every device at once and group ports by response
+def handle_command(command, workers=None):
+    responses = {}
+    for port, response, latency in iter_command(command, workers=workers):
+        responses[port] = response
     response_dict = {}
     for device in devices:
-        response = device.run_command(command)
         try:
-            response_dict[response].append(device.port)
+            response_dict[responses[device.port]].append(device.port)
         except:
-            response_dict[response] = [device.port]
+            response_dict[responses[device.port]] = [device.port]
     return response_dict
 
 
@@ -88,15 +158,41 @@ def handle_command(command):
 def interface():
     while True:
         command = input("> ")
+        if command.split()[:1] == ["stats"]:
+            print(stats_command(command))
+            continue
+        if command.split()[:1] == ["record"]:
+            print(record_command(command))
+            continue
         response = handle_command(command.encode())
         for res in response:
             print(res + " | " + (" ").join(response[res]))
 
 
+# CLI interface loop on the asyncio engine, every port read from one thread
+async def async_interface():
+    aio_devices = [async_ot_device(device.port, ser=device.serial) for device in devices]
+    while True:
+        command = await asyncio.to_thread(input, "> ")
+        if command.split()[:1] == ["stats"]:
+            print(stats_command(command))
+            continue
+        if command.split()[:1] == ["record"]:
+            print(record_command(command))
+            continue
+        response = await grouped_broadcast(aio_devices, command)
+        for res in response:
+            print(res.replace("\n", " ") + " | " + (" ").join(response[res]))
+
+
 if __name__ == "__main__":
     available_ports = get_ports()
     link_devices()
     print(str(len(devices)) + " thread enabled devices found:")
     for device in devices:
         print(device.port)
-    interface()
+    # the event loop can only poll serial ports on posix systems
+    if os.name == "posix":
+        asyncio.run(async_interface())
+    else:
+        interface()
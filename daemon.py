@@ -0,0 +1,201 @@
+import argparse
+import asyncio
+import fnmatch
+import hmac
+import json
+import os
+import signal
+
+import hotplug
+from async_device import async_ot_device, stream
+from client import SOCKET_PATH
+from metrics import metrics
+from ot_serial import SerialPool
+
+# Commands whose last response is kept in the device list
+REMEMBERED = ("state", "rloc16", "ipaddr")
+
+
+# Long running owner of the device connections and registry. Clients send
+# one JSON request per line and get one JSON message per line back:
+#   {"id": 1, "command": "state", "devices": ["/dev/ttyACM*"], "timeout": 1.0,
+#    "quorum": 3}
+#     -> {"id": 1, "port": ..., "response": ..., "seconds": ...} per device
+#        as it answers, then {"id": 1, "done": true, "count": N}
+#   {"id": 2, "op": "devices"} -> {"id": 2, "devices": [...], "done": true}
+#   {"id": 3, "op": "stats"} -> {"id": 3, "stats": {...}, "done": true}
+# Requests on a connection run concurrently, so clients can pipeline them.
+# A command request may also give "limit", the most devices to run it on at
+# the same time. With `tcp` set to (host, port) the daemon also serves the
+# same requests over TCP, as an agent of a federation; requests over TCP
+# must then carry `token` if one is set. The Unix socket is only open to
+# the daemon's user and needs none.
+class ControllerDaemon:
+    def __init__(self, path=SOCKET_PATH, patterns=None, tcp=None, token=None):
+        self.path = path
+        self.patterns = patterns
+        self.tcp = tcp
+        self.token = token
+        self.pool = SerialPool(baudrate=115200, timeout=0.1, write_timeout=1.0)
+        self.devices = {}  # port -> async_ot_device
+        self.info = {}  # port -> discovery entry and remembered responses
+        self.monitor = None
+        self.server = None
+        self.tcp_server = None
+        self.loop = None
+
+    async def start(self):
+        self.loop = asyncio.get_running_loop()
+        self.monitor = hotplug.HotplugMonitor(
+            self.pool, self.patterns,
+            on_added=lambda entry: self.loop.call_soon_threadsafe(self.add, entry),
+            on_removed=lambda entry: self.call_in_loop(self.remove, entry),
+        )
+        for entry in await asyncio.to_thread(self.monitor.start):
+            self.add(entry)
+        if os.path.exists(self.path):
+            os.unlink(self.path)  # left behind by a daemon that didn't exit cleanly
+        self.server = await asyncio.start_unix_server(self.handle, path=self.path)
+        os.chmod(self.path, 0o600)
+        if self.tcp:
+            self.tcp_server = await asyncio.start_server(
+                lambda reader, writer: self.handle(reader, writer, check_token=True), *self.tcp)
+
+    async def stop(self):
+        for server in (self.server, self.tcp_server):
+            if server:
+                server.close()
+                await server.wait_closed()
+        if self.monitor:
+            await asyncio.to_thread(self.monitor.stop)
+        for device in self.devices.values():
+            device.detach()
+        self.pool.close_all()
+        try:
+            os.unlink(self.path)
+        except OSError:
+            pass
+
+    def add(self, entry):
+        port = entry["port"]
+        self.info[port] = dict(entry)
+        if entry["platform"] and port not in self.devices:
+            self.devices[port] = async_ot_device(port, entry["platform"], ser=self.pool.get(port))
+
+    # Stop reading a removed port before its connection is closed, so the
+    # loop isn't left polling a stale fd
+    def remove(self, entry):
+        self.info.pop(entry["port"], None)
+        device = self.devices.pop(entry["port"], None)
+        if device is not None:
+            device.detach()
+        self.pool.close(entry["port"])
+
+    # Run function(*args) on the event loop from another thread and wait
+    # for it to finish
+    def call_in_loop(self, function, *args):
+        async def call():
+            return function(*args)
+        return asyncio.run_coroutine_threadsafe(call(), self.loop).result()
+
+    # Devices matching a list of ports or glob patterns, all if None
+    def select(self, patterns):
+        if not patterns:
+            return [self.devices[port] for port in sorted(self.devices)]
+        return [self.devices[port] for port in sorted(self.devices)
+                if any(fnmatch.fnmatch(port, pattern) for pattern in patterns)]
+
+    async def handle(self, reader, writer, check_token=False):
+        tasks = set()
+
+        async def send(message):
+            writer.write(json.dumps(message).encode() + b"\n")
+            await writer.drain()
+
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                try:
+                    request = json.loads(line)
+                except ValueError:
+                    await send({"error": "invalid request", "done": True})
+                    continue
+                task = asyncio.create_task(self.serve(request, send, check_token))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+            if tasks:
+                await asyncio.wait(tasks)
+        except ConnectionError:
+            pass
+        finally:
+            for task in tasks:
+                task.cancel()
+            writer.close()
+
+    async def serve(self, request, send, check_token=False):
+        rid = request.get("id")
+        op = request.get("op", "command")
+        try:
+            if check_token and self.token and not hmac.compare_digest(str(request.get("token")), self.token):
+                await send({"id": rid, "error": "bad token", "done": True})
+            elif op == "devices":
+                await send({"id": rid, "devices": [self.info[port] for port in sorted(self.info)],
+                            "done": True})
+            elif op == "stats":
+                await send({"id": rid, "stats": metrics.to_dict(), "done": True})
+            elif op == "command":
+                command = request["command"]
+                count = 0
+                async for port, response, seconds in stream(
+                        self.select(request.get("devices")), command,
+                        request.get("timeout"), request.get("quorum"), request.get("limit")):
+                    if command in REMEMBERED and port in self.info:
+                        self.info[port][command] = response
+                    await send({"id": rid, "port": port, "response": response,
+                                "seconds": round(seconds, 6)})
+                    count += 1
+                await send({"id": rid, "done": True, "count": count})
+            else:
+                await send({"id": rid, "error": "unknown op " + str(op), "done": True})
+        except ConnectionError:
+            pass
+        except Exception as e:
+            await send({"id": rid, "error": "%s: %s" % (type(e).__name__, e), "done": True})
+
+
+async def serve(path, patterns, tcp=None, token=None):
+    daemon = ControllerDaemon(path, patterns, tcp, token)
+    await daemon.start()
+    print("%d thread devices, listening on %s" % (len(daemon.devices), path))
+    if tcp:
+        print("agent listening on %s:%d" % tcp)
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+    try:
+        await stop.wait()
+    finally:
+        await daemon.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Keep the thread devices open and serve commands")
+    parser.add_argument("--socket", default=SOCKET_PATH)
+    parser.add_argument("--patterns", nargs="*", help="port patterns, default ttyACM*/ttyUSB*")
+    parser.add_argument("--tcp", metavar="[HOST:]PORT",
+                        help="also serve a federation coordinator over TCP, on localhost by default")
+    parser.add_argument("--token", default=os.environ.get("OT_AGENT_TOKEN"),
+                        help="secret requests over TCP must carry (default $OT_AGENT_TOKEN)")
+    args = parser.parse_args()
+    tcp = None
+    if args.tcp:
+        host, _, port = args.tcp.rpartition(":")
+        tcp = (host or "127.0.0.1", int(port))
+    asyncio.run(serve(args.socket, args.patterns, tcp, args.token))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,123 @@
+import ipaddress
+import struct
+
+# MeshCoP TLV types of the Active Operational Dataset
+CHANNEL_TLV = 0
+PANID_TLV = 1
+EXTPANID_TLV = 2
+NETWORKNAME_TLV = 3
+PSKC_TLV = 4
+NETWORKKEY_TLV = 5
+MESHLOCALPREFIX_TLV = 7
+SECURITYPOLICY_TLV = 12
+ACTIVETIMESTAMP_TLV = 14
+CHANNELMASK_TLV = 53
+
+# Values used for the fields that aren't given, the same as the OpenThread
+# CLI examples use
+DEFAULT_NETWORKNAME = "OpenThread"
+DEFAULT_EXTPANID = "dead00beef00cafe"
+DEFAULT_MESHLOCALPREFIX = "fdde:ad00:beef:0"
+# Key rotation of 672 hours, OpenThread's default flags
+DEFAULT_SECURITYPOLICY = "02a0f7f8"
+# Channel page 0, channels 11-26
+DEFAULT_CHANNELMASK = "0004001fffe0"
+
+
+def tlv(kind, value):
+    return struct.pack("BB", kind, len(value)) + value
+
+
+def hex_field(name, value, size):
+    value = str(value).lower()
+    if value.startswith("0x"):
+        value = value[2:]
+    try:
+        data = bytes.fromhex(value)
+    except ValueError:
+        raise ValueError("%s must be hex: %s" % (name, value))
+    if len(data) != size:
+        raise ValueError("%s must be %d bytes: %s" % (name, size, value))
+    return data
+
+
+# Mesh local prefix as the 8 bytes of a /64, accepting "fdde:ad00:beef:0",
+# "fdde:ad00:beef:0::" or "fdde:ad00:beef:0::/64"
+def prefix_field(value):
+    value = str(value).split("/")[0]
+    if not value.endswith("::"):
+        value += "::"
+    try:
+        address = ipaddress.IPv6Address(value)
+    except ValueError:
+        raise ValueError("meshlocalprefix is not an IPv6 prefix: %s" % value)
+    if not address.packed.startswith(b"\xfd"):
+        raise ValueError("meshlocalprefix must be a ULA (fd00::/8): %s" % value)
+    return address.packed[:8]
+
+
+def int_field(name, value, low, high):
+    try:
+        number = int(str(value), 0)
+    except ValueError:
+        raise ValueError("%s must be a number: %s" % (name, value))
+    if not low <= number <= high:
+        raise ValueError("%s must be between %d and %d: %s" % (name, low, high, value))
+    return number
+
+
+# Encode an Active Operational Dataset as the hex string taken by
+# "dataset set active". Every field is checked here, so a bad value is
+# reported before anything is sent to a device. Raises ValueError.
+def build_dataset(channel, panid, networkkey, networkname=DEFAULT_NETWORKNAME,
+                  extpanid=DEFAULT_EXTPANID, meshlocalprefix=DEFAULT_MESHLOCALPREFIX,
+                  pskc=None, timestamp=1):
+    channel = int_field("channel", channel, 11, 26)
+    panid = int_field("panid", panid, 0, 0xFFFE)
+    name = str(networkname).encode()
+    if not 1 <= len(name) <= 16:
+        raise ValueError("networkname must be 1 to 16 bytes: %s" % networkname)
+    data = tlv(ACTIVETIMESTAMP_TLV, struct.pack(">Q", int(timestamp) << 16))
+    data += tlv(CHANNEL_TLV, struct.pack(">BH", 0, channel))
+    data += tlv(CHANNELMASK_TLV, bytes.fromhex(DEFAULT_CHANNELMASK))
+    data += tlv(EXTPANID_TLV, hex_field("extpanid", extpanid, 8))
+    data += tlv(MESHLOCALPREFIX_TLV, prefix_field(meshlocalprefix))
+    data += tlv(NETWORKKEY_TLV, hex_field("networkkey", networkkey, 16))
+    data += tlv(NETWORKNAME_TLV, name)
+    data += tlv(PANID_TLV, struct.pack(">H", panid))
+    if pskc is not None:
+        data += tlv(PSKC_TLV, hex_field("pskc", pskc, 16))
+    data += tlv(SECURITYPOLICY_TLV, bytes.fromhex(DEFAULT_SECURITYPOLICY))
+    return data.hex()
+
+
+# Decode a dataset hex string, e.g. from "dataset active -x", into the
+# fields build_dataset takes, formatted the way the CLI prints them.
+# Unknown TLVs are skipped. Raises ValueError if the TLVs are malformed.
+def parse_dataset(tlvs):
+    data = bytes.fromhex(tlvs.strip())
+    fields = {}
+    i = 0
+    while i < len(data):
+        if i + 2 > len(data) or i + 2 + data[i + 1] > len(data):
+            raise ValueError("truncated dataset TLV at byte %d" % i)
+        kind, value = data[i], data[i + 2:i + 2 + data[i + 1]]
+        i += 2 + len(value)
+        if kind == CHANNEL_TLV and len(value) == 3:
+            fields["channel"] = str(struct.unpack(">H", value[1:])[0])
+        elif kind == PANID_TLV and len(value) == 2:
+            fields["panid"] = "0x%04x" % struct.unpack(">H", value)[0]
+        elif kind == EXTPANID_TLV:
+            fields["extpanid"] = value.hex()
+        elif kind == NETWORKNAME_TLV:
+            fields["networkname"] = value.decode(errors="replace")
+        elif kind == PSKC_TLV:
+            fields["pskc"] = value.hex()
+        elif kind == NETWORKKEY_TLV:
+            fields["networkkey"] = value.hex()
+        elif kind == MESHLOCALPREFIX_TLV and len(value) == 8:
+            groups = struct.unpack(">4H", value)
+            fields["meshlocalprefix"] = ":".join("%x" % g for g in groups)
+        elif kind == ACTIVETIMESTAMP_TLV and len(value) == 8:
+            fields["timestamp"] = struct.unpack(">Q", value)[0] >> 16
+    return fields
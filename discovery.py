@@ -0,0 +1,218 @@
+import fnmatch
+import glob
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import linkspeed
+import serial.tools.list_ports as ports_list
+from metrics import metrics
+from ot_serial import read_response
+
+NRF_PLATFORM = "Zephyr"
+SLABS_PLATFORM = "EFR32"
+TTM_VERSION = "NRF52840"
+
+# Device name patterns probed for thread devices
+PORT_PATTERNS = ["/dev/ttyACM*", "/dev/ttyUSB*"]
+# Where probe results are kept between runs
+CACHE_FILE = os.environ.get(
+    "OT_DEVICE_CACHE",
+    os.path.join(os.path.expanduser("~"), ".cache", "ot_controller", "devices.json"),
+)
+# Time allowed for a device to answer a probe
+PROBE_TIMEOUT = 0.5
+# Maximum number of ports probed at the same time
+WORKERS = 128
+# Seconds a port that didn't answer like a thread device is skipped for; a
+# board that was still booting gets probed again after this
+NEGATIVE_TTL = 600
+
+
+# Identity of the board behind a port, stable across renumbering of ttys
+def port_key(port):
+    if port.serial_number:
+        return port.serial_number
+    if port.vid is not None:
+        return "%04x:%04x@%s" % (port.vid, port.pid, port.device)
+    return port.device
+
+
+# Ports that may have a thread device attached, as (device path, key) pairs
+def candidate_ports(patterns=None):
+    patterns = patterns or PORT_PATTERNS
+    candidates = {}
+    for port in ports_list.comports():
+        if any(fnmatch.fnmatch(port.device, p) for p in patterns):
+            candidates[port.device] = port_key(port)
+    # ttys without sysfs information still get probed, keyed by path
+    for pattern in patterns:
+        for device in glob.glob(pattern):
+            candidates.setdefault(device, device)
+    return sorted(candidates.items())
+
+
+def load_cache(path=None):
+    try:
+        with open(path or CACHE_FILE) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_cache(cache, path=None):
+    path = path or CACHE_FILE
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path + ".tmp", "w") as f:
+            json.dump(cache, f, indent=1, sort_keys=True)
+        os.replace(path + ".tmp", path)
+    except OSError:
+        pass  # cache is only an optimisation
+
+
+# Send a probe command and return the response
+def ask(ser, command):
+    ser.write(bytes("\r\n" + command + "\r\n", "utf-8"))
+    ser.flush()
+    return read_response(ser, command, PROBE_TIMEOUT)
+
+
+# Find out which platform, firmware version and role a port has
+def probe(ser):
+    ser.reset_input_buffer()
+    platform = ""
+    if SLABS_PLATFORM in ask(ser, "platform"):
+        platform = SLABS_PLATFORM
+        version = ask(ser, "version")
+        raw_version = version
+    else:
+        if NRF_PLATFORM in ask(ser, "ot platform"):
+            platform = NRF_PLATFORM
+            version = ask(ser, "ot version")
+        else:
+            version = ""
+        raw_version = ask(ser, "version")
+    return {
+        "platform": platform,
+        "version": version.replace("\r", "").strip(),
+        "ttm": TTM_VERSION in raw_version,
+    }
+
+
+# Check that a port still answers like its cached entry
+def verify(ser, entry):
+    ser.reset_input_buffer()
+    if entry["platform"] == SLABS_PLATFORM:
+        return SLABS_PLATFORM in ask(ser, "platform")
+    if entry["platform"] == NRF_PLATFORM:
+        return NRF_PLATFORM in ask(ser, "ot platform")
+    return TTM_VERSION in ask(ser, "version")
+
+
+# Key of a single port, without enumerating every port on the system
+def device_key(device):
+    try:
+        from serial.tools.list_ports_linux import SysFS
+        return port_key(SysFS(device))
+    except Exception:
+        return device
+
+
+# Settings a port that doesn't answer is tried with: every rate and parity
+# if it had a thread device before or OT_LINK_SWEEP is set, otherwise only
+# those boards ship with, so ports of other hardware aren't swept
+def link_settings(known):
+    return linkspeed.LINK_SETTINGS if known or linkspeed.SWEEP else linkspeed.BOARD_SETTINGS
+
+
+# Whether the cache has a thread device or TTM behind a port
+def known_device(cache, device):
+    entry = cache.get(device_key(device))
+    return bool(entry and (entry.get("platform") or entry.get("ttm")))
+
+
+# Probe one port, or only re-verify it if it is in the cache. Ports cached as
+# not being thread devices are skipped for NEGATIVE_TTL unless `refresh` is
+# set. A port that doesn't answer is tried with the settings boards ship
+# with, or at every rate and parity if it was a thread device before (or
+# OT_LINK_SWEEP is set), and a newly found device is moved to the fastest
+# rate it supports; the settings are kept in the entry and used by the pool
+# from then on. Returns the port's entry, or None if it couldn't be opened.
+def check_port(pool, device, key, cache, refresh=False):
+    entry = cache.get(key)
+    if (entry and not refresh and not entry["platform"] and not entry["ttm"]
+            and time.time() - entry.get("checked", 0) < NEGATIVE_TTL):
+        return dict(entry, port=device)
+    known = entry if entry and (entry["platform"] or entry["ttm"]) else None
+    try:
+        if known and "baudrate" in known:
+            pool.configure(device, {"baudrate": known["baudrate"], "parity": known["parity"]})
+        ser = pool.get(device)
+        if not (known and not refresh and verify(ser, known)):
+            entry = probe(ser)
+            if not entry["platform"] and not entry["ttm"] and linkspeed.detect(ser, settings=link_settings(known)):
+                entry = probe(ser)
+            if entry["platform"]:
+                linkspeed.negotiate(ser, entry["platform"])
+    except Exception:
+        pool.close(device)
+        return None
+    entry = dict(entry, port=device)
+    if not entry["platform"] and not entry["ttm"]:
+        pool.close(device)
+        entry.setdefault("checked", time.time())
+        entry.pop("baudrate", None)
+        entry.pop("parity", None)
+    else:
+        entry.update(linkspeed.current_settings(ser))
+        pool.configure(device, linkspeed.current_settings(ser))
+    return entry
+
+
+# Check a single port that just appeared and update the cache. Returns its
+# entry if it is a thread device or TTM, otherwise None.
+def discover_port(pool, device, cache_path=None):
+    cache = load_cache(cache_path)
+    key = device_key(device)
+    cached = cache.get(key)
+    # a port known only by its path may now have a different board behind
+    # it, and a board that didn't answer before may have been booting
+    refresh = key == device or not (cached and (cached["platform"] or cached["ttm"]))
+    entry = check_port(pool, device, key, cache, refresh)
+    if entry is None:
+        return None
+    cache[key] = entry
+    save_cache(cache, cache_path)
+    if entry["platform"] or entry["ttm"]:
+        return entry
+    return None
+
+
+# Probe all candidate ports at the same time. Ports already in the cache are
+# only re-verified; ports cached as not being thread devices are skipped
+# unless `refresh` is set. Connections are taken from `pool` and ports that
+# aren't thread devices are closed again. Returns the entries of the ports
+# that are thread devices or TTMs, in port order.
+def discover(pool, patterns=None, refresh=False, cache_path=None):
+    start = time.monotonic()
+    cache = load_cache(cache_path)
+    ports = candidate_ports(patterns)
+
+    def check(port):
+        return check_port(pool, port[0], port[1], cache, refresh)
+
+    found = []
+    if ports:
+        with ThreadPoolExecutor(max_workers=min(WORKERS, len(ports))) as executor:
+            entries = list(executor.map(check, ports))
+        for (device, key), entry in zip(ports, entries):
+            if entry is None:
+                continue
+            cache[key] = entry
+            if entry["platform"] or entry["ttm"]:
+                found.append(entry)
+    save_cache(cache, cache_path)
+    metrics.operation("discovery", time.monotonic() - start)
+    return found
@@ -0,0 +1,216 @@
+import argparse
+import asyncio
+import itertools
+import json
+import os
+
+# Seconds a host has to answer a command before its missing devices are
+# reported as timed out
+HOST_DEADLINE = 5.0
+# Most devices a host runs a command on at the same time
+HOST_LIMIT = 64
+# Group for devices that didn't answer before the deadline
+DEADLINE_EXCEEDED = "deadline exceeded"
+
+
+# Connection to the controller daemon of one host, started with --tcp. The
+# connection is shared by all requests, whose messages are told apart by id.
+class Agent:
+    def __init__(self, address, token=None, limit=HOST_LIMIT, deadline=HOST_DEADLINE):
+        host, _, port = address.rpartition(":")
+        self.host = host or "127.0.0.1"
+        self.port = int(port)
+        self.name = address
+        self.token = token
+        self.limit = limit
+        self.deadline = deadline
+        self.ids = itertools.count(1)
+        self.queues = {}  # request id -> queue of its messages
+        self.reader = None
+        self.writer = None
+        self.listener = None
+        self.ports = []  # devices of the host
+
+    async def connect(self):
+        self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
+        self.listener = asyncio.create_task(self.listen())
+        async for message in self.request({"op": "devices"}):
+            if "error" in message:
+                await self.close()
+                raise ConnectionError(message["error"])
+            self.ports = [entry["port"] for entry in message["devices"] if entry["platform"]]
+
+    async def close(self):
+        if self.listener:
+            self.listener.cancel()
+        if self.writer:
+            self.writer.close()
+
+    # Hand each message to the request it belongs to
+    async def listen(self):
+        try:
+            while True:
+                line = await self.reader.readline()
+                if not line:
+                    break
+                message = json.loads(line)
+                queue = self.queues.get(message.get("id"))
+                if queue is not None:
+                    queue.put_nowait(message)
+        finally:
+            # wake up every request still waiting on the host
+            for queue in self.queues.values():
+                queue.put_nowait({"error": "connection lost", "done": True})
+
+    # Send a request and yield its messages until it is done
+    async def request(self, request):
+        rid = next(self.ids)
+        queue = self.queues[rid] = asyncio.Queue()
+        request = dict(request, id=rid)
+        if self.token:
+            request["token"] = self.token
+        try:
+            self.writer.write(json.dumps(request).encode() + b"\n")
+            await self.writer.drain()
+            while True:
+                message = await queue.get()
+                yield message
+                if message.get("done"):
+                    break
+        finally:
+            del self.queues[rid]
+
+    # Run a command on the host's devices and yield (port, response, seconds)
+    # as they answer. Devices that haven't answered when the deadline passes
+    # are yielded with DEADLINE_EXCEEDED, an unreachable host's devices with
+    # its error.
+    async def command(self, command, timeout=None):
+        answered = set()
+        error = DEADLINE_EXCEEDED
+        messages = self.request({"command": command, "timeout": timeout, "limit": self.limit})
+        try:
+            async with asyncio.timeout(self.deadline):
+                async for message in messages:
+                    if "port" in message:
+                        answered.add(message["port"])
+                        yield message["port"], message["response"], message["seconds"]
+                    elif "error" in message:
+                        error = message["error"]
+        except TimeoutError:
+            pass
+        except OSError as e:
+            error = "connection lost: %s" % e
+        finally:
+            await messages.aclose()
+        for port in self.ports:
+            if port not in answered:
+                yield port, error, None
+
+
+# Coordinator of several hosts' agents: commands go to every host at once, so
+# a command takes as long as the slowest host rather than the sum of them.
+# Ports are qualified with the host they are on, "host:port|/dev/ttyACM0".
+class Federation:
+    def __init__(self, agents):
+        self.agents = agents
+
+    async def connect(self):
+        results = await asyncio.gather(*(agent.connect() for agent in self.agents),
+                                       return_exceptions=True)
+        for agent, result in zip(self.agents, results):
+            if isinstance(result, Exception):
+                print("%s unreachable: %s" % (agent.name, result))
+        self.agents = [agent for agent, result in zip(self.agents, results)
+                       if not isinstance(result, Exception)]
+
+    async def close(self):
+        for agent in self.agents:
+            await agent.close()
+
+    @property
+    def ports(self):
+        return [qualified(agent, port) for agent in self.agents for port in agent.ports]
+
+    # Yield (qualified port, response, seconds) from every host as they arrive
+    async def stream(self, command, timeout=None):
+        queue = asyncio.Queue()
+
+        async def collect(agent):
+            try:
+                async for port, response, seconds in agent.command(command, timeout):
+                    queue.put_nowait((qualified(agent, port), response, seconds))
+            finally:
+                queue.put_nowait(None)
+
+        tasks = [asyncio.create_task(collect(agent)) for agent in self.agents]
+        try:
+            remaining = len(tasks)
+            while remaining:
+                item = await queue.get()
+                if item is None:
+                    remaining -= 1
+                else:
+                    yield item
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    # Run a command everywhere and group the qualified ports by response
+    async def grouped(self, command, timeout=None):
+        response_dict = {}
+        async for port, response, seconds in self.stream(command, timeout):
+            response_dict.setdefault(response, []).append(port)
+        for ports in response_dict.values():
+            ports.sort()
+        return response_dict
+
+
+def qualified(agent, port):
+    return agent.name + "|" + port
+
+
+# Console driving every host, printing the grouped view of controller.py
+async def interface(federation):
+    print("%d devices on %d hosts" % (len(federation.ports), len(federation.agents)))
+    while True:
+        try:
+            command = await asyncio.to_thread(input, "> ")
+        except EOFError:
+            break
+        if command in ("quit", "q"):
+            break
+        if command == "devices":
+            for port in federation.ports:
+                print(port)
+            continue
+        if not command.strip():
+            continue
+        response = await federation.grouped(command)
+        for res in response:
+            print(res.replace("\n", " ") + " | " + " ".join(response[res]))
+
+
+async def run(addresses, token, limit, deadline):
+    federation = Federation([Agent(address, token, limit, deadline) for address in addresses])
+    await federation.connect()
+    try:
+        await interface(federation)
+    finally:
+        await federation.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Drive the devices of several hosts from one console")
+    parser.add_argument("agents", nargs="+", metavar="HOST:PORT",
+                        help="agents, each a daemon.py started with --tcp")
+    parser.add_argument("--token", default=os.environ.get("OT_AGENT_TOKEN"))
+    parser.add_argument("--limit", type=int, default=HOST_LIMIT,
+                        help="most devices per host running a command at once")
+    parser.add_argument("--deadline", type=float, default=HOST_DEADLINE,
+                        help="seconds a host has to answer")
+    args = parser.parse_args()
+    asyncio.run(run(args.agents, args.token, args.limit, args.deadline))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,156 @@
+import threading
+import time
+
+import serial
+from metrics import command_verb, metrics, percentile
+from ot_serial import command_timeout, response_complete
+
+# Failed or slow commands in a row before a device is quarantined
+FAILURES_TO_QUARANTINE = 3
+# Fraction of the time a command is allowed (ot_serial.command_timeout)
+# after which its answer counts against the device
+SLOW_FRACTION = 0.8
+# Times a command that got no answer is sent again, and the first pause
+# between attempts in seconds, doubled on every retry
+RETRIES = 2
+BACKOFF = 0.05
+# Seconds a device stays quarantined before a command is let through to
+# probe it again; doubled every time the probe fails
+QUARANTINE_TIME = 10.0
+MAX_QUARANTINE_TIME = 300.0
+# A device's timeout for a command is TIMEOUT_FACTOR times its p99 latency
+# for that verb, once there are TIMEOUT_SAMPLES samples, but no less than
+# MIN_TIMEOUT and no more than the command's default timeout
+TIMEOUT_FACTOR = 4.0
+TIMEOUT_SAMPLES = 20
+MIN_TIMEOUT = 0.25
+
+
+class DeviceHealth:
+    def __init__(self):
+        self.failures = 0  # in a row
+        self.reason = ""
+        self.quarantined_at = None
+        self.quarantine_time = QUARANTINE_TIME
+
+
+# Circuit breaker for every device. Devices that keep failing or answering
+# slowly are quarantined so fleet-wide operations don't wait on them; once
+# the quarantine time has passed the next command probes the device, and
+# the device is released if it answers.
+class Health:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.devices = {}  # port -> DeviceHealth
+
+    def reset(self):
+        with self.lock:
+            self.devices = {}
+
+    def get(self, port):
+        return self.devices.setdefault(port, DeviceHealth())
+
+    def quarantined(self, port):
+        with self.lock:
+            return self.get(port).quarantined_at is not None
+
+    # False while a device is quarantined and not yet due to be probed
+    def available(self, port):
+        with self.lock:
+            device = self.get(port)
+            if device.quarantined_at is None:
+                return True
+            return time.monotonic() >= device.quarantined_at + device.quarantine_time
+
+    # Record that a device answered in `seconds`, out of the `allowed`
+    # seconds its commands had
+    def success(self, port, seconds, allowed):
+        if seconds > SLOW_FRACTION * allowed:
+            self.failure(port, "slow (%.1f s)" % seconds)
+            return
+        with self.lock:
+            device = self.get(port)
+            device.failures = 0
+            device.quarantined_at = None
+            device.quarantine_time = QUARANTINE_TIME
+
+    def failure(self, port, reason):
+        with self.lock:
+            device = self.get(port)
+            device.failures += 1
+            device.reason = reason
+            if device.quarantined_at is not None:
+                # the probe failed, wait longer before the next one
+                device.quarantine_time = min(MAX_QUARANTINE_TIME, device.quarantine_time * 2)
+                device.quarantined_at = time.monotonic()
+            elif device.failures >= FAILURES_TO_QUARANTINE:
+                device.quarantined_at = time.monotonic()
+
+    # Time to wait for a device to answer a command
+    def timeout(self, port, command):
+        default = command_timeout(command)
+        with metrics.lock:
+            hist = metrics.latency.get((port, command_verb(command)))
+            samples = list(hist.samples) if hist else []
+        if len(samples) < TIMEOUT_SAMPLES:
+            return default
+        return min(default, max(MIN_TIMEOUT, TIMEOUT_FACTOR * percentile(samples, 99)))
+
+    # Run send(timeout), which writes a command and returns the raw
+    # response, retrying with backoff while the device doesn't finish
+    # answering. Returns the last response, "" if the device is quarantined.
+    def run(self, port, command, send, timeout=None, retries=RETRIES):
+        response = ""
+        for attempt in range(retries + 1):
+            if not self.available(port):
+                break
+            start = time.monotonic()
+            try:
+                response = send(timeout or self.timeout(port, command))
+            except (serial.SerialException, OSError) as e:
+                self.failure(port, "%s: %s" % (type(e).__name__, e))
+            else:
+                if response_complete(response):
+                    self.success(port, time.monotonic() - start,
+                                 timeout or command_timeout(command))
+                    break
+                self.failure(port, "no answer to '%s'" % command.strip())
+            if attempt < retries:
+                time.sleep(BACKOFF * 2 ** attempt)
+        return response
+
+    # Record the outcome of a pipelined batch, a list of (command, response,
+    # ok) tuples that took `seconds`; every command left unanswered counts
+    # as a failure
+    def batch(self, port, results, seconds):
+        commands = [(command, response) for command, response, ok in results if command.strip()]
+        unanswered = [command for command, response in commands if not response_complete(response)]
+        if commands and not unanswered:
+            self.success(port, seconds, sum(command_timeout(command) for command, _ in commands))
+        for command in unanswered:
+            self.failure(port, "no answer to '%s'" % command.strip())
+
+    # Quarantined devices and why, {port: reason}
+    def report(self):
+        with self.lock:
+            return {port: device.reason for port, device in sorted(self.devices.items())
+                    if device.quarantined_at is not None}
+
+    def format_report(self):
+        quarantined = self.report()
+        if not quarantined:
+            return "no devices quarantined"
+        return "\n".join("%s | quarantined | %s" % item for item in quarantined.items())
+
+
+# Shared by every device in the process
+health = Health()
+
+
+# Console "health" command: lists quarantined devices, "health reset"
+# releases them
+def health_command(cmd):
+    if cmd.split()[1:] == ["reset"]:
+        health.reset()
+        return "all devices released"
+    return health.format_report()
@@ -0,0 +1,183 @@
+import ctypes
+import ctypes.util
+import fnmatch
+import glob
+import os
+import select
+import struct
+import threading
+import time
+
+import discovery
+
+# inotify event masks, from <sys/inotify.h>
+IN_ATTRIB = 0x00000004
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+EVENT_HEADER = struct.Struct("iIII")  # wd, mask, cookie, name length
+
+# Seconds between scans when inotify isn't available
+POLL_INTERVAL = 1.0
+# A new tty may not be usable until udev has set its permissions
+OPEN_RETRIES = 5
+OPEN_RETRY_DELAY = 0.2
+
+
+# inotify watch on a set of directories through libc, or None where the
+# system has no inotify
+class Inotify:
+    def __init__(self, directories):
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or None, use_errno=True)
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.directories = {}  # watch descriptor -> directory
+        mask = IN_CREATE | IN_DELETE | IN_ATTRIB | IN_MOVED_FROM | IN_MOVED_TO
+        for directory in directories:
+            wd = libc.inotify_add_watch(self.fd, os.fsencode(directory), mask)
+            if wd < 0:
+                os.close(self.fd)
+                raise OSError(ctypes.get_errno(), "inotify_add_watch failed on " + directory)
+            self.directories[wd] = directory
+
+    @classmethod
+    def create(cls, directories):
+        try:
+            return cls(directories)
+        except (OSError, AttributeError):
+            return None
+
+    # Wait up to `timeout` seconds and return the events as (mask, path)
+    def read(self, timeout):
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return []
+        try:
+            data = os.read(self.fd, 65536)
+        except BlockingIOError:
+            return []
+        events = []
+        i = 0
+        while i < len(data):
+            wd, mask, cookie, length = EVENT_HEADER.unpack_from(data, i)
+            i += EVENT_HEADER.size
+            name = data[i:i + length].rstrip(b"\0").decode(errors="replace")
+            i += length
+            if wd in self.directories and name:
+                events.append((mask, os.path.join(self.directories[wd], name)))
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+
+# Keeps the set of thread devices up to date as boards are plugged in and
+# out. The ports are probed once at start; after that only a port that
+# appears is probed and a port that disappears is dropped, with
+# on_added(entry) and on_removed(entry) called for thread devices and TTMs.
+class HotplugMonitor:
+    def __init__(self, pool, patterns=None, on_added=None, on_removed=None,
+                 poll_interval=POLL_INTERVAL, cache_path=None):
+        self.pool = pool
+        self.patterns = patterns or discovery.PORT_PATTERNS
+        self.on_added = on_added
+        self.on_removed = on_removed
+        self.poll_interval = poll_interval
+        self.cache_path = cache_path
+        self.lock = threading.Lock()
+        self.entries = {}  # port -> discovery entry of thread devices and TTMs
+        self.known = set()  # every matching port that has been checked
+        self.running = False
+        self.thread = None
+        self.inotify = None
+
+    # Discover the ports present now and start following changes. Returns the
+    # entries found, in port order.
+    def start(self):
+        found = discovery.discover(self.pool, self.patterns, cache_path=self.cache_path)
+        with self.lock:
+            self.entries = {entry["port"]: entry for entry in found}
+            self.known = set(self.matching_ports())
+        directories = sorted({os.path.dirname(pattern) for pattern in self.patterns})
+        self.inotify = Inotify.create(directories)
+        self.running = True
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+        return found
+
+    def stop(self):
+        self.running = False
+        if self.thread:
+            self.thread.join()
+            self.thread = None
+        if self.inotify:
+            self.inotify.close()
+            self.inotify = None
+
+    @property
+    def mode(self):
+        return "inotify" if self.inotify else "polling"
+
+    def devices(self):
+        with self.lock:
+            return [self.entries[port] for port in sorted(self.entries)]
+
+    def matches(self, path):
+        return any(fnmatch.fnmatch(path, pattern) for pattern in self.patterns)
+
+    def matching_ports(self):
+        return {path for pattern in self.patterns for path in glob.glob(pattern)}
+
+    def run(self):
+        while self.running:
+            if self.inotify:
+                for mask, path in self.inotify.read(0.5):
+                    if not self.matches(path):
+                        continue
+                    if mask & (IN_DELETE | IN_MOVED_FROM):
+                        self.removed(path)
+                    elif mask & (IN_CREATE | IN_MOVED_TO | IN_ATTRIB):
+                        self.added(path)
+            else:
+                ports = self.matching_ports()
+                with self.lock:
+                    new, gone = ports - self.known, self.known - ports
+                for path in sorted(gone):
+                    self.removed(path)
+                for path in sorted(new):
+                    self.added(path)
+                time.sleep(self.poll_interval)
+
+    # Probe a port that appeared, retrying while udev sets it up
+    def added(self, path):
+        with self.lock:
+            if path in self.known:
+                return
+            self.known.add(path)
+        for attempt in range(OPEN_RETRIES):
+            if not os.path.exists(path):
+                break
+            if os.access(path, os.R_OK | os.W_OK):
+                break
+            time.sleep(OPEN_RETRY_DELAY)
+        entry = discovery.discover_port(self.pool, path, self.cache_path)
+        if entry is None:
+            return
+        with self.lock:
+            if path not in self.known:
+                return  # unplugged while being probed
+            self.entries[path] = entry
+        if self.on_added:
+            self.on_added(entry)
+
+    def removed(self, path):
+        with self.lock:
+            self.known.discard(path)
+            entry = self.entries.pop(path, None)
+        # users of the port stop reading it before the connection is closed
+        if entry is not None and self.on_removed:
+            self.on_removed(entry)
+        self.pool.close(path)
@@ -0,0 +1,145 @@
+import os
+import secrets
+import time
+
+import serial
+from ot_serial import read_response, reconfigure
+
+# Settings boards are known to ship with, tried on any port that doesn't
+# answer with the ones it was opened with
+BOARD_SETTINGS = [(38400, serial.PARITY_EVEN)]
+# Baud rate and parity pairs tried on a port known to be a thread device,
+# or on any port with OT_LINK_SWEEP=1, the ones the boards use first
+SWEEP = os.environ.get("OT_LINK_SWEEP") == "1"
+LINK_SETTINGS = [
+    (115200, serial.PARITY_NONE),
+    (38400, serial.PARITY_EVEN),
+    (460800, serial.PARITY_NONE),
+    (921600, serial.PARITY_NONE),
+    (1000000, serial.PARITY_NONE),
+    (230400, serial.PARITY_NONE),
+    (57600, serial.PARITY_NONE),
+    (38400, serial.PARITY_NONE),
+    (19200, serial.PARITY_NONE),
+    (9600, serial.PARITY_NONE),
+]
+# Rates a link is raised to, fastest first, where the firmware can switch
+FAST_RATES = [1000000, 921600, 460800, 230400]
+# Command that makes the firmware switch its UART, "{rate}" being the new
+# baud rate, e.g. "baudrate {rate}". Stock OpenThread and Zephyr CLIs have
+# none, so without it links are only detected, never raised.
+BAUD_COMMAND = os.environ.get("OT_BAUD_COMMAND")
+# Round trips a new rate has to pass before it is kept
+STABLE_CHECKS = 3
+# Time allowed for a round trip, and for the UARTs to settle after a switch
+ROUND_TRIP_TIMEOUT = 0.5
+SWITCH_DELAY = 0.05
+
+
+def current_settings(ser):
+    return {"baudrate": ser.baudrate, "parity": ser.parity}
+
+
+def apply(ser, settings):
+    reconfigure(ser, {"baudrate": settings["baudrate"], "parity": settings["parity"]})
+
+
+# Send a line of random text and check it comes back intact in the echo.
+# An error line alone doesn't count: a garbled line gets one too, and so
+# can stale output from before a switch.
+def round_trip(ser):
+    token = "x" + secrets.token_hex(24)
+    ser.reset_input_buffer()
+    ser.write(bytes("\r\n" + token + "\r\n", "utf-8"))
+    ser.flush()
+    return token in read_response(ser, token, ROUND_TRIP_TIMEOUT)
+
+
+# Find the settings a port answers with, trying `preferred` (e.g. cached)
+# first, then `settings`, and leaving the port set to them. Returns the
+# settings, or None if nothing works, in which case the port is left as it
+# was.
+def detect(ser, preferred=None, settings=LINK_SETTINGS):
+    original = current_settings(ser)
+    candidates = [original]
+    if preferred:
+        candidates.insert(0, preferred)
+    candidates += [{"baudrate": rate, "parity": parity} for rate, parity in settings]
+    tried = []
+    for candidate in candidates:
+        if candidate in tried:
+            continue
+        tried.append(candidate)
+        try:
+            apply(ser, candidate)
+        except (serial.SerialException, OSError):
+            continue  # the driver doesn't support these settings
+        if round_trip(ser):
+            return candidate
+    try:
+        apply(ser, original)
+    except (serial.SerialException, OSError):
+        pass  # left at the last settings the driver took
+    return None
+
+
+# Ask the firmware to switch its UART with `line`, True if it agreed
+def request_rate(ser, line):
+    ser.reset_input_buffer()
+    ser.write(bytes(line + "\r\n", "utf-8"))
+    ser.flush()
+    return "Done" in read_response(ser, line, ROUND_TRIP_TIMEOUT)
+
+
+# Bring a link that failed at `failed` back to `stable`, the last settings
+# that passed: find the device, tell the firmware to switch back and check
+# it did, a few times if need be. Returns the settings the device answers
+# with in the end, or None if it can't be found.
+def fall_back(ser, template, failed, stable):
+    line = template.format(rate=stable["baudrate"])
+    for _ in range(STABLE_CHECKS):
+        found = detect(ser, failed)
+        if found == stable:
+            return stable
+        if found and request_rate(ser, line):
+            apply(ser, stable)
+            time.sleep(SWITCH_DELAY)
+            if round_trip(ser):
+                return stable
+    return detect(ser, stable)
+
+
+# Move a link to the fastest rate that passes STABLE_CHECKS round trips,
+# telling the firmware with `command` first. After a rate fails, the link
+# is moved back to the last one that passed before a slower one is tried.
+# Returns the settings the link ends up with.
+def negotiate(ser, platform="", command=BAUD_COMMAND, rates=FAST_RATES):
+    stable = current_settings(ser)
+    if not command:
+        return stable
+    template = ("ot " if platform == "Zephyr" else "") + command
+    for rate in rates:
+        if rate <= stable["baudrate"]:
+            break
+        if not request_rate(ser, template.format(rate=rate)):
+            return stable  # firmware can't switch
+        faster = dict(stable, baudrate=rate)
+        try:
+            apply(ser, faster)
+            time.sleep(SWITCH_DELAY)
+            passed = all(round_trip(ser) for _ in range(STABLE_CHECKS))
+        except (serial.SerialException, OSError):
+            passed = False  # the host's driver can't run at this rate
+        if passed:
+            return faster
+        settings = fall_back(ser, template, faster, stable)
+        if settings is None:
+            # lost the device; it most likely stayed at the rate that failed
+            try:
+                apply(ser, faster)
+            except (serial.SerialException, OSError):
+                pass
+            return current_settings(ser)
+        if settings != stable:
+            return settings  # couldn't get back, stay where the device answers
+    return stable
@@ -0,0 +1,210 @@
+import json
+import os
+import threading
+from collections import defaultdict, deque
+
+# Upper bounds of the latency histogram buckets, in seconds
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# Latency samples kept per device and verb for percentiles
+SAMPLES = 1024
+
+
+# Verb of a command for grouping, e.g. "ot dataset commit active" -> "dataset"
+def command_verb(command):
+    if isinstance(command, bytes):
+        command = command.decode(errors="replace")
+    words = command.split()
+    if words and words[0] == "ot":
+        words = words[1:]
+    return words[0] if words else ""
+
+
+def percentile(samples, p):
+    samples = sorted(samples)
+    if not samples:
+        return None
+    return samples[min(len(samples) - 1, int(round(p / 100.0 * (len(samples) - 1))))]
+
+
+class Histogram:
+    def __init__(self):
+        self.counts = [0] * len(BUCKETS)
+        self.count = 0
+        self.sum = 0.0
+        self.samples = deque(maxlen=SAMPLES)
+
+    def observe(self, seconds):
+        for i, bound in enumerate(BUCKETS):
+            if seconds <= bound:
+                self.counts[i] += 1
+        self.count += 1
+        self.sum += seconds
+        self.samples.append(seconds)
+
+
+# Counters and latency histograms broken down by device and command verb
+class Metrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.latency = defaultdict(Histogram)  # (device, verb) -> Histogram
+            self.operations = defaultdict(Histogram)  # operation -> Histogram
+            self.bytes_in = defaultdict(int)  # device -> bytes
+            self.bytes_out = defaultdict(int)
+            self.timeouts = defaultdict(int)  # (device, verb) -> count
+            self.errors = defaultdict(int)  # (device, verb) -> "Error N:" replies
+            self.reopens = defaultdict(int)  # device -> count
+
+    # Record one command exchange
+    def command(self, device, command, seconds, sent=0, received=0, timeout=False, error=False):
+        key = (device, command_verb(command))
+        with self.lock:
+            self.latency[key].observe(seconds)
+            self.bytes_out[device] += sent
+            self.bytes_in[device] += received
+            if timeout:
+                self.timeouts[key] += 1
+            if error:
+                self.errors[key] += 1
+
+    # Record bytes that did not belong to a command
+    def received(self, device, count):
+        with self.lock:
+            self.bytes_in[device] += count
+
+    def reopened(self, device):
+        with self.lock:
+            self.reopens[device] += 1
+
+    # Record the duration of a fleet-wide operation such as discovery
+    def operation(self, name, seconds):
+        with self.lock:
+            self.operations[name].observe(seconds)
+
+    def to_dict(self):
+        with self.lock:
+            commands = []
+            for (device, verb), hist in sorted(self.latency.items()):
+                commands.append({
+                    "device": device,
+                    "verb": verb,
+                    "count": hist.count,
+                    "sum": round(hist.sum, 6),
+                    "p50": percentile(hist.samples, 50),
+                    "p95": percentile(hist.samples, 95),
+                    "p99": percentile(hist.samples, 99),
+                    "timeouts": self.timeouts.get((device, verb), 0),
+                    "errors": self.errors.get((device, verb), 0),
+                })
+            operations = {
+                name: {"count": hist.count, "sum": round(hist.sum, 6),
+                       "p50": percentile(hist.samples, 50), "p99": percentile(hist.samples, 99)}
+                for name, hist in sorted(self.operations.items())
+            }
+            devices = sorted(set(self.bytes_in) | set(self.bytes_out) | set(self.reopens))
+            return {
+                "commands": commands,
+                "operations": operations,
+                "devices": {
+                    device: {
+                        "bytes_in": self.bytes_in.get(device, 0),
+                        "bytes_out": self.bytes_out.get(device, 0),
+                        "reopens": self.reopens.get(device, 0),
+                    }
+                    for device in devices
+                },
+            }
+
+    def to_json(self):
+        return json.dumps(self.to_dict(), indent=1)
+
+    # Prometheus text exposition format
+    def to_prometheus(self):
+        lines = []
+
+        def histogram(name, help_text, items):
+            lines.append("# HELP %s %s" % (name, help_text))
+            lines.append("# TYPE %s histogram" % name)
+            for labels, hist in items:
+                for bound, count in zip(BUCKETS, hist.counts):
+                    lines.append('%s_bucket{%sle="%g"} %d' % (name, labels, bound, count))
+                lines.append('%s_bucket{%sle="+Inf"} %d' % (name, labels, hist.count))
+                lines.append("%s_sum{%s} %f" % (name, labels.rstrip(","), hist.sum))
+                lines.append("%s_count{%s} %d" % (name, labels.rstrip(","), hist.count))
+
+        def counter(name, help_text, items):
+            lines.append("# HELP %s %s" % (name, help_text))
+            lines.append("# TYPE %s counter" % name)
+            for labels, value in items:
+                lines.append("%s{%s} %d" % (name, labels, value))
+
+        def device_verb(key):
+            return 'device="%s",verb="%s",' % key
+
+        with self.lock:
+            histogram("ot_command_latency_seconds", "Time from command to complete response.",
+                      [(device_verb(key), hist) for key, hist in sorted(self.latency.items())])
+            histogram("ot_operation_seconds", "Duration of fleet-wide operations.",
+                      [('operation="%s",' % name, hist) for name, hist in sorted(self.operations.items())])
+            counter("ot_command_timeouts_total", "Commands that got no complete response.",
+                    [(device_verb(key).rstrip(","), n) for key, n in sorted(self.timeouts.items())])
+            counter("ot_command_errors_total", "Commands answered with an Error line.",
+                    [(device_verb(key).rstrip(","), n) for key, n in sorted(self.errors.items())])
+            counter("ot_bytes_in_total", "Bytes read from the device.",
+                    [('device="%s"' % d, n) for d, n in sorted(self.bytes_in.items())])
+            counter("ot_bytes_out_total", "Bytes written to the device.",
+                    [('device="%s"' % d, n) for d, n in sorted(self.bytes_out.items())])
+            counter("ot_reopens_total", "Times the serial port was reopened.",
+                    [('device="%s"' % d, n) for d, n in sorted(self.reopens.items())])
+        return "\n".join(lines) + "\n"
+
+    # Latency percentiles per device, for the console
+    def format_stats(self):
+        with self.lock:
+            per_device = defaultdict(list)
+            timeouts = defaultdict(int)
+            errors = defaultdict(int)
+            for (device, verb), hist in self.latency.items():
+                per_device[device] += hist.samples
+            for (device, verb), n in self.timeouts.items():
+                timeouts[device] += n
+            for (device, verb), n in self.errors.items():
+                errors[device] += n
+        lines = ["device | count | p50 | p95 | p99 (ms) | timeouts | errors"]
+        for device in sorted(per_device):
+            samples = per_device[device]
+            lines.append("%s | %d | %.1f | %.1f | %.1f | %d | %d" % (
+                device, len(samples),
+                percentile(samples, 50) * 1000, percentile(samples, 95) * 1000,
+                percentile(samples, 99) * 1000, timeouts[device], errors[device]))
+        return "\n".join(lines)
+
+
+def write_file(path, text):
+    with open(path + ".tmp", "w") as f:
+        f.write(text)
+    os.replace(path + ".tmp", path)  # scrapers never see a partial file
+
+
+# Shared by every device in the process
+metrics = Metrics()
+
+
+# Console "stats" command: "stats" prints percentiles per device,
+# "stats json FILE" and "stats prom FILE" export, "stats reset" clears
+def stats_command(cmd):
+    words = cmd.split()
+    if len(words) >= 2 and words[1] == "reset":
+        metrics.reset()
+        return "stats cleared"
+    if len(words) == 3 and words[1] in ("json", "prom", "prometheus"):
+        text = metrics.to_json() if words[1] == "json" else metrics.to_prometheus()
+        try:
+            write_file(words[2], text)
+        except OSError as e:
+            return "can't write %s: %s" % (words[2], e.strerror or e)
+        return "stats written to " + words[2]
+    return metrics.format_stats()
@@ -0,0 +1,442 @@
+import re
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+import serial
+from metrics import metrics
+from recorder import RecordingSerial
+
+try:
+    import termios
+except ImportError:
+    termios = None  # Windows, where pyserial raises SerialException instead
+
+# Prompts printed by the OpenThread CLI (EFR32) and the Zephyr shell (nRF)
+PROMPTS = ("uart:~$", ">")
+# Line printed by the CLI when a command fails, e.g. "Error 7: InvalidArgs"
+ERROR_LINE = re.compile(r"^Error \d+: ")
+# Errors raised when a port can't take new settings; pyserial passes those
+# of tcsetattr through unwrapped
+SETTINGS_ERRORS = (serial.SerialException, OSError) + ((termios.error,) if termios else ())
+
+# Default time allowed for a device to finish answering a command
+DEFAULT_TIMEOUT = 1.0
+# Commands that take longer than the default to answer
+COMMAND_TIMEOUTS = {
+    "scan": 10.0,
+    "discover": 10.0,
+    "dataset commit": 3.0,
+    "factoryreset": 3.0,
+    "reset": 3.0,
+}
+
+
+# Remove a leading prompt from a line
+def strip_prompt(line):
+    line = line.strip()
+    for prompt in PROMPTS:
+        if line.startswith(prompt):
+            return line[len(prompt):].strip()
+    return line
+
+
+# Last line of a command as it will be echoed back by the device
+def echo_line(command):
+    if isinstance(command, bytes):
+        command = command.decode(errors="replace")
+    lines = command.strip().splitlines()
+    return lines[-1].strip() if lines else ""
+
+
+# Time allowed for a device to answer a command
+def command_timeout(command):
+    command = echo_line(command)
+    if command.startswith("ot "):
+        command = command[3:]
+    for verb, timeout in COMMAND_TIMEOUTS.items():
+        if command.startswith(verb):
+            return timeout
+    return DEFAULT_TIMEOUT
+
+
+# Incremental parser for the response to one command. Bytes are fed in as
+# they arrive; a response ends with a "Done" or "Error N: ..." line, or with a
+# prompt once some output other than the echoed command has been received.
+# With `expect_echo`, nothing counts until the command's echo has arrived:
+# lines before it, such as the late answer to a command that timed out, are
+# moved to `unsolicited` instead of ending the response early.
+class ResponseFrame:
+    def __init__(self, command="", expect_echo=False):
+        self.echo = echo_line(command)
+        self.echoed = not (expect_echo and self.echo)
+        self.buf = bytearray()
+        self.pos = 0  # start of the first line not yet inspected
+        self.seen_body = False
+        self.complete = False
+        self.error = False  # ended with an "Error N: ..." line
+        self.remainder = b""  # bytes received after the terminating line
+        self.unsolicited = bytearray()  # lines received before the echo
+
+    # Add received bytes, returns True once the response is complete
+    def feed(self, data):
+        self.buf += data
+        end = self.buf.find(b"\n", self.pos)
+        while end != -1:
+            line = strip_prompt(self.buf[self.pos:end].decode(errors="replace"))
+            if not self.echoed:
+                if line == self.echo:
+                    self.echoed = True
+                    self.pos = end + 1
+                else:
+                    self.unsolicited += self.buf[self.pos:end + 1]
+                    del self.buf[self.pos:end + 1]
+                end = self.buf.find(b"\n", self.pos)
+                continue
+            self.pos = end + 1
+            if line == "Done" or ERROR_LINE.match(line):
+                self.error = line != "Done"
+                self.remainder = bytes(self.buf[self.pos:])
+                del self.buf[self.pos:]
+                self.complete = True
+                return True
+            if line and line != self.echo:
+                self.seen_body = True
+            end = self.buf.find(b"\n", self.pos)
+        tail = self.buf[self.pos:].decode(errors="replace").strip()
+        if self.seen_body and tail in PROMPTS:
+            self.complete = True
+        return self.complete
+
+    @property
+    def text(self):
+        return self.buf.decode(errors="replace")
+
+    # Lines received before the echo since the last call
+    def take_unsolicited(self):
+        data = bytes(self.unsolicited)
+        self.unsolicited.clear()
+        return data
+
+    # Add the exchange to the process-wide metrics
+    def record(self, device, command, seconds):
+        sent = len(command) + 2 if command else 0
+        metrics.command(device, command, seconds, sent, len(self.buf),
+                        timeout=not self.complete, error=self.error)
+
+
+# Read from a serial port until the response to a command is complete.
+# Returns the raw decoded text, which is partial if the deadline passed.
+# If `pending` is given it holds bytes already read from the port: they are
+# consumed first, and anything received after the terminator is put back.
+def read_response(ser, command="", timeout=None, pending=None):
+    if timeout is None:
+        timeout = command_timeout(command)
+    start = time.monotonic()
+    deadline = start + timeout
+    frame = ResponseFrame(command)
+    chunk = b""
+    if pending:
+        chunk = bytes(pending)
+        pending.clear()
+    while not (chunk and frame.feed(chunk)):
+        if time.monotonic() >= deadline:
+            break
+        chunk = ser.read(ser.in_waiting or 1)
+        if not chunk and not ser.timeout:
+            time.sleep(0.001)  # non-blocking port, avoid spinning
+    if pending is not None:
+        pending += frame.remainder
+    frame.record(getattr(ser, "port", ""), command, time.monotonic() - start)
+    return frame.text
+
+
+# Lines of a response without the echoed command, prompts and blank lines
+def response_lines(text, command=""):
+    echo = echo_line(command)
+    lines = []
+    for line in text.replace("\r", "").split("\n"):
+        line = strip_prompt(line)
+        if line and line != echo:
+            lines.append(line)
+    return lines
+
+
+# True if a response ended with "Done"
+def response_ok(text):
+    return "Done" in response_lines(text)
+
+
+# True if the device finished answering, with "Done" or an error
+def response_complete(text):
+    return any(line == "Done" or ERROR_LINE.match(line) for line in response_lines(text))
+
+
+# Send a list of commands without waiting for each answer, then match the
+# streamed responses to the commands in order. At most `window` commands are
+# in flight at once so the device's input buffer isn't overrun.
+# Returns a list of (command, response, ok) tuples.
+def run_batch(ser, commands, window=8, timeout=None):
+    results = []
+    pending = []
+    unread = bytearray()  # bytes read past the end of the previous response
+    commands = list(commands)
+    sent = 0
+    while sent < len(commands) or pending:
+        while sent < len(commands) and len(pending) < window:
+            command = commands[sent]
+            ser.write(bytes(command + "\r\n", "utf-8"))
+            sent += 1
+            if echo_line(command):
+                pending.append(command)
+            else:
+                results.append((command, "", True))  # blank line, no answer
+        ser.flush()
+        if pending:
+            command = pending.pop(0)
+            res = read_response(ser, command, timeout, unread)
+            results.append((command, res, response_ok(res)))
+    return results
+
+
+# Output a device prints without being asked (late ping replies, state
+# changes, log lines). The latest lines are kept in a bounded ring buffer and
+# passed to subscribers as they arrive.
+class EventLog:
+    def __init__(self, maxlen=1000):
+        self.events = deque(maxlen=maxlen)  # (monotonic time, line)
+        self.subscribers = []
+        self.partial = bytearray()
+        self.lock = threading.Lock()
+
+    # Add received bytes, complete lines become events
+    def feed(self, data):
+        with self.lock:
+            self.partial += data
+            lines = self.partial.split(b"\n")
+            self.partial = bytearray(lines.pop())
+            if strip_prompt(self.partial.decode(errors="replace")) == "":
+                self.partial.clear()  # only a prompt is waiting
+        for line in lines:
+            line = strip_prompt(line.decode(errors="replace"))
+            if line:
+                self.add(line)
+
+    def add(self, line):
+        timestamp = time.monotonic()
+        with self.lock:
+            self.events.append((timestamp, line))
+            subscribers = list(self.subscribers)
+        for callback in subscribers:
+            try:
+                callback(timestamp, line)
+            except Exception:
+                pass  # a broken subscriber mustn't stop the reader
+
+    # Call callback(timestamp, line) for every new event
+    def subscribe(self, callback):
+        with self.lock:
+            self.subscribers.append(callback)
+
+    def unsubscribe(self, callback):
+        with self.lock:
+            if callback in self.subscribers:
+                self.subscribers.remove(callback)
+
+    # Most recent events, oldest first
+    def recent(self, count=None):
+        with self.lock:
+            events = list(self.events)
+        return events[-count:] if count else events
+
+
+# Background thread that keeps draining a port. Output belonging to a command
+# sent through request() goes to that command; everything else is logged as
+# an unsolicited event, so it can neither be lost nor corrupt a response.
+class DeviceReader:
+    def __init__(self, ser, events=None, echo=True):
+        self.serial = ser
+        self.events = events if events is not None else EventLog()
+        self.echo = echo  # the device echoes commands, see ResponseFrame
+        self.frames = deque()  # responses being waited for, oldest first
+        self.cond = threading.Condition()
+        self.running = False
+        self.thread = None
+
+    def start(self):
+        if self.running:
+            return
+        self.running = True
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def run(self):
+        while self.running:
+            try:
+                data = self.serial.read(self.serial.in_waiting or 1)
+            except (serial.SerialException, OSError):
+                break
+            if not data:
+                if not self.serial.timeout:
+                    time.sleep(0.001)  # non-blocking port, avoid spinning
+                continue
+            unsolicited = bytearray()
+            with self.cond:
+                while data and self.frames:
+                    frame = self.frames[0]
+                    complete = frame.feed(data)
+                    unsolicited += frame.take_unsolicited()
+                    if not complete:
+                        data = b""
+                        break
+                    self.frames.popleft()
+                    data = frame.remainder
+                    self.cond.notify_all()
+            unsolicited += data
+            if unsolicited:
+                metrics.received(self.serial.port, len(unsolicited))
+                self.events.feed(bytes(unsolicited))
+        with self.cond:
+            self.running = False
+            self.cond.notify_all()
+
+    # Send commands, at most `window` in flight, and return their raw
+    # responses in order. A response that times out is returned partial.
+    def request(self, commands, window=8, timeout=None):
+        commands = list(commands)
+        results = [""] * len(commands)
+        pending = deque()  # (index, frame) of commands written
+        sent = 0
+        deadline = None
+        while sent < len(commands) or pending:
+            while sent < len(commands) and len(pending) < window:
+                command = commands[sent]
+                if echo_line(command):
+                    frame = ResponseFrame(command, self.echo)
+                    frame.start = time.monotonic()
+                    with self.cond:
+                        self.frames.append(frame)
+                    pending.append((sent, frame))
+                self.serial.write(bytes(command + "\r\n", "utf-8"))
+                sent += 1
+            self.serial.flush()
+            if not pending:
+                continue
+            index, frame = pending[0]
+            if deadline is None:
+                wait = timeout if timeout is not None else command_timeout(commands[index])
+                deadline = time.monotonic() + wait
+            with self.cond:
+                self.cond.wait_for(
+                    lambda: frame.complete or not self.running,
+                    max(0, deadline - time.monotonic()),
+                )
+                if not frame.complete and frame in self.frames:
+                    self.frames.remove(frame)  # give up on this response
+            frame.record(self.serial.port, commands[index], time.monotonic() - frame.start)
+            results[index] = frame.text
+            pending.popleft()
+            deadline = None
+        return results
+
+
+# Change the settings (baudrate, parity) of an open port. Some drivers
+# refuse to change framing in place, so the port is reopened with the new
+# settings if they do. Raises SerialException if the port can't take them
+# at all, leaving it closed.
+def reconfigure(ser, settings):
+    try:
+        for name, value in settings.items():
+            setattr(ser, name, value)
+    except SETTINGS_ERRORS:
+        ser.close()
+        for name, value in settings.items():
+            setattr(ser, name, value)
+    if not ser.is_open:
+        try:
+            ser.open()
+        except SETTINGS_ERRORS as e:
+            raise serial.SerialException("can't set %s: %s" % (settings, e))
+
+
+# Long-lived serial connections keyed by device path. Each port is opened
+# once and reused; a port that fails is closed and reopened on next use.
+class SerialPool:
+    def __init__(self, **settings):
+        self.settings = settings  # passed to serial.Serial, e.g. baudrate
+        self.device_settings = {}  # device -> settings found for it, see configure
+        self.connections = {}
+        self.lock = threading.Lock()
+
+    # Open connection for a device, reopening it if it is no longer healthy
+    def get(self, device):
+        with self.lock:
+            ser = self.connections.get(device)
+            if ser is not None and self.healthy(ser):
+                return ser
+            self.connections.pop(device, None)
+        if ser is not None:
+            self.close_serial(ser)
+            metrics.reopened(device)
+        # open outside the lock so slow ports don't hold up the others
+        ser = RecordingSerial(device, **dict(self.settings, **self.device_settings.get(device, {})))
+        with self.lock:
+            current = self.connections.setdefault(device, ser)
+        if current is not ser:
+            self.close_serial(ser)
+        return current
+
+    # Use `settings` (baudrate, parity) for a device from now on, including
+    # its open connection
+    def configure(self, device, settings):
+        with self.lock:
+            self.device_settings[device] = dict(settings)
+            ser = self.connections.get(device)
+        if ser is not None:
+            reconfigure(ser, settings)
+
+    # Borrow a connection; it is dropped from the pool if the caller fails
+    @contextmanager
+    def connection(self, device):
+        ser = self.get(device)
+        try:
+            yield ser
+        except (serial.SerialException, OSError):
+            self.close(device)
+            raise
+
+    # Check that an open port can still be queried
+    def healthy(self, ser):
+        try:
+            ser.in_waiting
+            return ser.is_open
+        except (serial.SerialException, OSError):
+            return False
+
+    def close_serial(self, ser):
+        try:
+            ser.close()
+        except (serial.SerialException, OSError):
+            pass
+
+    # Close one device's connection
+    def close(self, device):
+        with self.lock:
+            ser = self.connections.pop(device, None)
+        if ser is not None:
+            self.close_serial(ser)
+
+    # Close every connection in the pool
+    def close_all(self):
+        with self.lock:
+            connections = list(self.connections.values())
+            self.connections = {}
+        for ser in connections:
+            self.close_serial(ser)
@@ -0,0 +1,128 @@
+import asyncio
+import csv
+import io
+import json
+import re
+
+from async_device import broadcast
+
+REPLY = re.compile(r"(\d+) bytes from (\S+): icmp_seq=(\d+) hlim=(\d+) time=(\d+)ms")
+STATS = re.compile(r"(\d+) packets transmitted, (\d+) packets received\.")
+
+# Default ping parameters: payload bytes, echo requests per pair, seconds
+# between requests and seconds to wait for the last reply
+PING_SIZE = 8
+PING_COUNT = 3
+PING_INTERVAL = 0.2
+PING_TIMEOUT = 3.0
+
+
+# Parse the output of the CLI ping command into RTT and loss figures
+def parse_ping(lines, count):
+    rtts = []
+    sent = count
+    received = None
+    for line in lines:
+        reply = REPLY.search(line)
+        if reply:
+            rtts.append(int(reply.group(5)))
+        stats = STATS.search(line)
+        if stats:
+            sent, received = int(stats.group(1)), int(stats.group(2))
+    if received is None:
+        received = len(rtts)
+    result = {
+        "sent": sent,
+        "received": received,
+        "loss": round(100.0 * (sent - received) / sent, 1) if sent else 100.0,
+        "rtt_min": None,
+        "rtt_avg": None,
+        "rtt_max": None,
+    }
+    if rtts:
+        result.update(rtt_min=min(rtts), rtt_avg=round(sum(rtts) / len(rtts), 1), rtt_max=max(rtts))
+    return result
+
+
+# Ping an address from one device and return its parsed result. Replies that
+# arrive after the command's "Done" are picked up from the device's events.
+async def ping(device, address, count=PING_COUNT, size=PING_SIZE,
+               interval=PING_INTERVAL, timeout=PING_TIMEOUT):
+    late = []
+
+    def collect(timestamp, line):
+        if REPLY.search(line) or STATS.search(line):
+            late.append(line)
+
+    command = "ping %s %d %d %g 64 %g" % (address, size, count, interval, timeout)
+    device.events.subscribe(collect)
+    try:
+        wait = count * interval + timeout
+        lines = (await device.run_command(command, wait + 1.0)).split("\n")
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + wait
+        while not any(STATS.search(line) for line in lines + late) and loop.time() < deadline:
+            await asyncio.sleep(0.05)
+    finally:
+        device.events.unsubscribe(collect)
+    return parse_ping(lines + late, count)
+
+
+# First mesh-local address in an ipaddr response
+def mesh_address(response):
+    for line in response.split("\n"):
+        if ":" in line and not line.startswith("fe80"):
+            return line
+    return ""
+
+
+# Ping every ordered pair of devices. In round r device i pings device
+# (i + r) % N, so every device has at most one ping outstanding and a round
+# takes as long as one ping: N - 1 rounds in total instead of N * (N - 1).
+# Returns {"ports": [...], "results": N x N matrix of parse_ping results}.
+async def ping_matrix(devices, addresses=None, count=PING_COUNT, size=PING_SIZE,
+                      interval=PING_INTERVAL, timeout=PING_TIMEOUT):
+    if addresses is None:
+        addresses = [mesh_address(res) for res in await broadcast(devices, "ipaddr")]
+    n = len(devices)
+    results = [[None] * n for _ in range(n)]
+    for r in range(1, n):
+        pairs = [(i, (i + r) % n) for i in range(n)]
+        round_results = await asyncio.gather(*(
+            ping(devices[i], addresses[j], count, size, interval, timeout)
+            for i, j in pairs
+        ))
+        for (i, j), result in zip(pairs, round_results):
+            results[i][j] = result
+    return {"ports": [device.port for device in devices], "results": results}
+
+
+def to_json(matrix):
+    return json.dumps(matrix, indent=1)
+
+
+# One metric of the matrix as CSV, sources as rows and targets as columns
+def to_csv(matrix, field="rtt_avg"):
+    out = io.StringIO()
+    writer = csv.writer(out)
+    writer.writerow([field] + matrix["ports"])
+    for port, row in zip(matrix["ports"], matrix["results"]):
+        writer.writerow([port] + ["" if cell is None or cell[field] is None else cell[field]
+                                  for cell in row])
+    return out.getvalue()
+
+
+# Average RTT / loss table for the console
+def format_matrix(matrix):
+    lines = []
+    for port, row in zip(matrix["ports"], matrix["results"]):
+        cells = []
+        for cell in row:
+            if cell is None:
+                cells.append("-")
+            elif cell["rtt_avg"] is None:
+                cells.append("lost")
+            else:
+                cells.append("%gms/%g%%" % (cell["rtt_avg"], cell["loss"]))
+        lines.append(port + " | " + " ".join(cells))
+    return "\n".join(lines)
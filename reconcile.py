@@ -0,0 +1,85 @@
+import hashlib
+import threading
+
+from dataset import parse_dataset
+
+# Commands that read back the settings config applies, sent as one batch
+READ_COMMANDS = ["dataset active -x", "mode", "txpower"]
+# State of a device that wasn't read, so that every setting is sent
+UNKNOWN_STATE = {"dataset": None, "mode": None, "txpower": None}
+
+
+# Settings a device should end up with
+def desired_state(tlvs, mode, txpower):
+    return {"dataset": tlvs, "mode": mode, "txpower": str(txpower)}
+
+
+# Settings read from a device, given the responses to READ_COMMANDS as lists
+# of lines without the echo. Anything that can't be read is None.
+def current_state(responses):
+    tlvs, mode, txpower = [lines[0] if lines and lines[0] not in ("", "Done") else None
+                           for lines in responses]
+    if txpower is not None:
+        txpower = txpower.split()[0]  # "0 dBm"
+    if mode == "-":
+        mode = ""
+    return {"dataset": tlvs, "mode": mode, "txpower": txpower}
+
+
+# Dataset fields that matter, so TLV order and timestamps don't count as a change
+def dataset_fields(tlvs):
+    try:
+        fields = parse_dataset(tlvs or "")
+    except ValueError:
+        return None
+    fields.pop("timestamp", None)
+    return fields or None
+
+
+def fingerprint(state):
+    fields = dataset_fields(state["dataset"])
+    text = "%s|%s|%s" % (sorted(fields.items()) if fields else None,
+                         "".join(sorted(state["mode"] or "")), state["txpower"])
+    return hashlib.sha1(text.encode()).hexdigest()[:16]
+
+
+# Commands that take a device from `current` to `desired`, nothing if they
+# already match
+def diff_commands(current, desired):
+    commands = []
+    if current["txpower"] != desired["txpower"]:
+        commands.append("txpower " + desired["txpower"])
+    if sorted(current["mode"] or "-") != sorted(desired["mode"] or "-"):
+        commands.append("mode " + (desired["mode"] or "-"))
+    if dataset_fields(current["dataset"]) != dataset_fields(desired["dataset"]):
+        commands.append("dataset set active " + desired["dataset"])
+    return commands
+
+
+# Fingerprint of the configuration last applied to each device, to tell
+# whether a device changed since it was configured
+class Reconciler:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.fingerprints = {}  # port -> fingerprint
+
+    # Commands to send to a device and a note if its configuration no longer
+    # matches what was last applied to it
+    def plan(self, port, current, desired):
+        with self.lock:
+            last = self.fingerprints.get(port)
+        note = None
+        if last is not None and fingerprint(current) != last:
+            note = "changed since last config"
+        return diff_commands(current, desired), note
+
+    def applied(self, port, desired):
+        with self.lock:
+            self.fingerprints[port] = fingerprint(desired)
+
+    def forget(self, port=None):
+        with self.lock:
+            if port is None:
+                self.fingerprints.clear()
+            else:
+                self.fingerprints.pop(port, None)
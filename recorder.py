@@ -0,0 +1,258 @@
+import argparse
+import json
+import os
+import selectors
+import threading
+import time
+
+import serial
+
+# Record every byte written to and read from the devices with the
+# OT_RECORD=<file> environment variable or the consoles' "record" command.
+RECORD_ENV = "OT_RECORD"
+
+
+# Appends timestamped serial traffic to a JSONL file. Bytes are stored as
+# latin-1 strings so any data round-trips exactly.
+class Recorder:
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, "a", buffering=1 << 16)
+        self.lock = threading.Lock()
+        self.start = time.monotonic()
+        self.write_line({"version": 1, "start": time.time()})
+
+    def write_line(self, entry):
+        line = json.dumps(entry, separators=(",", ":")) + "\n"
+        with self.lock:
+            self.file.write(line)
+
+    def record(self, device, op, data):
+        self.write_line({
+            "t": round(time.monotonic() - self.start, 6),
+            "dev": device,
+            "op": op,  # "w" host to device, "r" device to host
+            "data": data.decode("latin-1"),
+        })
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+
+recorder = None
+
+
+# Opens the new file first so a bad path keeps the current recording going
+def start_recording(path):
+    global recorder
+    new = Recorder(path)
+    stop_recording()
+    recorder = new
+
+
+def stop_recording():
+    global recorder
+    if recorder is not None:
+        recorder.close()
+        recorder = None
+
+
+# Hook for code that reads or writes a port without going through pyserial
+def record(device, op, data):
+    if recorder is not None and data:
+        recorder.record(device, op, data)
+
+
+# serial.Serial that records its traffic while a recording is running
+class RecordingSerial(serial.Serial):
+    def read(self, size=1):
+        data = super().read(size)
+        record(self.port, "r", data)
+        return data
+
+    def write(self, data):
+        record(self.port, "w", bytes(data))
+        return super().write(data)
+
+
+# Console "record" command: "record FILE" starts, "record stop" stops
+def record_command(cmd):
+    words = cmd.split()
+    if len(words) == 2 and words[1] == "stop":
+        stop_recording()
+        return "recording stopped"
+    if len(words) == 2:
+        try:
+            start_recording(words[1])
+        except OSError as e:
+            return "can't record to %s: %s" % (words[1], e.strerror or e)
+        return "recording to " + words[1]
+    return "usage: record FILE | record stop"
+
+
+if os.environ.get(RECORD_ENV):
+    start_recording(os.environ[RECORD_ENV])
+
+
+# Recorded traffic grouped by device, as lists of (time, op, bytes)
+def load_session(path):
+    session = {}
+    with open(path) as f:
+        for line in f:
+            entry = json.loads(line)
+            if "dev" not in entry:
+                continue  # header
+            session.setdefault(entry["dev"], []).append(
+                (entry["t"], entry["op"], entry["data"].encode("latin-1")))
+    return session
+
+
+# Plays a recorded device back on a pseudo terminal. Device output is only
+# released once the host has written as much as it did in the recording,
+# then paced like the original (speed 1.0) or sent at once (speed None).
+class ReplayDevice:
+    def __init__(self, name, events, speed):
+        self.name = name
+        self.events = events
+        self.speed = speed
+        self.pos = 0
+        import tty  # replay needs ptys, recording doesn't
+        self.master_fd, self.slave_fd = os.openpty()
+        tty.setraw(self.slave_fd)
+        os.set_blocking(self.master_fd, False)
+        self.port = os.ttyname(self.slave_fd)
+        self.host_bytes = 0  # written by the host so far
+        self.expected = 0  # written by the host in the recording so far
+        self.gate_time = time.monotonic()  # when the last write was matched
+        self.gate_t = events[0][0] if events else 0.0
+
+    @property
+    def finished(self):
+        return self.pos >= len(self.events)
+
+    # Release whatever can be sent now, returns the time of the next event
+    def step(self, now):
+        while not self.finished:
+            t, op, data = self.events[self.pos]
+            if op == "w":
+                if self.host_bytes < self.expected + len(data):
+                    return None  # waiting for the host
+                self.expected += len(data)
+                self.gate_time, self.gate_t = now, t
+            else:
+                due = now if self.speed is None else self.gate_time + (t - self.gate_t) / self.speed
+                if due > now:
+                    return due
+                try:
+                    os.write(self.master_fd, data)
+                except OSError:
+                    pass
+            self.pos += 1
+        return None
+
+    def close(self):
+        for fd in (self.master_fd, self.slave_fd):
+            try:
+                os.close(fd)
+            except OSError:
+                pass
+
+
+# Virtual devices replaying a recorded session, served by one thread.
+# `ports` maps each recorded device name to the pty now standing in for it.
+class ReplayFarm:
+    def __init__(self, path, speed=1.0):
+        self.devices = [ReplayDevice(name, events, speed)
+                        for name, events in load_session(path).items()]
+        self.ports = {device.name: device.port for device in self.devices}
+        self.selector = selectors.DefaultSelector()
+        for device in self.devices:
+            self.selector.register(device.master_fd, selectors.EVENT_READ, device)
+        self.running = False
+        self.thread = None
+        self.done = threading.Event()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+        if self.thread:
+            self.thread.join()
+        self.selector.close()
+        for device in self.devices:
+            device.close()
+
+    def run(self):
+        while self.running:
+            now = time.monotonic()
+            wake = [device.step(now) for device in self.devices]
+            if all(device.finished for device in self.devices):
+                self.done.set()
+            due = [t for t in wake if t is not None]
+            timeout = min(0.05, max(0, min(due) - now)) if due else 0.05
+            for key, _ in self.selector.select(timeout):
+                try:
+                    key.data.host_bytes += len(os.read(key.fd, 4096))
+                except OSError:
+                    pass
+
+
+# Run every recorded response through the response parser as fast as
+# possible, returns (responses parsed, bytes, seconds)
+def bench_parser(path):
+    from ot_serial import ResponseFrame
+    session = load_session(path)
+    start = time.perf_counter()
+    responses = 0
+    total = 0
+    for events in session.values():
+        frame = None
+        for t, op, data in events:
+            if op == "w":
+                frame = ResponseFrame(data.decode("latin-1"))
+            elif frame is not None:
+                total += len(data)
+                if frame.feed(data):
+                    responses += 1
+                    frame = None
+    return responses, total, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay recorded serial traffic")
+    sub = parser.add_subparsers(dest="action", required=True)
+    replay = sub.add_parser("replay", help="serve a recording on virtual devices")
+    replay.add_argument("file")
+    replay.add_argument("--speed", default="1", help="playback speed factor, or 'max'")
+    bench = sub.add_parser("bench", help="time the response parser on a recording")
+    bench.add_argument("file")
+    args = parser.parse_args()
+    if args.action == "bench":
+        responses, total, seconds = bench_parser(args.file)
+        print("%d responses, %d bytes in %.3f s (%.1f MB/s)" % (
+            responses, total, seconds, total / seconds / 1e6 if seconds else 0))
+        return
+    speed = None if args.speed == "max" else float(args.speed)
+    with ReplayFarm(args.file, speed) as farm:
+        for name, port in farm.ports.items():
+            print(name + " -> " + port)
+        try:
+            farm.done.wait()
+            print("replay finished")
+        except KeyboardInterrupt:
+            pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,224 @@
+import argparse
+import asyncio
+import fnmatch
+import json
+import os
+import re
+import sys
+import time
+
+import discovery
+from async_device import async_ot_device, broadcast, stream
+from ot_serial import SerialPool
+
+try:
+    import yaml
+except ImportError:
+    yaml = None  # YAML scenarios need PyYAML, JSON ones don't
+
+# Roles a device reports once it has joined a network
+ATTACHED = ["child", "router", "leader"]
+# Defaults of wait steps: seconds to wait and between polls
+WAIT_TIMEOUT = 30.0
+WAIT_INTERVAL = 0.5
+
+
+# Load a scenario: JSON, YAML, or a plain script with one command per line
+# ("sleep N" pauses, "#" starts a comment). Returns
+# {"name", "patterns", "stop_on_failure", "steps": [...]}.
+def load_scenario(path):
+    with open(path) as f:
+        text = f.read()
+    extension = os.path.splitext(path)[1].lower()
+    if extension == ".json":
+        scenario = json.loads(text)
+    elif extension in (".yaml", ".yml"):
+        if yaml is None:
+            raise ValueError("YAML scenarios need PyYAML (pip install pyyaml)")
+        try:
+            scenario = yaml.safe_load(text)
+        except yaml.YAMLError as e:
+            raise ValueError(str(e))
+    else:
+        steps = []
+        for line in text.splitlines():
+            line = line.split("#")[0].strip()
+            if line.split()[:1] == ["sleep"]:
+                steps.append({"sleep": float(line.split()[1])})
+            elif line:
+                steps.append({"command": line})
+        scenario = {"steps": steps}
+    if not isinstance(scenario, dict) or not isinstance(scenario.get("steps"), list):
+        raise ValueError("a scenario needs a list of steps")
+    scenario.setdefault("name", os.path.basename(path))
+    scenario.setdefault("stop_on_failure", True)
+    return scenario
+
+
+def as_list(value):
+    return value if isinstance(value, list) else [value]
+
+
+# True if a device matches a step's selector, e.g. {"platform": "Zephyr",
+# "role": ["router", "leader"], "port": "/dev/ttyACM*", "ttm": false}. Every
+# given field has to match; platforms, roles and ports can be lists.
+def matches(selector, entry, role=None):
+    if "platform" in selector and entry["platform"].lower() not in [
+            p.lower() for p in as_list(selector["platform"])]:
+        return False
+    if "port" in selector and not any(fnmatch.fnmatch(entry["port"], pattern)
+                                      for pattern in as_list(selector["port"])):
+        return False
+    if "ttm" in selector and bool(entry["ttm"]) != bool(selector["ttm"]):
+        return False
+    if "role" in selector and role not in as_list(selector["role"]):
+        return False
+    return True
+
+
+# Runs the steps of a scenario on the thread devices, without a console.
+# Every step reaches only the devices its selector picks, and the result of
+# every step is kept for the report.
+class ScenarioRunner:
+    def __init__(self, entries, devices, log=None):
+        self.entries = entries  # discovery entries, in port order
+        self.devices = devices  # port -> async_ot_device
+        self.log = log or (lambda text: None)
+
+    # Devices a selector picks; roles are only asked for when it needs them
+    async def select(self, selector):
+        selector = selector or {}
+        entries = [entry for entry in self.entries if entry["platform"]]
+        roles = [None] * len(entries)
+        if "role" in selector:
+            responses = await broadcast([self.devices[entry["port"]] for entry in entries], "state")
+            roles = [response.split("\n")[0] for response in responses]
+        return [self.devices[entry["port"]] for entry, role in zip(entries, roles)
+                if matches(selector, entry, role)]
+
+    async def run(self, scenario):
+        start = time.monotonic()
+        results = []
+        stopped = False
+        for index, step in enumerate(scenario["steps"]):
+            for repeat in range(int(step.get("repeat", 1))):
+                result = await self.run_step(step)
+                result.update(step=index, repeat=repeat)
+                results.append(result)
+                self.log("%s | %s | %d devices | %.2f s" % (
+                    "ok" if result["ok"] else "FAILED", result["name"],
+                    result["devices"], result["seconds"]))
+                stopped = not result["ok"] and scenario["stop_on_failure"]
+                if stopped:
+                    break
+            if stopped:
+                break
+        return {
+            "scenario": scenario["name"],
+            "passed": not stopped and all(result["ok"] for result in results),
+            "seconds": round(time.monotonic() - start, 3),
+            "steps": results,
+        }
+
+    async def run_step(self, step):
+        start = time.monotonic()
+        if "sleep" in step:
+            await asyncio.sleep(float(step["sleep"]))
+            result = {"name": step.get("name", "sleep %g" % step["sleep"]), "ok": True,
+                      "devices": 0, "failed": []}
+        elif "wait" in step:
+            result = await self.wait(step)
+        elif "command" in step:
+            result = await self.command(step)
+        else:
+            result = {"name": step.get("name", "?"), "ok": False, "devices": 0,
+                      "failed": [{"error": "a step needs command, wait or sleep"}]}
+        result["seconds"] = round(time.monotonic() - start, 3)
+        return result
+
+    # Run a command on the selected devices, at most `parallel` at a time.
+    # A device fails the step if its response doesn't match `expect`, a
+    # regular expression, or doesn't end with Done when there is none. A
+    # step that selects no device fails unless it sets `allow_empty`.
+    async def command(self, step):
+        devices = await self.select(step.get("select"))
+        expect = re.compile(step["expect"]) if "expect" in step else None
+        failed = []
+        async for port, response, seconds in stream(devices, step["command"], step.get("timeout"),
+                                                    limit=step.get("parallel")):
+            ok = expect.search(response) if expect else "Done" in response.split("\n")
+            if not ok:
+                failed.append({"port": port, "response": response})
+        failed.sort(key=lambda entry: entry["port"])
+        ok = not failed and (devices or step.get("allow_empty", False))
+        return {"name": step.get("name", step["command"]), "ok": bool(ok),
+                "devices": len(devices), "failed": failed}
+
+    # Poll the selected devices until `count` of them (all by default) answer
+    # `command` ("state" by default) with something matching `match`, or
+    # are in one of the roles listed in `state`. Fails with the devices
+    # still not matching once `timeout` has passed.
+    async def wait(self, step):
+        wait = step["wait"] if isinstance(step["wait"], dict) else {"state": step["wait"]}
+        command = wait.get("command", "state")
+        if "match" in wait:
+            pattern = re.compile(wait["match"])
+        else:
+            roles = as_list(wait.get("state", ATTACHED))
+            pattern = re.compile("^(%s)$" % "|".join(map(re.escape, roles)), re.MULTILINE)
+        timeout = float(wait.get("timeout", step.get("timeout", WAIT_TIMEOUT)))
+        interval = float(wait.get("interval", WAIT_INTERVAL))
+        devices = await self.select(step.get("select"))
+        count = int(wait.get("count", len(devices)))
+        deadline = time.monotonic() + timeout
+        while True:
+            responses = await broadcast(devices, command)
+            pending = [{"port": device.port, "response": response}
+                       for device, response in zip(devices, responses)
+                       if not pattern.search(response)]
+            if len(devices) - len(pending) >= count or time.monotonic() >= deadline:
+                break
+            await asyncio.sleep(interval)
+        ok = len(devices) - len(pending) >= count and bool(devices or step.get("allow_empty", False))
+        return {"name": step.get("name", "wait %s ~ %s" % (command, pattern.pattern)),
+                "ok": ok, "devices": len(devices), "failed": [] if ok else pending}
+
+
+async def run(scenario, patterns=None, log=None):
+    pool = SerialPool(baudrate=115200, timeout=0.1, write_timeout=1.0)
+    entries = await asyncio.to_thread(discovery.discover, pool, patterns or scenario.get("patterns"))
+    devices = {entry["port"]: async_ot_device(entry["port"], entry["platform"], ser=pool.get(entry["port"]))
+               for entry in entries if entry["platform"]}
+    try:
+        return await ScenarioRunner(entries, devices, log).run(scenario)
+    finally:
+        for device in devices.values():
+            device.detach()
+        pool.close_all()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Run a scenario of steps on the thread devices without a console")
+    parser.add_argument("scenario", help="JSON or YAML scenario, or a script with one command per line")
+    parser.add_argument("--patterns", nargs="*", help="port patterns, default ttyACM*/ttyUSB*")
+    parser.add_argument("--output", help="write the JSON report here instead of stdout")
+    parser.add_argument("--quiet", action="store_true", help="don't log steps to stderr")
+    args = parser.parse_args()
+    try:
+        scenario = load_scenario(args.scenario)
+    except (OSError, ValueError) as e:
+        sys.exit("can't load %s: %s" % (args.scenario, e))
+    log = None if args.quiet else (lambda text: print(text, file=sys.stderr))
+    report = asyncio.run(run(scenario, args.patterns, log))
+    text = json.dumps(report, indent=1)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+    sys.exit(0 if report["passed"] else 1)
+
+
+if __name__ == "__main__":
+    main()
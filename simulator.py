@@ -0,0 +1,801 @@
+import argparse
+import hashlib
+import heapq
+import itertools
+import os
+import random
+import selectors
+import termios
+import threading
+import time
+import tty
+
+import dataset
+
+ZEPHYR = "zephyr"  # nRF boards: commands prefixed with "ot ", "uart:~$" prompt
+EFR32 = "efr32"  # Silicon Labs boards: bare commands, "> " prompt
+
+PROMPTS = {ZEPHYR: "uart:~$ ", EFR32: "> "}
+PLATFORMS = {ZEPHYR: "Zephyr", EFR32: "EFR32"}
+
+MESH_LOCAL_PREFIX = "fdde:ad00:beef:0"
+
+
+# Error reported by a simulated CLI command, printed as "Error N: name"
+class CommandError(Exception):
+    def __init__(self, code, name):
+        super().__init__("Error %d: %s" % (code, name))
+
+
+INVALID_COMMAND = (35, "InvalidCommand")
+INVALID_ARGS = (7, "InvalidArgs")
+INVALID_STATE = (13, "InvalidState")
+
+# Noise floor in dBm, link margins are measured from it
+NOISE_FLOOR = -100
+# 802.15.4 data rate in bytes per second, and bytes of MAC, 6LoWPAN and UDP
+# headers added to every datagram
+AIR_RATE = 250000 / 8
+FRAME_OVERHEAD = 40
+# Seconds a datagram may wait for the channel before it is dropped
+MAX_QUEUE_DELAY = 0.5
+# UART rates a device can run at, with their termios speeds
+SPEEDS = {rate: getattr(termios, "B%d" % rate) for rate in (
+    9600, 19200, 38400, 57600, 115200, 230400, 460800, 921600, 1000000)}
+
+
+# Format the groups of an IPv6 address the way the OpenThread CLI prints them
+def ip6(prefix, iid):
+    groups = [iid[i:i + 4].lstrip("0") or "0" for i in range(0, 16, 4)]
+    return prefix + ":" + ":".join(groups)
+
+
+# Table the way the OpenThread CLI prints it, with cells padded to the
+# header widths
+def table(header, rows):
+    widths = [len(name) + 2 for name in header]
+    lines = ["|" + "|".join(" %s " % name for name in header) + "|",
+             "+" + "+".join("-" * width for width in widths) + "+"]
+    for row in rows:
+        lines.append("|" + "|".join(("%*s " % (width - 1, cell)) for width, cell in zip(widths, row)) + "|")
+    return lines
+
+
+# Link quality 0-3 for a link margin in dB, as in OpenThread
+def link_quality(margin):
+    if margin > 20:
+        return 3
+    if margin > 10:
+        return 2
+    if margin > 2:
+        return 1
+    return 0
+
+
+# One simulated board behind a pseudo terminal. The controller opens `port`
+# like any other serial device; the farm thread answers on the master side.
+class VirtualDevice:
+    def __init__(self, farm, index, dialect=EFR32, echo=True, latency=0.002,
+                 jitter=0.0, ttm=False, baudrate=115200, parity="N"):
+        self.farm = farm
+        self.default_baudrate = baudrate  # the UART comes back at this rate after a reset
+        self.parity = parity
+        # above this rate a fifth of the input is garbled, like on a long
+        # cable; None for a clean link at any rate
+        self.max_baudrate = None
+        self.index = index
+        self.dialect = dialect
+        self.echo = echo
+        self.latency = latency
+        self.jitter = jitter
+        self.ttm = ttm
+        self.master_fd, self.slave_fd = os.openpty()
+        tty.setraw(self.slave_fd)
+        os.set_blocking(self.master_fd, False)
+        self.port = os.ttyname(self.slave_fd)
+        self.inbuf = b""
+        self.ready_at = 0.0  # output is never reordered before this time
+        self.wedged = False  # set to ignore all input, like a hung board
+        self.ext_addr = hashlib.sha1(b"ot-sim-%d" % index).hexdigest()[:16]
+        self.mleid_iid = hashlib.sha1(b"ot-sim-mleid-%d" % index).hexdigest()[:16]
+        self.factory_reset()
+
+    def factory_reset(self):
+        self.txpower = 0
+        self.mode = "rdn"
+        self.router_jitter = 120  # seconds, the OpenThread default
+        self.pending = {}
+        self.active = None
+        self.reset()
+
+    # Volatile state lost on reboot
+    def reset(self):
+        self.if_up = False
+        self.thread_on = False
+        self.role = "disabled"
+        self.rloc16 = 0xFFFE
+        self.parent = None
+        self.baudrate = self.default_baudrate
+        self.udp_port = None  # None: socket closed, 0: open but not bound
+        self.attach_gen = getattr(self, "attach_gen", 0) + 1
+
+    @property
+    def prompt(self):
+        return PROMPTS[self.dialect]
+
+    @property
+    def attached(self):
+        return self.role in ("child", "router", "leader")
+
+    @property
+    def network(self):
+        if not self.active:
+            return None
+        return (self.active.get("channel"), self.active.get("panid"),
+                self.active.get("networkkey"))
+
+    def addresses(self):
+        addrs = []
+        if self.if_up:
+            prefix = (self.active or {}).get("meshlocalprefix", MESH_LOCAL_PREFIX)
+            addrs.append(ip6(prefix, self.mleid_iid))
+            if self.attached:
+                addrs.append(ip6(prefix, "000000fffe00%04x" % self.rloc16))
+            addrs.append(ip6("fe80:0:0:0", self.ext_addr))
+        return addrs
+
+    # Queue output so that it reaches the port after the response latency
+    def send(self, text, delay=None):
+        if delay is None:
+            delay = self.latency + random.uniform(0, self.jitter)
+        at = max(time.monotonic() + delay, self.ready_at) + self.transmit_time(len(text))
+        self.ready_at = at
+        self.farm.schedule(at, self.write, text.encode())
+
+    # Seconds the UART takes to send `size` bytes, with the farm's
+    # serial_timing on; a start and stop bit per byte, and a parity bit
+    def transmit_time(self, size):
+        if not self.farm.serial_timing:
+            return 0.0
+        bits = 10 if self.parity == "N" else 11
+        return size * bits / self.baudrate
+
+    # True if the host has the port set to the device's baud rate and parity.
+    # Parity is only compared where ptys keep it, see pty_keeps_parity.
+    def line_matches(self):
+        try:
+            attributes = termios.tcgetattr(self.slave_fd)
+        except termios.error:
+            return True
+        cflag, speed = attributes[2], attributes[4]
+        if speed != SPEEDS.get(self.baudrate):
+            return False
+        if not self.farm.check_parity:
+            return True
+        parity = "N"
+        if cflag & termios.PARENB:
+            parity = "O" if cflag & termios.PARODD else "E"
+        return parity == self.parity
+
+    def write(self, data):
+        try:
+            os.write(self.master_fd, data)
+        except OSError:
+            pass  # nobody reading and the pty buffer is full, data is lost
+
+    def respond(self, lines, done=True):
+        text = "".join(line + "\r\n" for line in lines)
+        if done:
+            text += "Done\r\n"
+        self.send(text + self.prompt)
+
+    def receive(self, data):
+        if self.wedged:
+            return
+        unstable = self.max_baudrate and self.baudrate > self.max_baudrate
+        if not self.line_matches() or (unstable and self.farm.random.random() < 0.2):
+            # framing errors: the input is lost and the host reads noise
+            self.write(bytes(random.randrange(0x80, 0x100) for _ in range(len(data) // 2 + 1)))
+            return
+        self.inbuf += data
+        while True:
+            cut = [i for i in (self.inbuf.find(b"\r"), self.inbuf.find(b"\n")) if i != -1]
+            if not cut:
+                return
+            end = min(cut)
+            line = self.inbuf[:end].decode(errors="replace")
+            # treat \r\n as one line ending
+            skip = 2 if self.inbuf[end:end + 2] == b"\r\n" else 1
+            self.inbuf = self.inbuf[end + skip:]
+            self.handle_line(line.strip())
+
+    def handle_line(self, line):
+        if self.echo:
+            self.send(line + "\r\n", delay=0)
+        if not line:
+            self.send(self.prompt, delay=0)
+            return
+        words = line.split()
+        if self.dialect == ZEPHYR:
+            if words[0] != "ot":
+                self.shell_command(words)
+                return
+            words = words[1:]
+        if not words:
+            self.respond([])
+            return
+        handler = getattr(self, "cmd_" + words[0].replace("-", "_"), None)
+        try:
+            if handler is None:
+                raise CommandError(*INVALID_COMMAND)
+            lines = handler(words[1:])
+        except CommandError as e:
+            self.send(str(e) + "\r\n" + self.prompt)
+            return
+        if lines is not None:  # None: command answers later by itself
+            self.respond(lines)
+
+    # Zephyr shell commands that are not OpenThread CLI commands
+    def shell_command(self, words):
+        if words[0] == "version":
+            board = "nrf52840dk_nrf52840 NRF52840" if self.ttm else "nrf52840dk_nrf52840"
+            self.send("Zephyr version 3.5.0 (%s)\r\n" % board + self.prompt)
+        else:
+            self.send("%s: command not found\r\n" % words[0] + self.prompt)
+
+    def cmd_platform(self, args):
+        return [PLATFORMS[self.dialect]]
+
+    def cmd_version(self, args):
+        board = " NRF52840" if self.ttm else ""
+        return ["OPENTHREAD/thread-reference-20230706; %s%s; Jan  1 2024 00:00:00"
+                % (PLATFORMS[self.dialect], board)]
+
+    def cmd_state(self, args):
+        return [self.role]
+
+    def cmd_txpower(self, args):
+        if not args:
+            return ["%d dBm" % self.txpower]
+        try:
+            self.txpower = int(args[0])
+        except ValueError:
+            raise CommandError(*INVALID_ARGS)
+        return []
+
+    def cmd_mode(self, args):
+        if not args:
+            return [self.mode or "-"]
+        if args[0] != "-" and set(args[0]) - set("rdn"):
+            raise CommandError(*INVALID_ARGS)
+        self.mode = "" if args[0] == "-" else args[0]
+        return []
+
+    def cmd_routerselectionjitter(self, args):
+        if not args:
+            return [str(self.router_jitter)]
+        if not args[0].isdigit() or not 1 <= int(args[0]) <= 255:
+            raise CommandError(*INVALID_ARGS)
+        self.router_jitter = int(args[0])
+        return []
+
+    # baudrate [rate]: switch the UART once the answer has been sent. Not a
+    # stock CLI command; stands in for firmware that can change its rate.
+    def cmd_baudrate(self, args):
+        if not args:
+            return [str(self.baudrate)]
+        if not args[0].isdigit() or int(args[0]) not in SPEEDS:
+            raise CommandError(*INVALID_ARGS)
+        self.respond([])
+        self.farm.schedule(self.ready_at, setattr, self, "baudrate", int(args[0]))
+
+    def cmd_rloc16(self, args):
+        return ["%04x" % self.rloc16]
+
+    def cmd_extaddr(self, args):
+        return [self.ext_addr]
+
+    def cmd_router(self, args):
+        if args != ["table"]:
+            raise CommandError(*INVALID_ARGS)
+        rows = []
+        if self.role in ("router", "leader"):
+            for peer in sorted(self.farm.routers(self), key=lambda d: d.rloc16):
+                rid = peer.rloc16 >> 10
+                if peer is self:
+                    rows.append([rid, "0x%04x" % peer.rloc16, 63, 0, 0, 0, 0, peer.ext_addr, 0])
+                    continue
+                rssi = self.farm.link_rssi(self, peer)
+                lq = link_quality(rssi - NOISE_FLOOR)
+                rows.append([rid, "0x%04x" % peer.rloc16, 63, 1, lq, lq, 3, peer.ext_addr, 1])
+        return table(["ID", "RLOC16", "Next Hop", "Path Cost", "LQ In", "LQ Out", "Age",
+                      "Extended MAC    ", "Link"], rows)
+
+    def cmd_child(self, args):
+        if args != ["table"]:
+            raise CommandError(*INVALID_ARGS)
+        rows = []
+        for child in sorted(self.farm.children(self), key=lambda d: d.rloc16):
+            lq = link_quality(self.farm.link_rssi(self, child) - NOISE_FLOOR)
+            flags = ["1" if c in child.mode else "0" for c in "rdn"]
+            rows.append([child.rloc16 & 0x1FF, "0x%04x" % child.rloc16, 240, 5, lq, 0]
+                        + flags + [4, 0, 0, 129, child.ext_addr])
+        return table(["ID ", "RLOC16", "Timeout   ", "Age       ", "LQ In", "C_VN", "R", "D",
+                      "N", "Ver", "CSL", "QMsgCnt", "Suprvsn", "Extended MAC    "], rows)
+
+    def cmd_neighbor(self, args):
+        if args != ["table"]:
+            raise CommandError(*INVALID_ARGS)
+        if self.role == "child":
+            neighbors = [self.parent]
+        elif self.role in ("router", "leader"):
+            neighbors = [d for d in self.farm.routers(self) if d is not self]
+            neighbors += self.farm.children(self)
+        else:
+            neighbors = []
+        rows = []
+        for peer in sorted(neighbors, key=lambda d: d.rloc16):
+            rssi = self.farm.link_rssi(self, peer)
+            flags = ["1" if c in peer.mode else "0" for c in "rdn"]
+            rows.append(["C" if peer.role == "child" else "R", "0x%04x" % peer.rloc16, 3,
+                         rssi, rssi] + flags + [peer.ext_addr])
+        return table(["Role", "RLOC16", "Age", "Avg RSSI", "Last RSSI", "R", "D", "N",
+                      "Extended MAC    "], rows)
+
+    def cmd_leaderdata(self, args):
+        if not self.attached:
+            raise CommandError(*INVALID_STATE)
+        leader = self.farm.leader(self)
+        partition = int(hashlib.sha1(repr(self.network).encode()).hexdigest()[:8], 16)
+        return ["Partition ID: %d" % partition, "Weighting: 64", "Data Version: 1",
+                "Stable Data Version: 1",
+                "Leader Router ID: %d" % (leader.rloc16 >> 10 if leader else 63)]
+
+    # scan energy [duration], milliseconds per channel
+    def cmd_scan(self, args):
+        if args[:1] != ["energy"]:
+            raise CommandError(*INVALID_ARGS)
+        if not self.if_up:
+            raise CommandError(*INVALID_STATE)
+        try:
+            duration = int(args[1]) if len(args) > 1 else 300
+        except ValueError:
+            raise CommandError(*INVALID_ARGS)
+        channels = range(11, 27)
+        rows = [[channel, self.farm.channel_energy(self, channel)] for channel in channels]
+        self.send("\r\n".join(table(["Ch", "RSSI"], rows)) + "\r\nDone\r\n" + self.prompt,
+                  delay=len(channels) * duration / 1000.0)
+
+    # udp open | close | bind <address> <port> | send <address> <port> <text>
+    def cmd_udp(self, args):
+        if not args:
+            raise CommandError(*INVALID_ARGS)
+        if args[0] == "open":
+            if self.udp_port is not None:
+                raise CommandError(*INVALID_STATE)
+            self.udp_port = 0
+            return []
+        if self.udp_port is None:
+            raise CommandError(*INVALID_STATE)
+        if args[0] == "close":
+            self.udp_port = None
+            return []
+        if args[0] == "bind" and len(args) == 3 and args[2].isdigit():
+            self.udp_port = int(args[2])
+            return []
+        if args[0] == "send" and len(args) >= 4 and args[2].isdigit():
+            if not self.attached:
+                raise CommandError(*INVALID_STATE)
+            self.farm.deliver(self, args[1], int(args[2]), " ".join(args[3:]))
+            return []
+        raise CommandError(*INVALID_ARGS)
+
+    def cmd_ipaddr(self, args):
+        return self.addresses()
+
+    def cmd_ifconfig(self, args):
+        if not args:
+            return ["up" if self.if_up else "down"]
+        if args[0] == "up":
+            self.if_up = True
+        elif args[0] == "down":
+            if self.thread_on:
+                raise CommandError(*INVALID_STATE)
+            self.if_up = False
+        else:
+            raise CommandError(*INVALID_ARGS)
+        return []
+
+    def cmd_thread(self, args):
+        if not args:
+            raise CommandError(*INVALID_ARGS)
+        if args[0] == "start":
+            if not self.if_up or not self.active:
+                raise CommandError(*INVALID_STATE)
+            if not self.thread_on:
+                self.thread_on = True
+                self.farm.set_role(self, "detached")
+                self.farm.schedule_attach(self)
+        elif args[0] == "stop":
+            self.thread_on = False
+            self.farm.set_role(self, "disabled")
+        else:
+            raise CommandError(*INVALID_ARGS)
+        return []
+
+    def cmd_dataset(self, args):
+        if not args:
+            raise CommandError(*INVALID_ARGS)
+        fields = ("channel", "panid", "networkkey", "networkname", "extpanid",
+                  "meshlocalprefix")
+        if args[0] == "init" and args[1:] == ["new"]:
+            seed = random.Random(self.index)
+            self.pending = {
+                "channel": str(seed.randint(11, 26)),
+                "panid": "0x%04x" % seed.randint(0, 0xFFFE),
+                "networkkey": "%032x" % seed.getrandbits(128),
+                "networkname": "OpenThread-%04x" % seed.getrandbits(16),
+                "extpanid": "%016x" % seed.getrandbits(64),
+                "meshlocalprefix": MESH_LOCAL_PREFIX,
+            }
+            return []
+        if args[0] == "commit" and args[1:] == ["active"]:
+            active = dict(self.active or {}, **self.pending)
+            if not all(active.get(f) for f in ("channel", "panid", "networkkey")):
+                raise CommandError(*INVALID_STATE)
+            self.active = active
+            self.pending = {}
+            return []
+        if args[0] == "set" and len(args) == 3 and args[1] == "active":
+            try:
+                fields = dataset.parse_dataset(args[2])
+            except ValueError:
+                raise CommandError(*INVALID_ARGS)
+            fields.pop("timestamp", None)
+            fields.pop("pskc", None)
+            self.active = fields
+            return []
+        if args[0] == "active" and args[1:] == ["-x"]:
+            if not self.active:
+                return []
+            try:
+                return [dataset.build_dataset(**self.active)]
+            except (TypeError, ValueError):
+                raise CommandError(*INVALID_STATE)
+        if args[0] == "active" and not args[1:]:
+            if not self.active:
+                return []
+            names = {
+                "channel": "Channel", "extpanid": "Ext PAN ID",
+                "meshlocalprefix": "Mesh Local Prefix", "networkkey": "Network Key",
+                "networkname": "Network Name", "panid": "PAN ID",
+            }
+            lines = ["Active Timestamp: 1"]
+            for field in sorted(names):
+                if field in self.active:
+                    value = self.active[field]
+                    if field == "meshlocalprefix":
+                        value += "::/64"
+                    lines.append("%s: %s" % (names[field], value))
+            return lines
+        if args[0] in fields:
+            if len(args) != 2:
+                raise CommandError(*INVALID_ARGS)
+            value = args[1]
+            if args[0] == "channel" and not (value.isdigit() and 11 <= int(value) <= 26):
+                raise CommandError(*INVALID_ARGS)
+            if args[0] == "networkkey" and len(value) != 32:
+                raise CommandError(*INVALID_ARGS)
+            self.pending[args[0]] = value
+            return []
+        raise CommandError(*INVALID_ARGS)
+
+    def cmd_reset(self, args):
+        self.thread_on = False
+        self.farm.set_role(self, "disabled")
+        self.reset()
+        self.send(self.prompt, delay=0.05)
+
+    def cmd_factoryreset(self, args):
+        self.cmd_reset(args)
+        self.factory_reset()
+
+    # ping <address> [size] [count] [interval] [hoplimit] [timeout]
+    def cmd_ping(self, args):
+        if not args:
+            raise CommandError(*INVALID_ARGS)
+        try:
+            size = int(args[1]) if len(args) > 1 else 8
+            count = int(args[2]) if len(args) > 2 else 1
+            interval = float(args[3]) if len(args) > 3 else 1.0
+            timeout = float(args[5]) if len(args) > 5 else self.farm.ping_timeout
+        except ValueError:
+            raise CommandError(*INVALID_ARGS)
+        address = args[0]
+        target = self.farm.find_address(address)
+        received = []
+        start = time.monotonic()
+        for seq in range(1, count + 1):
+            rtt = self.farm.link_rtt(self, target)
+            if rtt is None:
+                continue
+            received.append(rtt)
+            at = start + (seq - 1) * interval + rtt / 1000.0
+            self.farm.schedule(at, self.write, (
+                "%d bytes from %s: icmp_seq=%d hlim=64 time=%dms\r\n"
+                % (size + 8, address, seq, rtt)).encode())
+        last = start + (count - 1) * interval
+        end = last + (max(received) / 1000.0 if len(received) == count else timeout)
+        loss = 100.0 * (count - len(received)) / count
+        stats = "%d packets transmitted, %d packets received. Packet loss = %.1f%%." % (
+            count, len(received), loss)
+        if received:
+            stats += " Round-trip min/avg/max = %d/%.1f/%d ms." % (
+                min(received), sum(received) / len(received), max(received))
+        self.ready_at = max(self.ready_at, end)
+        self.farm.schedule(end, self.write, (stats + "\r\nDone\r\n" + self.prompt).encode())
+
+    def close(self):
+        for fd in (self.master_fd, self.slave_fd):
+            try:
+                os.close(fd)
+            except OSError:
+                pass
+
+
+# Some kernels' ptys drop the parity flags or refuse even parity, in which
+# case a device can't tell the parity the host uses
+def pty_keeps_parity():
+    master_fd, slave_fd = os.openpty()
+    try:
+        attributes = termios.tcgetattr(slave_fd)
+        attributes[2] |= termios.PARENB
+        attributes[2] &= ~termios.PARODD
+        termios.tcsetattr(slave_fd, termios.TCSANOW, attributes)
+        return bool(termios.tcgetattr(slave_fd)[2] & termios.PARENB)
+    except termios.error:
+        return False
+    finally:
+        os.close(master_fd)
+        os.close(slave_fd)
+
+
+# A set of virtual devices served by one background thread
+class DeviceFarm:
+    def __init__(self, count, dialect=EFR32, echo=True, latency=0.002, jitter=0.0,
+                 attach_delay=0.2, link_rtt=20, ping_timeout=3.0, ttm=False, seed=None,
+                 logs=False, upgrade_scale=0.0, baudrate=115200, parity="N",
+                 serial_timing=False):
+        self.random = random.Random(seed)
+        # with serial_timing, output takes as long as the UART needs to send it
+        self.serial_timing = serial_timing
+        self.check_parity = pty_keeps_parity()
+        self.logs = logs  # print a log line on every role change
+        self.attach_delay = attach_delay
+        # FTDs joining a network first attach as children and become routers
+        # after up to routerselectionjitter * upgrade_scale seconds; with 0
+        # they become routers straight away
+        self.upgrade_scale = upgrade_scale
+        self.rtt = link_rtt  # ms between any two attached devices
+        # background energy per channel, with a few channels crowded by
+        # other radios
+        self.noise = {channel: -100 + self.random.randint(0, 8) for channel in range(11, 27)}
+        for channel in self.random.sample(range(11, 27), 4):
+            self.noise[channel] = -75 + self.random.randint(0, 20)
+        self.ping_timeout = ping_timeout
+        self.queue = []
+        self.air_free = {}  # network -> time its channel is next idle
+        self.counter = itertools.count()
+        self.lock = threading.Lock()
+        self.selector = selectors.DefaultSelector()
+        self.running = False
+        self.thread = None
+        dialects = [dialect] * count if isinstance(dialect, str) else list(dialect)
+        baudrates = [baudrate] * count if isinstance(baudrate, int) else list(baudrate)
+        self.devices = [
+            VirtualDevice(self, i, dialects[i], echo, latency, jitter,
+                          ttm=(ttm and i == count - 1), baudrate=baudrates[i], parity=parity)
+            for i in range(count)
+        ]
+        for device in self.devices:
+            self.selector.register(device.master_fd, selectors.EVENT_READ, device)
+
+    @property
+    def ports(self):
+        return [device.port for device in self.devices]
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+        if self.thread:
+            self.thread.join()
+        self.selector.close()
+        for device in self.devices:
+            device.close()
+
+    # Call function(*args) on the farm thread at monotonic time `at`
+    def schedule(self, at, function, *args):
+        with self.lock:
+            heapq.heappush(self.queue, (at, next(self.counter), function, args))
+
+    def run(self):
+        while self.running:
+            now = time.monotonic()
+            with self.lock:
+                due = []
+                while self.queue and self.queue[0][0] <= now:
+                    due.append(heapq.heappop(self.queue))
+                wait = self.queue[0][0] - now if self.queue else 0.05
+            for _, _, function, args in due:
+                function(*args)
+            if due:
+                continue
+            for key, _ in self.selector.select(min(max(wait, 0), 0.05)):
+                try:
+                    data = os.read(key.fd, 4096)
+                except OSError:
+                    continue
+                if data:
+                    key.data.receive(data)
+
+    def set_role(self, device, role):
+        if self.logs and role != device.role:
+            device.send("[%012.3f] <inf> net_l2_openthread: Role changed: %s -> %s\r\n"
+                        % (time.monotonic(), device.role, role), delay=0)
+        device.role = role
+        if role in ("disabled", "detached"):
+            device.rloc16 = 0xFFFE
+            device.parent = None
+
+    def schedule_attach(self, device):
+        gen = device.attach_gen
+        at = time.monotonic() + self.attach_delay * (0.5 + self.random.random())
+        self.schedule(at, self.attach, device, gen)
+
+    # Join the device's network, or form it if it is an FTD and no leader exists
+    def attach(self, device, gen):
+        if device.attach_gen != gen or not device.thread_on or device.attached:
+            return
+        peers = [d for d in self.devices if d is not device and d.attached
+                 and d.network == device.network]
+        leader = next((d for d in peers if d.role == "leader"), None)
+        if leader is None:
+            if "d" in device.mode:
+                self.set_role(device, "leader")
+                device.rloc16 = self.router_id(device, peers) << 10
+            else:
+                self.schedule_attach(device)  # MTDs wait for a leader
+            return
+        if "d" in device.mode and not self.upgrade_scale:
+            self.set_role(device, "router")
+            device.rloc16 = self.router_id(device, peers) << 10
+        else:
+            parents = [d for d in peers if d.role in ("router", "leader")]
+            parent = parents[device.index % len(parents)]
+            children = [d for d in peers if d.parent is parent]
+            self.set_role(device, "child")
+            device.parent = parent
+            device.rloc16 = parent.rloc16 | (len(children) + 1)
+            if "d" in device.mode:
+                delay = self.random.random() * device.router_jitter * self.upgrade_scale
+                self.schedule(time.monotonic() + delay, self.upgrade, device, gen)
+
+    # REED becoming a router once its router selection jitter has passed
+    def upgrade(self, device, gen):
+        if device.attach_gen != gen or device.role != "child":
+            return
+        peers = [d for d in self.devices if d is not device and d.attached
+                 and d.network == device.network]
+        self.set_role(device, "router")
+        device.parent = None
+        device.rloc16 = self.router_id(device, peers) << 10
+
+    def router_id(self, device, peers):
+        used = {d.rloc16 >> 10 for d in peers if d.role in ("router", "leader")}
+        return next(i for i in range(63) if i not in used)
+
+    # Attached devices on the same network as `device`, itself included
+    def partition(self, device):
+        return [d for d in self.devices if d.attached and d.network == device.network]
+
+    def routers(self, device):
+        return [d for d in self.partition(device) if d.role in ("router", "leader")]
+
+    def children(self, device):
+        return [d for d in self.devices if d.parent is device and d.role == "child"]
+
+    def leader(self, device):
+        return next((d for d in self.partition(device) if d.role == "leader"), None)
+
+    # Strength in dBm at which `receiver` hears `sender`: the sender's
+    # txpower less a path loss that is the same both ways and stable for the
+    # life of the farm
+    def link_rssi(self, receiver, sender):
+        a, b = sorted((receiver.index, sender.index))
+        loss = 35 + int(hashlib.sha1(b"%d-%d" % (a, b)).hexdigest()[:4], 16) % 60
+        return sender.txpower - loss
+
+    # Energy in dBm a device measures on a channel: the site's background
+    # plus a few dB that depend on where the device is
+    def channel_energy(self, device, channel):
+        spread = int(hashlib.sha1(b"%d-%d" % (device.index, channel)).hexdigest()[:2], 16) % 6
+        return self.noise[channel] + spread
+
+    def find_address(self, address):
+        address = address.lower()
+        for device in self.devices:
+            if address in device.addresses():
+                return device
+        return None
+
+    # Send a UDP datagram over the simulated air. Every network shares one
+    # channel, so datagrams queue for airtime and are dropped once the queue
+    # is longer than MAX_QUEUE_DELAY: a mesh has a capacity to find.
+    def deliver(self, source, address, port, payload):
+        target = self.find_address(address)
+        now = time.monotonic()
+        with self.lock:
+            start = max(now, self.air_free.get(source.network, now))
+            if start - now > MAX_QUEUE_DELAY:
+                return
+            done = start + (len(payload) + FRAME_OVERHEAD) / AIR_RATE
+            self.air_free[source.network] = done
+        rtt = self.link_rtt(source, target)
+        if rtt is None or target.udp_port != port:
+            return
+        line = "%d bytes from %s %d %s\r\n" % (
+            len(payload), source.addresses()[0], source.udp_port or 49152 + source.index, payload)
+        self.schedule(done + rtt / 2000.0, target.write, line.encode())
+
+    # Round trip time in ms between two devices, or None if unreachable
+    def link_rtt(self, source, target):
+        if target is None or not source.attached or not target.attached:
+            return None
+        if source.network != target.network:
+            return None
+        return max(1, int(self.rtt * (0.8 + 0.4 * self.random.random())))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Simulated OpenThread CLI devices on ptys")
+    parser.add_argument("count", type=int, nargs="?", default=4)
+    parser.add_argument("--dialect", choices=[ZEPHYR, EFR32], default=EFR32)
+    parser.add_argument("--no-echo", action="store_true")
+    parser.add_argument("--latency", type=float, default=0.002, help="seconds")
+    parser.add_argument("--jitter", type=float, default=0.0, help="seconds")
+    parser.add_argument("--ttm", action="store_true", help="make the last device a TTM")
+    parser.add_argument("--logs", action="store_true", help="print role changes as log lines")
+    parser.add_argument("--upgrade-scale", type=float, default=0.0,
+                        help="scale of the child to router upgrade delay, 1.0 for real time")
+    parser.add_argument("--baudrate", type=int, choices=sorted(SPEEDS), default=115200)
+    parser.add_argument("--parity", choices=["N", "E", "O"], default="N")
+    parser.add_argument("--serial-timing", action="store_true",
+                        help="deliver output no faster than the baud rate allows")
+    args = parser.parse_args()
+    farm = DeviceFarm(args.count, args.dialect, not args.no_echo, args.latency,
+                      args.jitter, ttm=args.ttm, logs=args.logs,
+                      upgrade_scale=args.upgrade_scale, baudrate=args.baudrate,
+                      parity=args.parity, serial_timing=args.serial_timing)
+    with farm:
+        for device in farm.devices:
+            print(device.port + " | " + PLATFORMS[device.dialect])
+        try:
+            while True:
+                time.sleep(1)
+        except KeyboardInterrupt:
+            pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,131 @@
+from async_device import broadcast
+from ot_serial import response_lines
+from topology import parse_table
+
+# IEEE 802.15.4 channels Thread can use
+CHANNELS = range(11, 27)
+# Milliseconds each channel is measured for by "scan energy"
+SCAN_DURATION = 300
+# Margin in dB above the channel's energy that every link should keep when
+# txpower is planned
+TARGET_MARGIN = 20
+# txpower the radios accept, in dBm
+MIN_TXPOWER = -40
+MAX_TXPOWER = 8
+
+
+def scan_command(duration=SCAN_DURATION):
+    return "scan energy %d" % duration
+
+
+# Seconds a device takes to scan every channel, with time to spare
+def scan_timeout(duration=SCAN_DURATION):
+    return len(CHANNELS) * duration / 1000.0 + 2.0
+
+
+# "scan energy" output as {channel: rssi}
+def parse_energy(lines):
+    energy = {}
+    for row in parse_table(lines):
+        try:
+            energy[int(row["Ch"])] = int(row["RSSI"])
+        except (KeyError, ValueError):
+            pass
+    return energy
+
+
+# Scan every device at the same time, so the survey takes one scan however
+# many devices there are. The interfaces are brought up first, as the radio
+# can't scan otherwise. Returns {port: {channel: rssi}}, devices that
+# couldn't scan left out.
+async def scan(devices, duration=SCAN_DURATION):
+    await broadcast(devices, "ifconfig up")
+    command = scan_command(duration)
+    responses = await broadcast(devices, command, scan_timeout(duration))
+    scans = {}
+    for device, response in zip(devices, responses):
+        energy = parse_energy(response_lines(response, command))
+        if energy:
+            scans[device.port] = energy
+    return scans
+
+
+# Fleet-wide energy per channel, {channel: {"max", "avg", "devices"}}. The
+# loudest reading counts most, as the mesh has to work where it is worst.
+def aggregate(scans):
+    summary = {}
+    for channel in CHANNELS:
+        readings = [energy[channel] for energy in scans.values() if channel in energy]
+        if readings:
+            summary[channel] = {"max": max(readings),
+                                "avg": round(sum(readings) / len(readings), 1),
+                                "devices": len(readings)}
+    return summary
+
+
+# Least congested channel: lowest loudest reading, then lowest average
+def best_channel(summary):
+    if not summary:
+        return None
+    return min(summary, key=lambda channel: (summary[channel]["max"], summary[channel]["avg"], channel))
+
+
+def clamp_txpower(txpower):
+    return max(MIN_TXPOWER, min(MAX_TXPOWER, txpower))
+
+
+# txpower argument of a console command, None if it isn't a whole number of
+# dBm the radios accept
+def parse_txpower(text):
+    try:
+        txpower = int(text)
+    except ValueError:
+        return None
+    return txpower if MIN_TXPOWER <= txpower <= MAX_TXPOWER else None
+
+
+# txpower per role, {"ftd": dBm, "mtd": dBm}, that leaves the weakest link of
+# each kind TARGET_MARGIN dB above `noise`. Links come from a topology
+# snapshot taken with the roles at `current` txpower: router links are sent
+# at the FTD power and child links mostly at the MTD power. A role without
+# measured links keeps its current power.
+def plan_txpower(snapshot, noise, current):
+    planned = {}
+    for role, kind in (("ftd", "router"), ("mtd", "child")):
+        margins = [edge["rssi"] - noise for (a, b, edge_kind), edge in
+                   (snapshot["edges"].items() if snapshot else [])
+                   if edge_kind == kind and edge["rssi"] is not None]
+        if margins:
+            planned[role] = clamp_txpower(current[role] + TARGET_MARGIN - min(margins))
+        else:
+            planned[role] = current[role]
+    return planned
+
+
+# Survey result: the per-channel summary and the recommended settings,
+# {"summary", "channel", "noise", "txpower", "devices"}
+def recommend(scans, snapshot, current):
+    summary = aggregate(scans)
+    channel = best_channel(summary)
+    noise = summary[channel]["max"] if channel else None
+    txpower = plan_txpower(snapshot, noise, current) if channel else dict(current)
+    return {"summary": summary, "channel": channel, "noise": noise, "txpower": txpower,
+            "devices": len(scans)}
+
+
+def format_survey(survey):
+    if survey["channel"] is None:
+        return "no device could scan"
+    lines = ["ch | max dBm | avg dBm"]
+    for channel, entry in sorted(survey["summary"].items()):
+        mark = " <" if channel == survey["channel"] else ""
+        lines.append("%d | %d | %g%s" % (channel, entry["max"], entry["avg"], mark))
+    lines.append("%d devices scanned, channel %d is the least congested (%d dBm)"
+                 % (survey["devices"], survey["channel"], survey["noise"]))
+    lines.append("txpower: FTD %d dBm, MTD %d dBm" % (survey["txpower"]["ftd"], survey["txpower"]["mtd"]))
+    return "\n".join(lines)
+
+
+async def survey(devices, snapshot=None, current=None, duration=SCAN_DURATION):
+    scans = await scan(devices, duration)
+    return recommend(scans, snapshot, current or {"ftd": 0, "mtd": 0})
@@ -14,18 +14,31 @@ Expanded on 15 May 2024
 '''
 
 
-import serial
+import os
 import time
-import os.path
+import threading
+from ot_serial import read_response, response_lines, response_ok, run_batch, SerialPool
+from concurrent.futures import ThreadPoolExecutor
+import discovery
+import hotplug
+import bringup
+import dataset
+import reconcile
+import topology
+import survey
+from watch import NetworkWatch
+from metrics import stats_command
+from recorder import record_command
+from health import health, health_command
 
 
 
 NETWORKKEY = '00112233445566778899aabbccddeeff'
-CHANNEL = '15'
+CHANNEL = os.environ.get('OT_CHANNEL', '15')
 PANID = '0xabcd'
 
-FTD_TXPOWER = 0 # dBm
-MTD_TXPOWER = -40 # dBm
+FTD_TXPOWER = int(os.environ.get('OT_FTD_TXPOWER', 0)) # dBm
+MTD_TXPOWER = int(os.environ.get('OT_MTD_TXPOWER', -40)) # dBm
 
 
 PING_TARGET_IPADDR = 'fe80:0:0:0:98fc:1b54:7b61:991a'
@@ -33,7 +46,7 @@ PING_TARGET_IPADDR = 'fe80:0:0:0:98fc:1b54:7b61:991a'
 
 class ThreadConsole:
     
-    def __init__(self, channel, panid, networkkey):  
+    def __init__(self, channel, panid, networkkey, ftdTxPower=FTD_TXPOWER, mtdTxPower=MTD_TXPOWER):  
         self.noOfFoundDevices = 0
         self.threadDevices = []
         self.zephyrDevices = []
@@ -41,96 +54,185 @@ class ThreadConsole:
         self.channel = channel
         self.panid = panid
         self.networkkey = networkkey
+        self.ftdTxPower = ftdTxPower
+        self.mtdTxPower = mtdTxPower
+        # serial connections shared by all operations, opened once per device
+        self.pool = SerialPool(baudrate=115200, timeout=0.1, write_timeout=1.0)
+        # configuration last applied to each device
+        self.reconciler = reconcile.Reconciler()
+        # last mesh snapshot, to report only the links that changed
+        self.topology = topology.Topology()
+        # follows boards being plugged in and out once started
+        self.monitor = None
+        self.lock = threading.Lock()
         
-    def readSerial(self, com):
-        data = com.read(200)     
-        return data.decode('utf-8')
+    # read until the device has finished answering (Done, Error or prompt)
+    def readSerial(self, com, cmd="", timeout=None):
+        return read_response(com, cmd, timeout)
         
     def writeSerial(self, com, x):
         com.write(bytes(x, 'utf-8'))
         com.flush()
                
+    # write a command and read the answer, sending it again if the device
+    # doesn't answer; quarantined devices return "" straight away
     def writeReadSerial(self, com, x):
-        self.writeSerial(com, x)  
         if x in self.efr32Devices:
             com.replace('ot ', '')
-        com.readline() # ignore echo'd line    
-        return self.readSerial(com)
+
+        def send(timeout):
+            com.reset_input_buffer() # drop output left by an abandoned attempt
+            self.writeSerial(com, x)
+            return self.readSerial(com, x, timeout)
+        return health.run(com.port, x, send)
         
     def printSerial(self,com):
         com.readline() # ignore fist line (echo'd line)             
         r = com.read(80) # upto 10 lines
         print (r.decode("utf-8"))     
         
-    def findOtDevices(self):
+    # probe all ttys at once, re-verifying cached boards instead of reprobing.
+    # While the hotplug monitor runs the device lists are already up to date.
+    def findOtDevices(self, refresh=False, patterns=None):
+        if(self.monitor and not refresh and patterns is None):
+            return self.noOfFoundDevices
         print("searching...")
-        ttydev = "/dev/ttyACM"         
-        self.noOfFoundDevices = 0       
-        self.threadDevices = []
-        for i in range(1, 20, 1):
-            dev = ttydev + str(i)
-            if(os.path.exists(dev)):
-                #print ("%s exists!" % dev)finf
-                try:             
-                    # check if we can open it
-                    with serial.Serial(dev, baudrate=115200, timeout=0.1, write_timeout=1.0) as ser:
-                     
-                            rcv = self.writeReadSerial(ser,"ot platform\r\n")                            
-                            if(rcv.find("Zephyr") != -1):       
-                                print(r"found nRF board")                        
-                                self.threadDevices.append(dev)
-                                self.zephyrDevices.append(dev)
-                                self.noOfFoundDevices += 1
-                            rcv = self.writeReadSerial(ser,"platform\r\n")                            
-                            if(rcv.find("EFR32") != -1):       
-                                print(r"found EFR32 board")                        
-                                self.threadDevices.append(dev)
-                                self.efr32Devices.append(dev)
-                                self.noOfFoundDevices += 1
-                except:
-                    continue
+        with self.lock:
+            self.noOfFoundDevices = 0       
+            self.threadDevices = []
+            self.zephyrDevices = []
+            self.efr32Devices = []
+        for entry in discovery.discover(self.pool, patterns, refresh):
+            self.deviceAdded(entry)
         return self.noOfFoundDevices
 
+    # add a discovered board to the device lists. The lists are replaced
+    # rather than changed so that loops over them aren't disturbed.
+    def deviceAdded(self, entry):
+        dev = entry["port"]
+        with self.lock:
+            if(dev in self.threadDevices):
+                return
+            if(entry["platform"] == discovery.NRF_PLATFORM):
+                print(r"found nRF board")                        
+                self.zephyrDevices = self.zephyrDevices + [dev]
+            elif(entry["platform"] == discovery.SLABS_PLATFORM):
+                print(r"found EFR32 board")                        
+                self.efr32Devices = self.efr32Devices + [dev]
+            else:
+                return
+            self.threadDevices = self.threadDevices + [dev]
+            self.noOfFoundDevices = len(self.threadDevices)
+
+    def deviceRemoved(self, entry):
+        dev = entry["port"]
+        with self.lock:
+            if(dev not in self.threadDevices):
+                return
+            print("[%s] removed" % dev)
+            self.threadDevices = [d for d in self.threadDevices if d != dev]
+            self.zephyrDevices = [d for d in self.zephyrDevices if d != dev]
+            self.efr32Devices = [d for d in self.efr32Devices if d != dev]
+            self.noOfFoundDevices = len(self.threadDevices)
+        self.reconciler.forget(dev)
+
+    # probe the ttys once, then follow boards being plugged in and out
+    def startHotplug(self, patterns=None):
+        print("searching...")
+        self.monitor = hotplug.HotplugMonitor(self.pool, patterns, self.deviceAdded, self.deviceRemoved)
+        for entry in self.monitor.start():
+            self.deviceAdded(entry)
+        return self.noOfFoundDevices
 
-    def configDevice(self, device, otCmds):   
-        with serial.Serial(device, baudrate=115200, timeout=0.1, write_timeout=1.0) as ser:
-            self.readSerial(ser) # flush read buf
-            for cmd in otCmds:
-                try:    
-                    #print(cmd)              
-                    rcv = self.writeReadSerial(ser, cmd + "\r\n")   
-                    #print(rcv) 
-                    time.sleep(0.1)               
-                except:
-                    return -1
-        return 0
+    def stopHotplug(self):
+        if(self.monitor):
+            self.monitor.stop()
+            self.monitor = None
 
 
-    def configDeviceAsRouter(self,device, txPower):
+    # send all commands in one pipelined batch, report any that failed
+    def configDevice(self, device, otCmds):   
+        if not health.available(device):
+            print("[%s] quarantined, not configured" % device)
+            return -1
+        start = time.monotonic()
+        try:
+            with self.pool.connection(device) as ser:
+                ser.reset_input_buffer() # flush read buf
+                results = run_batch(ser, otCmds)
+        except Exception as e:
+            self.pool.close(device) # reopen on next use
+            health.failure(device, "%s: %s" % (type(e).__name__, e))
+            # carry on one command at a time so the rest still get sent
+            results = [self.configCommand(device, cmd) for cmd in otCmds]
+        else:
+            health.batch(device, results, time.monotonic() - start)
+        failed = 0
+        for cmd, rcv, ok in results:
+            if not ok:
+                print("[%s] '%s' failed: %s" % (device, cmd.strip(), rcv.strip() or "no response"))
+                failed = -1
+        return failed
+
+
+    def configCommand(self, device, cmd):
+        if not cmd.strip():
+            return (cmd, "", True)
+        try:
+            with self.pool.connection(device) as ser:
+                rcv = self.writeReadSerial(ser, cmd + "\r\n")
+        except Exception as e:
+            self.pool.close(device)
+            rcv = "%s: %s" % (type(e).__name__, e)
+        return (cmd, rcv, response_ok(rcv))
+
+
+    # active dataset as a TLV hex string, raises ValueError on bad settings
+    def datasetTlvs(self):
+        return dataset.build_dataset(self.channel, self.panid, self.networkkey)
+
+
+    # read the device's settings and send only those that differ, or all
+    # of them with force
+    def reconcileDevice(self, device, mode, txPower, force=False):
+        desired = reconcile.desired_state(self.datasetTlvs(), mode, txPower)
+        cmds = reconcile.diff_commands(reconcile.UNKNOWN_STATE, desired)
+        if not health.available(device):
+            print("[%s] quarantined, not configured" % device)
+            return -1
+        if not force:
+            start = time.monotonic()
+            try:
+                with self.pool.connection(device) as ser:
+                    results = run_batch(ser, [""] + ["ot " + c for c in reconcile.READ_COMMANDS])
+            except Exception as e:
+                self.pool.close(device) # reopen on next use
+                health.failure(device, "%s: %s" % (type(e).__name__, e))
+                return -1
+            health.batch(device, results, time.monotonic() - start)
+            if not health.available(device):
+                print("[%s] quarantined, not configured" % device)
+                return -1
+            current = reconcile.current_state([response_lines(rcv, cmd) for cmd, rcv, ok in results[1:]])
+            cmds, note = self.reconciler.plan(device, current, desired)
+            if(note):
+                print("[%s] %s" % (device, note))
+        if not cmds:
+            return 0
+        failed = self.configDevice(device, [""] + ["ot " + c for c in cmds])
+        if not failed:
+            self.reconciler.applied(device, desired)
+        return failed
+
+
+    def configDeviceAsRouter(self,device, txPower, force=False):
         print("[%s] configured as FTD" %device)
-        otCmds = []   
-        otCmds.append("")
-        otCmds.append("ot txpower " + str(txPower))
-        otCmds.append("ot mode rdn")
-        otCmds.append("ot mode dataset init new")        
-        otCmds.append("ot dataset channel " + self.channel)
-        otCmds.append("ot dataset networkkey " + self.networkkey)
-        otCmds.append("ot dataset panid " + self.panid)
-        otCmds.append("ot dataset commit active")
-        self.configDevice(device, otCmds)
+        return self.reconcileDevice(device, "rdn", txPower, force)
     
     
-    def configDeviceAsChild(self,device, txPower):
+    def configDeviceAsChild(self,device, txPower, force=False):
         print("[%s] configured as MTD" %device)
-        otCmds = []   
-        otCmds.append("\r\n")
-        otCmds.append("ot txpower " + str(txPower))
-        otCmds.append("ot mode rn")
-        otCmds.append("ot dataset channel " + self.channel)
-        otCmds.append("ot dataset networkkey " + self.networkkey)
-        otCmds.append("ot dataset panid " + self.panid)
-        otCmds.append("ot dataset commit active")
-        self.configDevice(device, otCmds)
+        return self.reconcileDevice(device, "rn", txPower, force)
 
 
     def softReset(self, device):
@@ -164,39 +266,67 @@ class ThreadConsole:
             return -1  
         return 0
               
-    def startAll(self):                                         
-        for device in self.threadDevices:
-            with serial.Serial(device, baudrate=115200, timeout=0.1, write_timeout=1.0) as ser:  
+    # bring the network up in stages: leader, then routers, then children,
+    # each stage waiting until its devices have attached
+    def startAll(self):
+        devices = [dev for dev in self.threadDevices if health.available(dev)]
+        with ThreadPoolExecutor(max_workers=max(1, len(devices))) as pool:
+            modes = list(pool.map(self.getDeviceMode, devices))
+        leader, routers, children = bringup.plan(devices, [bringup.is_ftd(mode) for mode in modes])
+        if(leader is None):
+            print("no FTD to form the network, configure thread devices first!")
+            return None
+
+        def start(device):
+            with self.pool.connection(device) as ser:
+                if(device in routers):
+                    self.writeReadSerial(ser, "ot routerselectionjitter %d\r\n" % bringup.ROUTER_SELECTION_JITTER)
                 if(self.start(ser)):
-                    print("failed to start %d thread device!" % device)
-                time.sleep(0.1)
-
-    def stopAll(self):                                         
-        for device in self.threadDevices:
-            with serial.Serial(device, baudrate=115200, timeout=0.1, write_timeout=1.0) as ser:  
-                if(self.stop(ser)):
-                    print("failed to stop %d thread device!" % device)
-                time.sleep(0.1)
+                    print("failed to start %s thread device!" % device)
+                    return False
+            return True
+
+        report = bringup.BringUp(start, self.getDeviceState).run(leader, routers, children)
+        print(bringup.format_report(report))
+        if(health.report()):
+            print(health.format_report())
+        return report
+
+    # stop every device at once; a device that fails doesn't hold up the rest
+    def stopAll(self):
+        def stop(device):
+            if not health.available(device):
+                return
+            try:
+                with self.pool.connection(device) as ser:  
+                    if(self.stop(ser)):
+                        print("failed to stop %s thread device!" % device)
+            except Exception as e:
+                print("failed to stop %s thread device: %s" % (device, e))
+
+        with ThreadPoolExecutor(max_workers=max(1, len(self.threadDevices))) as pool:
+            list(pool.map(stop, self.threadDevices))
+        if(health.report()):
+            print(health.format_report())
                 
     def softResetAllDevices(self):
         for device in self.threadDevices:
-            with serial.Serial(device, baudrate=115200, timeout=0.1, write_timeout=1.0) as ser:  
-                self.softReset(ser)
+            self.softReset(device)
 
     def softRestartAllDevices(self):
         for device in self.threadDevices:
-            with serial.Serial(device, baudrate=115200, timeout=0.1, write_timeout=1.0) as ser:  
+            with self.pool.connection(device) as ser:  
                 self.softRestart(ser)
                         
         
     def resetAllDevices(self):
         print("resetting network devices...")
         for device in self.threadDevices:
-            with serial.Serial(device, baudrate=115200, timeout=0.1) as ser:   
+            with self.pool.connection(device) as ser:   
                 self.writeSerial(ser, "\r\not reset\r\n")               
         time.sleep(5)
         for device in self.threadDevices:
-            with serial.Serial(device, baudrate=115200, timeout=0.1) as ser:                 
+            with self.pool.connection(device) as ser:                 
                 self.writeSerial(ser, "\r\n")  
  
     def hardResetAllDevices(self):  
@@ -208,66 +338,140 @@ class ThreadConsole:
         if(device == 'none'):
             print("unable to find TTM device!")
             return       
-        with serial.Serial(device, baudrate=115200, timeout=0.1) as ser:
+        with self.pool.connection(device) as ser:
             self.writeSerial(ser, "\r\not txpower " + txpower + "\r\n")  
                             
             
+    def getDeviceState(self, device):
+        with self.pool.connection(device) as ser:        
+            r = self.writeReadSerial(ser, "ot state\r\n")           
+        r = r.replace("uart:~$", '')
+        r = r.replace("ot state", '')            
+        r = r.replace("Done",'')
+        r = r.strip()                    
+        s = "unknwown"
+        if(r.find("child") != -1):
+            s = "child"
+        if(r.find("disabled") != -1):
+            s = "disabled"
+        if(r.find("detached") != -1):
+            s = "detached"
+        if(r.find("router") != -1):
+            s = "router"
+        if(r.find("leader") != -1):
+            s = "leader"                                
+        return s
+
     def showDeviceState(self):
         for device in self.threadDevices:
-            with serial.Serial(device, baudrate=115200, timeout=0.1) as ser:        
-                r = self.writeReadSerial(ser, "ot state\r\n")           
-                r = r.replace("uart:~$", '')
-                r = r.replace("ot state", '')            
-                r = r.replace("Done",'')
-                r = r.strip()                    
-                s = "unknwown"
-                if(r.find("child") != -1):
-                    s = "child"
-                if(r.find("disabled") != -1):
-                    s = "disabled"
-                if(r.find("detached") != -1):
-                    s = "detached"
-                if(r.find("router") != -1):
-                    s = "router"
-                if(r.find("leader") != -1):
-                    s = "leader"                                
-                print("[%s] thread state = %s" % (device,s))
+            if(health.quarantined(device) and not health.available(device)):
+                print("[%s] thread state = quarantined" % device)
+            else:
+                print("[%s] thread state = %s" % (device, self.getDeviceState(device)))
+
+    # rloc16 and addresses of a device
+    def getDeviceAddresses(self, device):
+        with self.pool.connection(device) as ser:        
+            rloc = response_lines(self.writeReadSerial(ser, "ot rloc16\r\n"), "ot rloc16")
+            addrs = response_lines(self.writeReadSerial(ser, "ot ipaddr\r\n"), "ot ipaddr")
+        return (rloc[0] if rloc else ""), [a for a in addrs if ":" in a]
+
+    # thread mode of a device, e.g. 'rdn' for an FTD
+    def getDeviceMode(self, device):
+        with self.pool.connection(device) as ser:
+            mode = response_lines(self.writeReadSerial(ser, "ot mode\r\n"), "ot mode")
+        return mode[0] if mode else ""
+
+    # answers of a device to the topology commands, {command: lines}
+    def queryTopology(self, device):
+        output = {}
+        with self.pool.connection(device) as ser:
+            for cmd in topology.COMMANDS:
+                output[cmd] = response_lines(self.writeReadSerial(ser, "ot " + cmd + "\r\n"), "ot " + cmd)
+        return output
+
+    # ask every device for its router, child and neighbor tables at once and
+    # print the links that changed since the last call
+    def showTopology(self):
+        devices = [dev for dev in self.threadDevices if health.available(dev)]
+        with ThreadPoolExecutor(max_workers=max(1, len(devices))) as pool:
+            responses = dict(zip(devices, pool.map(self.queryTopology, devices)))
+        print(self.topology.format_changes(self.topology.update(responses)))
+
+    # energy on every channel as seen by a device, {channel: rssi}; the
+    # interface has to be up for the radio to scan
+    def scanDevice(self, device):
+        cmd = "ot " + survey.scan_command()
+        with self.pool.connection(device) as ser:
+            self.writeReadSerial(ser, "ot ifconfig up\r\n")
+            return survey.parse_energy(response_lines(self.writeReadSerial(ser, cmd + "\r\n"), cmd))
+
+    # scan all devices at once, recommend the least congested channel and a
+    # txpower per role from the links of the last topology; with apply, switch
+    # to them and configure the network again
+    def surveyChannels(self, apply=False):
+        devices = [dev for dev in self.threadDevices if health.available(dev)]
+        with ThreadPoolExecutor(max_workers=max(1, len(devices))) as pool:
+            scans = {dev: energy for dev, energy in zip(devices, pool.map(self.scanDevice, devices)) if energy}
+        result = survey.recommend(scans, self.topology.snapshot,
+                                  {"ftd": self.ftdTxPower, "mtd": self.mtdTxPower})
+        print(survey.format_survey(result))
+        if apply and result["channel"] is not None:
+            self.channel = str(result["channel"])
+            self.ftdTxPower = result["txpower"]["ftd"]
+            self.mtdTxPower = result["txpower"]["mtd"]
+            self.configNetwork()
+        return result
+
+    # poll all devices until ctrl-c, printing only state transitions
+    def watchDeviceState(self, minInterval=0.5, maxInterval=30.0):
+        watch = NetworkWatch(minInterval, maxInterval)
+        with ThreadPoolExecutor(max_workers=max(1, len(self.threadDevices))) as pool:
+            try:
+                while True:
+                    states = list(pool.map(self.getDeviceState, self.threadDevices))
+                    moved = [(dev, s) for dev, s in zip(self.threadDevices, states) if watch.role_changed(dev, s)]
+                    details = pool.map(self.getDeviceAddresses, [dev for dev, _ in moved])
+                    changes = []
+                    for (dev, s), (rloc, addrs) in zip(moved, details):
+                        changes += watch.update(dev, s, rloc, addrs)
+                    for change in changes:
+                        print(change)
+                    time.sleep(watch.next_interval(bool(changes)))
+            except KeyboardInterrupt:
+                pass
   
         
-    def configNetwork(self):
+    def configNetwork(self, force=False):
+        try:
+            self.datasetTlvs()
+        except ValueError as e:
+            print("invalid network settings: %s" % e)
+            return
         # first, reset network
         #self.resetAllDevices()
         #self.softResetAllDevices()
         
-        # configure a device as FTD to act as router
-        self.configDeviceAsRouter(self.threadDevices[0], 0)
-        # configure others as MTD devices
-        for i in range(1,len(self.threadDevices)):
-            self.configDeviceAsChild(self.threadDevices[i], -40)  
+        # configure a device as FTD to act as router and the others as MTD
+        # devices, all boards at the same time
+        with ThreadPoolExecutor(max_workers=len(self.threadDevices)) as pool:
+            pool.submit(self.configDeviceAsRouter, self.threadDevices[0], self.ftdTxPower, force)
+            for i in range(1,len(self.threadDevices)):
+                pool.submit(self.configDeviceAsChild, self.threadDevices[i], self.mtdTxPower, force)
 
     def listDevices(self):
         for device in self.threadDevices:
             print(device)
     
     def findTTMDevice(self):
-        print("searching...")
-        ttydev = "/dev/ttyACM"         
-        self.noOfFoundDevices = 0       
-        self.threadDevices = []
-        for i in range(1, 20, 1):
-            dev = ttydev + str(i)
-            if(os.path.exists(dev)):
-                try:
-                    with serial.Serial(dev, baudrate=115200, timeout=0.1, write_timeout=1.0) as ser:    
-                        self.writeReadSerial(ser, "\r\n")  
-                        self.writeReadSerial(ser, "\r\n")                     
-                        self.writeSerial(ser, "version\r\n")                            
-                        rcv = self.readSerial(ser)  
-                        self.readSerial(ser)  
-                        if(rcv.find("NRF52840") != -1):   
-                            return dev    
-                except:
-                    pass
+        if(self.monitor):
+            entries = self.monitor.devices()
+        else:
+            print("searching...")
+            entries = discovery.discover(self.pool)
+        for entry in entries:
+            if(entry["ttm"]):
+                return entry["port"]
         return "none"
             
     
@@ -275,6 +479,7 @@ def main():
     cmd = ' '
     
     console = ThreadConsole(panid=PANID, channel=CHANNEL, networkkey=NETWORKKEY)
+    print("found %d thread devices" % console.startHotplug())
     
     while (cmd != 'quit'):
         cmd = input("> ")
@@ -283,16 +488,23 @@ def main():
             continue
         
         elif(cmd == "state"):
-            console.findOtDevices()
+            if(console.noOfFoundDevices == 0):
+                console.findOtDevices()
             console.showDeviceState()
 
-        elif(cmd == "config"):                    
+        elif(cmd == "watch"):
+            if(console.noOfFoundDevices == 0):
+                console.findOtDevices()
+            print("watching thread state, ctrl-c to stop")
+            console.watchDeviceState()
+
+        elif(cmd == "config" or cmd == "config force"):                    
             print ("finding openthread devices...")
             console.findOtDevices()
             print("found %d nRF devices" % console.noOfFoundDevices)        
             if (console.noOfFoundDevices):                   
                 print ("configuring thread network:")
-                console.configNetwork()
+                console.configNetwork(force=(cmd == "config force"))
                 
         elif(cmd == "reset"):             
             if(console.noOfFoundDevices == 0):
@@ -308,9 +520,16 @@ def main():
 
         elif(cmd == "ttmpower"):
             txpower = input("enter tx power in dBm: ")
-            if(txpower == "0" or txpower == "-20" or txpower == "-40"):
-                console.setTTMTxPower(txpower)    
+            if(survey.parse_txpower(txpower) is not None):
+                console.setTTMTxPower(str(survey.parse_txpower(txpower)))    
                 print("done")
+            else:
+                print("tx power must be %d to %d dBm" % (survey.MIN_TXPOWER, survey.MAX_TXPOWER))
+
+        elif(cmd == "survey" or cmd == "survey apply"):
+            if(console.noOfFoundDevices == 0):
+                console.findOtDevices()
+            console.surveyChannels(apply=(cmd == "survey apply"))
                 
         elif(cmd == "find"):  
             nD = console.findOtDevices()        
@@ -321,6 +540,10 @@ def main():
             else:
                 print("no thread devices found!")      
 
+        elif(cmd == "find all"):  
+            nD = console.findOtDevices(refresh=True)        
+            print("found %d thread devices" % nD)
+
         elif(cmd == "find ttm"):  
             dev = console.findTTMDevice()
             if(dev == "none"):
@@ -348,10 +571,27 @@ def main():
             else:
                 print("you need to configure thread devices first!")  
                                                           
+        elif(cmd.split()[:1] == ["stats"]):
+            print(stats_command(cmd))
+
+        elif(cmd.split()[:1] == ["record"]):
+            print(record_command(cmd))
+
+        elif(cmd.split()[:1] == ["health"]):
+            print(health_command(cmd))
+
+        elif(cmd.split()[:1] == ["topology"]):
+            console.showTopology()
+            message = topology.export_command(console.topology.snapshot, cmd)
+            if(message):
+                print(message)
+
         elif(cmd == "help" or cmd == 'h'):
             print("help menu:")
-            print("config\t\tconfigure thread devices")
+            print("config\t\tconfigure thread devices, sending only settings that changed")
+            print("config force\tconfigure thread devices, sending every setting")
             print("find\t\tfind number of thread devices")
+            print("find all\tre-probe every port, ignoring cached devices")
             print("find ttm\tfind the TTM thread device and report its tty allocation")
             print("list\t\tlist found thread devices")            
             print("reset\t\treset all thread devices")
@@ -359,7 +599,14 @@ def main():
             print("start\t\tstart the thread devices")
             print("stop\t\tstop the thread devices")
             print("state\t\tshow status of all thread devices")
+            print("stats\t\tshow command latency per device (stats json|prom FILE to export)")
+            print("record\t\trecord serial traffic to a file (record stop to end)")
+            print("health\t\tlist quarantined devices (health reset to release them)")
+            print("watch\t\tshow thread state changes as they happen")
+            print("topology\tshow mesh links that changed (topology json|dot FILE to export)")
             print("ttmpower\tset TTM device tx power strength in dBm")
+            print("survey\t\tscan channel energy on all devices and recommend channel and tx power")
+            print("survey apply\tswitch to the recommended channel and tx power and configure")
             print("quit\t\tquit")   
         
         elif(len(cmd) != 0):
@@ -0,0 +1,249 @@
+import asyncio
+import json
+import re
+import time
+
+from metrics import write_file
+from ot_serial import response_lines
+
+# Commands sent to every device for a snapshot
+COMMANDS = ["extaddr", "rloc16", "state", "router table", "child table",
+            "neighbor table", "leaderdata"]
+LEADERDATA_LINE = re.compile(r"^([A-Za-z ]+): (\S+)$")
+
+
+# Rows of a table printed by the CLI ("router table", "child table", ...) as
+# dicts keyed by the stripped column names
+def parse_table(lines):
+    header = None
+    rows = []
+    for line in lines:
+        if not line.startswith("|"):
+            continue  # "+----+" separators, Done, errors
+        cells = [cell.strip() for cell in line.strip().strip("|").split("|")]
+        if header is None:
+            header = cells
+        elif len(cells) == len(header):
+            rows.append(dict(zip(header, cells)))
+    return rows
+
+
+# "leaderdata" output as {"partition_id": "1077744240", "leader_router_id": "60", ...}
+def parse_leaderdata(lines):
+    fields = {}
+    for line in lines:
+        match = LEADERDATA_LINE.match(line)
+        if match:
+            fields[match.group(1).strip().lower().replace(" ", "_")] = match.group(2)
+    return fields
+
+
+def number(text):
+    try:
+        return int(text, 0)
+    except (TypeError, ValueError):
+        return None
+
+
+# Build a snapshot of the mesh from {port: {command: lines}}. Nodes are keyed
+# by extended address, which stays the same when a device changes role, and
+# include the neighbors seen in the tables that no port is connected to.
+# Edges are keyed (node, node, kind) with kind "router" for links between
+# routers and "child" for parent (first) to child (second); each carries the
+# worst link quality (0-3) and average RSSI reported by either end.
+def build_snapshot(responses):
+    nodes = {}
+    edges = {}
+    partitions = {}
+
+    def node(ext, rloc16=None, role=None, port=None):
+        entry = nodes.setdefault(ext, {"port": None, "rloc16": None, "role": None})
+        for key, value in (("rloc16", rloc16), ("role", role), ("port", port)):
+            if value is not None and (entry[key] is None or port is not None):
+                entry[key] = value
+        return entry
+
+    def link(a, b, kind, lq=None):
+        key = (a, b, kind) if kind == "child" else (min(a, b), max(a, b), kind)
+        edge = edges.setdefault(key, {"lq": None, "rssi": []})
+        if lq is not None:
+            edge["lq"] = lq if edge["lq"] is None else min(edge["lq"], lq)
+        return edge
+
+    own = {}  # port -> extended address
+    for port, output in sorted(responses.items()):
+        ext = (output.get("extaddr") or [""])[0]
+        if not re.fullmatch(r"[0-9a-f]{16}", ext):
+            continue  # didn't answer
+        own[port] = ext
+        rloc16 = (output.get("rloc16") or [""])[0]
+        role = (output.get("state") or [""])[0]
+        node(ext, "0x" + rloc16 if rloc16 else None, role, port)
+        leaderdata = parse_leaderdata(output.get("leaderdata", []))
+        if "partition_id" in leaderdata:
+            partition = partitions.setdefault(leaderdata["partition_id"], {
+                "leader_router_id": number(leaderdata.get("leader_router_id")), "ports": []})
+            partition["ports"].append(port)
+        for row in parse_table(output.get("router table", [])):
+            peer = row.get("Extended MAC")
+            if not peer or peer == ext:
+                continue
+            node(peer, row.get("RLOC16"), "router")
+            if row.get("Link") == "1":
+                lq = [number(row.get(column)) for column in ("LQ In", "LQ Out")]
+                link(ext, peer, "router", None if None in lq else min(lq))
+        for row in parse_table(output.get("child table", [])):
+            child = row.get("Extended MAC")
+            if child:
+                node(child, row.get("RLOC16"), "child")
+                link(ext, child, "child", number(row.get("LQ In")))
+        for row in parse_table(output.get("neighbor table", [])):
+            peer = row.get("Extended MAC")
+            if not peer:
+                continue
+            peer_role = "child" if row.get("Role") == "C" else "router"
+            node(peer, row.get("RLOC16"), peer_role)
+            if peer_role == "child":
+                edge = link(ext, peer, "child")
+            elif role == "child":
+                edge = link(peer, ext, "child")  # a child's only neighbor is its parent
+            else:
+                edge = link(ext, peer, "router")
+            rssi = number(row.get("Avg RSSI"))
+            if rssi is not None:
+                edge["rssi"].append(rssi)
+
+    for edge in edges.values():
+        edge["rssi"] = round(sum(edge["rssi"]) / len(edge["rssi"])) if edge["rssi"] else None
+    return {"time": time.time(), "nodes": nodes, "edges": edges, "partitions": partitions,
+            "ports": own}
+
+
+# Run the COMMANDS on every device at once, `devices` being
+# async_ot_devices; returns {port: {command: lines}}
+async def collect(devices):
+    async def query(device):
+        output = {}
+        for command in COMMANDS:
+            output[command] = response_lines(await device.run_command(command), command)
+        return output
+
+    results = await asyncio.gather(*(query(device) for device in devices))
+    return {device.port: output for device, output in zip(devices, results)}
+
+
+# Edges in `new` but not `old` and the other way round
+def diff(old, new):
+    old_edges = old["edges"] if old else {}
+    return {
+        "added": sorted(key for key in new["edges"] if key not in old_edges),
+        "removed": sorted(key for key in old_edges if key not in new["edges"]),
+    }
+
+
+# Keeps the last snapshot so each refresh reports only the edges that
+# appeared or went away since the previous one
+class Topology:
+    def __init__(self):
+        self.snapshot = None
+        self.previous = None
+
+    # Take a snapshot from {port: {command: lines}} and return the changes
+    def update(self, responses):
+        snapshot = build_snapshot(responses)
+        changes = diff(self.snapshot, snapshot)
+        self.previous, self.snapshot = self.snapshot, snapshot
+        return changes
+
+    async def refresh(self, devices):
+        return self.update(await collect(devices))
+
+    # One line per changed edge, or the whole graph on the first snapshot
+    def format_changes(self, changes):
+        if self.previous is None:
+            return format_snapshot(self.snapshot)
+        lines = []
+        for key in changes["added"]:
+            lines.append("+ " + format_edge(self.snapshot, key))
+        for key in changes["removed"]:
+            lines.append("- " + format_edge(self.previous, key))
+        lines.append(format_partitions(self.snapshot))
+        return "\n".join(lines)
+
+
+# Port, else rloc16, of a node
+def node_name(snapshot, ext):
+    entry = snapshot["nodes"].get(ext, {})
+    return entry.get("port") or entry.get("rloc16") or ext
+
+
+def format_edge(snapshot, key):
+    a, b, kind = key
+    edge = snapshot["edges"][key]
+    details = [kind]
+    if edge["lq"] is not None:
+        details.append("lq %d" % edge["lq"])
+    if edge["rssi"] is not None:
+        details.append("%d dBm" % edge["rssi"])
+    return "%s -- %s (%s)" % (node_name(snapshot, a), node_name(snapshot, b), ", ".join(details))
+
+
+def format_partitions(snapshot):
+    partitions = snapshot["partitions"]
+    routers = sum(1 for entry in snapshot["nodes"].values() if entry["role"] in ("router", "leader"))
+    text = "%d nodes, %d routers, %d links, %d partition%s" % (
+        len(snapshot["nodes"]), routers, len(snapshot["edges"]), len(partitions),
+        "" if len(partitions) == 1 else "s")
+    if len(partitions) > 1:
+        for partition_id, partition in sorted(partitions.items()):
+            text += "\npartition %s | %d devices" % (partition_id, len(partition["ports"]))
+    return text
+
+
+def format_snapshot(snapshot):
+    lines = [format_edge(snapshot, key) for key in sorted(snapshot["edges"])]
+    lines.append(format_partitions(snapshot))
+    return "\n".join(lines)
+
+
+def to_json(snapshot):
+    return json.dumps({
+        "time": snapshot["time"],
+        "nodes": [dict(entry, extaddr=ext) for ext, entry in sorted(snapshot["nodes"].items())],
+        "edges": [dict(edge, source=a, target=b, kind=kind)
+                  for (a, b, kind), edge in sorted(snapshot["edges"].items())],
+        "partitions": snapshot["partitions"],
+    }, indent=1)
+
+
+# Graphviz graph: routers as boxes, children as ellipses, child links dashed,
+# link quality as the edge label
+def to_dot(snapshot):
+    lines = ["graph thread {"]
+    for ext, entry in sorted(snapshot["nodes"].items()):
+        label = "\\n".join(part for part in (entry["port"], entry["rloc16"], entry["role"]) if part)
+        shape = "box" if entry["role"] in ("router", "leader") else "ellipse"
+        style = ", style=bold" if entry["role"] == "leader" else ""
+        lines.append('  "%s" [label="%s", shape=%s%s];' % (ext, label, shape, style))
+    for (a, b, kind), edge in sorted(snapshot["edges"].items()):
+        attributes = []
+        if edge["lq"] is not None:
+            attributes.append('label="%d"' % edge["lq"])
+        if kind == "child":
+            attributes.append("style=dashed")
+        lines.append('  "%s" -- "%s" [%s];' % (a, b, ", ".join(attributes)))
+    lines.append("}")
+    return "\n".join(lines) + "\n"
+
+
+# Console "topology json FILE" / "topology dot FILE": write the last snapshot
+# to a file. Returns a message, or None if the command asks for no export.
+def export_command(snapshot, cmd):
+    words = cmd.split()
+    if len(words) != 3 or words[1] not in ("json", "dot"):
+        return None
+    try:
+        write_file(words[2], to_json(snapshot) if words[1] == "json" else to_dot(snapshot))
+    except OSError as e:
+        return "can't write %s: %s" % (words[2], e.strerror or e)
+    return "topology written to " + words[2]
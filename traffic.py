@@ -0,0 +1,205 @@
+import asyncio
+import json
+import random
+import re
+import time
+
+import ping_matrix
+from async_device import broadcast
+
+RECEIVED = re.compile(r"(\d+) bytes from (\S+) (\d+) f(\d+)\.(\d+)\.")
+
+# Ways of choosing who sends to whom
+ALL_TO_LEADER = "all-to-leader"
+PAIRWISE = "pairwise"
+RANDOM = "random"
+PATTERNS = (ALL_TO_LEADER, PAIRWISE, RANDOM)
+
+# Default load: UDP port the targets listen on, datagrams per flow, payload
+# bytes and seconds between datagrams of a flow
+UDP_PORT = 1234
+COUNT = 20
+SIZE = 64
+INTERVAL = 0.1
+# Seconds to wait for datagrams still in flight after the last one is sent
+DRAIN_TIME = 2.0
+# Width in seconds of the goodput buckets
+BUCKET = 1.0
+
+
+# Flows as (source, target) device indexes. all-to-leader sends from every
+# device to the leader; pairwise pairs device i with device i + N/2, so
+# every device sends one flow and receives one; random sends from every
+# device to another one picked at random.
+def plan_flows(count, pattern, leader=0, rng=random):
+    if pattern == ALL_TO_LEADER:
+        return [(i, leader) for i in range(count) if i != leader]
+    if pattern == PAIRWISE:
+        half = max(1, count // 2)
+        return [(i, (i + half) % count) for i in range(count) if (i + half) % count != i]
+    if pattern == RANDOM:
+        return [(i, rng.choice([j for j in range(count) if j != i])) for i in range(count) if count > 1]
+    raise ValueError("unknown traffic pattern " + pattern)
+
+
+# Payload of datagram `seq` of flow `flow`, padded to `size` bytes. The flow
+# and sequence number let the receiver's output be matched to the send.
+def payload(flow, seq, size):
+    text = "f%d.%d." % (flow, seq)
+    return text + "x" * max(0, size - len(text))
+
+
+# Collects what the targets report receiving, from their event logs and from
+# responses that arrived while they were running a command of their own
+class Receiver:
+    def __init__(self):
+        self.received = {}  # (flow, seq) -> (monotonic time, bytes)
+
+    def line(self, timestamp, line):
+        match = RECEIVED.search(line)
+        if match:
+            key = (int(match.group(4)), int(match.group(5)))
+            self.received.setdefault(key, (timestamp, int(match.group(1))))
+
+    def response(self, text):
+        now = time.monotonic()
+        for line in text.split("\n"):
+            self.line(now, line)
+
+
+# Send one flow's datagrams at `interval`, recording when each was sent
+async def send_flow(device, flow, address, count, size, interval, port, sent, receiver):
+    loop = asyncio.get_running_loop()
+    start = loop.time()
+    for seq in range(count):
+        await asyncio.sleep(max(0, start + seq * interval - loop.time()))
+        sent[(flow, seq)] = time.monotonic()
+        receiver.response(await device.run_command(
+            "udp send %s %d %s" % (address, port, payload(flow, seq, size))))
+
+
+# Run UDP flows between `devices` (async_ot_devices) at once. `addresses` are
+# the devices' mesh addresses. Returns the results of summarize().
+async def udp_traffic(devices, addresses, flows, count=COUNT, size=SIZE,
+                      interval=INTERVAL, port=UDP_PORT):
+    receiver = Receiver()
+    targets = sorted({target for source, target in flows})
+    await broadcast(devices, "udp close")  # left open by an earlier run
+    await broadcast(devices, "udp open")
+    await broadcast([devices[i] for i in targets], "udp bind :: %d" % port)
+    for i in targets:
+        devices[i].events.subscribe(receiver.line)
+    sent = {}
+    start = time.monotonic()
+    try:
+        await asyncio.gather(*(
+            send_flow(devices[source], flow, addresses[target], count, size, interval,
+                      port, sent, receiver)
+            for flow, (source, target) in enumerate(flows)))
+        deadline = time.monotonic() + DRAIN_TIME
+        while len(receiver.received) < len(sent) and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+    finally:
+        for i in targets:
+            devices[i].events.unsubscribe(receiver.line)
+        await broadcast(devices, "udp close")
+    return summarize(devices, flows, sent, receiver.received, start, size)
+
+
+# Per-flow and aggregate figures:
+#   {"flows": [{"source", "target", "sent", "received", "bytes", "loss",
+#               "latency_avg", "latency_max"}],
+#    "goodput": [bytes per second in each BUCKET], "bytes", "seconds"}
+# Latency is measured on the host, from the send command going out to the
+# target printing the datagram, so it includes both serial links.
+def summarize(devices, flows, sent, received, start, size):
+    results = []
+    for flow, (source, target) in enumerate(flows):
+        keys = [key for key in sent if key[0] == flow]
+        got = [key for key in keys if key in received]
+        latencies = [1000 * (received[key][0] - sent[key]) for key in got]
+        results.append({
+            "source": devices[source].port,
+            "target": devices[target].port,
+            "sent": len(keys),
+            "received": len(got),
+            "bytes": sum(received[key][1] for key in got),
+            "loss": round(100.0 * (len(keys) - len(got)) / len(keys), 1) if keys else 100.0,
+            "latency_avg": round(sum(latencies) / len(latencies), 1) if latencies else None,
+            "latency_max": round(max(latencies), 1) if latencies else None,
+        })
+    end = max([timestamp for timestamp, _ in received.values()] + [start])
+    goodput = [0] * (int((end - start) / BUCKET) + 1)
+    for timestamp, length in received.values():
+        goodput[int((timestamp - start) / BUCKET)] += length
+    return {
+        "flows": results,
+        "goodput": [round(total / BUCKET) for total in goodput],
+        "bytes": sum(flow["bytes"] for flow in results),
+        "seconds": round(end - start, 3),
+        "size": size,
+    }
+
+
+# Sized, counted pings on every flow at once, with the results in the same
+# shape as udp_traffic; bytes are the echo payloads that came back
+async def ping_traffic(devices, addresses, flows, count=COUNT, size=SIZE, interval=INTERVAL):
+    start = time.monotonic()
+    pings = await asyncio.gather(*(
+        ping_matrix.ping(devices[source], addresses[target], count, size, interval)
+        for source, target in flows))
+    seconds = time.monotonic() - start
+    results = []
+    for (source, target), result in zip(flows, pings):
+        results.append({
+            "source": devices[source].port,
+            "target": devices[target].port,
+            "sent": result["sent"],
+            "received": result["received"],
+            "bytes": result["received"] * size,
+            "loss": result["loss"],
+            "latency_avg": result["rtt_avg"],
+            "latency_max": result["rtt_max"],
+        })
+    total = sum(flow["bytes"] for flow in results)
+    return {"flows": results, "goodput": [round(total / seconds)] if seconds else [],
+            "bytes": total, "seconds": round(seconds, 3), "size": size}
+
+
+# Run a traffic pattern over the attached devices. Addresses and the leader
+# are looked up on the devices, all at once.
+async def run_traffic(devices, pattern=ALL_TO_LEADER, kind="udp", count=COUNT,
+                      size=SIZE, interval=INTERVAL):
+    roles = [state.split("\n")[0] for state in await broadcast(devices, "state")]
+    attached = [i for i, role in enumerate(roles) if role in ("child", "router", "leader")]
+    if len(attached) < 2:
+        return None
+    devices = [devices[i] for i in attached]
+    roles = [roles[i] for i in attached]
+    leader = roles.index("leader") if "leader" in roles else 0
+    addresses = [ping_matrix.mesh_address(res) for res in await broadcast(devices, "ipaddr")]
+    flows = plan_flows(len(devices), pattern, leader)
+    if kind == "ping":
+        return await ping_traffic(devices, addresses, flows, count, size, interval)
+    return await udp_traffic(devices, addresses, flows, count, size, interval)
+
+
+def to_json(results):
+    return json.dumps(results, indent=1)
+
+
+def format_results(results):
+    if results is None:
+        return "need at least two attached devices"
+    lines = []
+    for flow in results["flows"]:
+        latency = "-" if flow["latency_avg"] is None else "%gms avg %gms max" % (
+            flow["latency_avg"], flow["latency_max"])
+        lines.append("%s -> %s | %d/%d | %d B | %g%% loss | %s" % (
+            flow["source"], flow["target"], flow["received"], flow["sent"], flow["bytes"],
+            flow["loss"], latency))
+    lines.append("goodput B/s: " + " ".join(str(value) for value in results["goodput"]))
+    seconds = results["seconds"] or 1
+    lines.append("%d flows, %d bytes in %g s, %.0f B/s" % (
+        len(results["flows"]), results["bytes"], results["seconds"], results["bytes"] / seconds))
+    return "\n".join(lines)
@@ -0,0 +1,49 @@
+# Last known role, rloc16 and addresses of every device, reporting only what
+# changed between polls. The poll interval drops to `min_interval` after a
+# change and backs off towards `max_interval` while the network is stable.
+class NetworkWatch:
+    def __init__(self, min_interval=0.5, max_interval=30.0, backoff=2.0):
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+        self.interval = min_interval
+        self.devices = {}  # port -> {"role": ..., "rloc16": ..., "addresses": [...]}
+
+    # True if the role differs from the last one seen, so the caller should
+    # also fetch rloc16 and addresses
+    def role_changed(self, port, role):
+        return self.devices.get(port, {}).get("role") != role
+
+    # Record a poll result and return a description of each change
+    def update(self, port, role, rloc16=None, addresses=None):
+        last = self.devices.setdefault(port, {"role": None, "rloc16": None, "addresses": []})
+        changes = []
+        if role != last["role"]:
+            if last["role"] is None:
+                changes.append("%s | %s" % (port, role))
+            else:
+                changes.append("%s | %s -> %s" % (port, last["role"], role))
+            last["role"] = role
+        if rloc16 is not None and rloc16 != last["rloc16"]:
+            if last["rloc16"] is not None:
+                changes.append("%s | rloc16 %s -> %s" % (port, last["rloc16"], rloc16))
+            last["rloc16"] = rloc16
+        if addresses is not None and addresses != last["addresses"]:
+            for address in sorted(set(addresses) - set(last["addresses"])):
+                changes.append("%s | + %s" % (port, address))
+            for address in sorted(set(last["addresses"]) - set(addresses)):
+                changes.append("%s | - %s" % (port, address))
+            last["addresses"] = list(addresses)
+        return changes
+
+    # Forget devices that are no longer polled
+    def forget(self, port):
+        self.devices.pop(port, None)
+
+    # Interval until the next poll, given whether this poll saw a change
+    def next_interval(self, changed):
+        if changed:
+            self.interval = self.min_interval
+        else:
+            self.interval = min(self.max_interval, self.interval * self.backoff)
+        return self.interval